@@ -0,0 +1,1151 @@
+import argparse
+import asyncio
+import collections
+import gc
+import json
+import os
+import random
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+from cluster import RemoteClient
+from common import PROTOCOL_V1, PROTOCOL_V2, ClientInfo, FrameDecoder, encode_body, parse_header_block, read_frame
+from common import encode_frame as encode_protocol_frame
+from engine import ChatEngine
+from registry import ClientRegistry, ClientSession
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def encode_frame(message_type, json_data=None, additional_headers=None):
+    body = json.dumps(json_data).encode('utf-8') if json_data else b''
+    headers = [f"{message_type} 1.0", "Host: 127.0.0.1", f"Content-Length: {len(body)}"]
+    if additional_headers:
+        for key, value in additional_headers.items():
+            headers.append(f"{key}: {value}")
+    return ("\r\n".join(headers) + "\r\n\r\n").encode('utf-8') + body
+
+
+def process_stats(pid):
+    """RSS (KiB) und Thread-Anzahl eines Prozesses aus /proc lesen"""
+    stats = {'rss_kib': None, 'threads': None}
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    stats['rss_kib'] = int(line.split()[1])
+                elif line.startswith('Threads:'):
+                    stats['threads'] = int(line.split()[1])
+    except OSError:
+        pass
+    return stats
+
+
+def start_server(mode, port, extra_args=()):
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'Server.py'),
+         '--host', '127.0.0.1', '--port', str(port), '--mode', mode, *extra_args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        preexec_fn=raise_fd_limit
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"Server ({mode}) nicht erreichbar")
+
+
+class Drain:
+    """Liest alle Client-Sockets in einem Thread leer und zählt Nachrichtentypen"""
+
+    def __init__(self, patterns):
+        self.selector = selectors.DefaultSelector()
+        self.patterns = [p.encode('utf-8') for p in patterns]
+        self.counts = {p: 0 for p in patterns}
+        self.first_seen = set()
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def add(self, sock):
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, [b''])
+
+    def run(self):
+        while self.running:
+            for key, _ in self.selector.select(timeout=0.2):
+                try:
+                    data = key.fileobj.recv(65536)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    data = b''
+                if not data:
+                    self.selector.unregister(key.fileobj)
+                    continue
+                # Rest des letzten Pakets voranstellen, damit geteilte Typen gezählt werden
+                tail = key.data[0]
+                window = tail + data
+                key.data[0] = window[-32:]
+                with self.lock:
+                    self.first_seen.add(key.fileobj)
+                    for pattern, name in zip(self.patterns, self.counts):
+                        self.counts[name] += window.count(pattern) - tail.count(pattern)
+
+    def count(self, name):
+        with self.lock:
+            return self.counts[name]
+
+    def seen(self):
+        with self.lock:
+            return len(self.first_seen)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+
+def wait_until(predicate, timeout, interval=0.01):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+    return predicate()
+
+
+def bench_connections(mode, clients, timeout):
+    port = free_port()
+    server = start_server(mode, port)
+    drain = Drain(['BROADCAST_MSG'])
+    sockets = []
+    result = {'mode': mode, 'clients': clients}
+
+    try:
+        idle = process_stats(server.pid)
+        drain.thread.start()
+
+        started = time.perf_counter()
+        for i in range(clients):
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall(encode_frame('REGISTER', {
+                'nickname': f"bench{i}",
+                'ip': '127.0.0.1',
+                'udp_port': 10000 + i
+            }))
+            drain.add(sock)
+            sockets.append(sock)
+        registered = wait_until(lambda: drain.seen() >= clients, timeout)
+        result['register_seconds'] = round(time.perf_counter() - started, 3)
+        result['registered'] = drain.seen()
+
+        loaded = process_stats(server.pid)
+        result['rss_kib'] = loaded['rss_kib']
+        result['threads'] = loaded['threads']
+        if idle['rss_kib'] and loaded['rss_kib']:
+            result['kib_per_client'] = round((loaded['rss_kib'] - idle['rss_kib']) / clients, 2)
+
+        if registered:
+            # Ein Broadcast muss alle anderen Clients erreichen
+            expected = drain.count('BROADCAST_MSG') + clients - 1
+            started = time.perf_counter()
+            sockets[0].setblocking(True)
+            sockets[0].sendall(encode_frame('BROADCAST', {'message': 'ping'}))
+            sockets[0].setblocking(False)
+            if wait_until(lambda: drain.count('BROADCAST_MSG') >= expected, timeout):
+                result['broadcast_fanout_seconds'] = round(time.perf_counter() - started, 4)
+    finally:
+        drain.stop()
+        for sock in sockets:
+            sock.close()
+        server.kill()
+        server.wait()
+
+    return result
+
+
+def bench_sharding(workers, clients, senders, broadcasts, mode, timeout):
+    """Zugestellte BROADCAST_MSG pro Sekunde bei workers Server-Prozessen"""
+    port = free_port()
+    server = start_server(mode, port, ['--workers', str(workers), '--rate-limit', 'none'])
+    drain = Drain(['BROADCAST_MSG'])
+    sockets = []
+    result = {'workers': workers, 'mode': mode, 'clients': clients, 'senders': senders}
+
+    try:
+        time.sleep(0.5)  # alle Worker an den Port binden lassen
+        drain.thread.start()
+        for i in range(clients):
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall(encode_frame('REGISTER', {
+                'nickname': f"bench{i}",
+                'ip': '127.0.0.1',
+                'udp_port': 10000 + i
+            }))
+            drain.add(sock)
+            sockets.append(sock)
+        if not wait_until(lambda: drain.seen() >= clients, timeout):
+            result['error'] = f"nur {drain.seen()} Clients registriert"
+            return result
+        time.sleep(1.0)  # Beitritte über den Shard-Bus verteilen lassen
+
+        frame = encode_frame('BROADCAST', {'message': 'x' * 64})
+        expected = senders * broadcasts * (clients - 1)
+        started = time.perf_counter()
+        for sock in sockets[:senders]:
+            sock.setblocking(True)
+        for _ in range(broadcasts):
+            for sock in sockets[:senders]:
+                sock.sendall(frame)
+        delivered = wait_until(lambda: drain.count('BROADCAST_MSG') >= expected, timeout)
+        elapsed = time.perf_counter() - started
+        result['delivered'] = drain.count('BROADCAST_MSG')
+        result['expected'] = expected
+        result['seconds'] = round(elapsed, 3)
+        if delivered:
+            result['deliveries_per_second'] = round(expected / elapsed)
+    finally:
+        drain.stop()
+        for sock in sockets:
+            sock.close()
+        server.terminate()
+        server.wait()
+
+    return result
+
+
+def cmd_sharding(args):
+    results = [bench_sharding(workers, args.clients, args.senders, args.broadcasts, args.mode, args.timeout)
+               for workers in args.workers]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        if 'error' in result:
+            print(f"[{result['workers']} Worker] Fehler: {result['error']}")
+            continue
+        print(f"[{result['workers']} Worker] {result['delivered']}/{result['expected']} Zustellungen "
+              f"in {result['seconds']}s ({result.get('deliveries_per_second')} /s)")
+
+
+def percentiles(samples):
+    """p50/p99/p999 und Maximum einer Latenzliste in Millisekunden"""
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+    pick = lambda p: round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 3)
+    return {
+        'count': len(samples),
+        'p50': pick(0.50),
+        'p99': pick(0.99),
+        'p999': pick(0.999),
+        'max': round(samples[-1] * 1000, 3)
+    }
+
+
+def cluster_stats(pid):
+    """RSS, Threads und CPU-Sekunden eines Prozesses samt direkter Kindprozesse (Worker)"""
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            pids += [int(child) for child in children.read().split()]
+    except OSError:
+        pass
+
+    ticks = os.sysconf('SC_CLK_TCK')
+    totals = {'rss_kib': 0, 'threads': 0, 'cpu_seconds': 0.0, 'processes': len(pids)}
+    for process_id in pids:
+        stats = process_stats(process_id)
+        totals['rss_kib'] += stats['rss_kib'] or 0
+        totals['threads'] += stats['threads'] or 0
+        try:
+            with open(f"/proc/{process_id}/stat") as stat:
+                # Felder nach dem Prozessnamen; utime und stime sind Feld 14 und 15
+                fields = stat.read().rsplit(')', 1)[1].split()
+            totals['cpu_seconds'] += (int(fields[11]) + int(fields[12])) / ticks
+        except (OSError, IndexError, ValueError):
+            pass
+    totals['cpu_seconds'] = round(totals['cpu_seconds'], 3)
+    return totals
+
+
+class LoadClient:
+    """Synthetischer Protokoll-Client ohne TUI, gesteuert vom LoadGenerator"""
+
+    def __init__(self, index, protocol_version, recv_view):
+        self.index = index
+        self.nickname = f"load{index}"
+        self.offer_version = protocol_version
+        self.protocol_version = PROTOCOL_V1  # bis REGISTER_OK eine andere Version bestätigt
+        self.decoder = FrameDecoder(recv_view)
+        self.socket = None
+        self.udp_socket = None
+        self.listener = None
+        self.registered = False
+        self.busy = False  # An-/Abmeldung läuft, keine weiteren Aktionen
+        self.register_started = None
+        self.skip_lists = 0  # USER_LIST-Antworten auf REGISTER, nicht auf GET_USERS
+        self.pending_users = collections.deque()  # Sendezeitpunkte offener GET_USERS
+        self.chat = None
+
+    def frame(self, message_type, json_data=None, additional_headers=None, protocol_version=None):
+        protocol_version = protocol_version or self.protocol_version
+        headers = {} if protocol_version == PROTOCOL_V2 else {'Host': '127.0.0.1'}
+        if additional_headers:
+            headers.update(additional_headers)
+        return encode_protocol_frame(message_type, protocol_version, headers,
+                                     encode_body(json_data, protocol_version))
+
+    def register_frame(self):
+        # REGISTER immer als Text, die Startzeile bietet die gewünschte Version an
+        return self.frame('REGISTER', {'nickname': self.nickname, 'ip': '127.0.0.1',
+                                       'udp_port': self.udp_port()},
+                          {'Presence': 'batch'}, self.offer_version)
+
+    def udp_port(self):
+        return self.udp_socket.getsockname()[1] if self.udp_socket else 10000 + self.index
+
+
+class ChatSession:
+    """Ein P2P-Durchlauf: CHAT_REQUEST (UDP), CHAT_HELLO und CHAT_MSG (TCP)"""
+
+    def __init__(self, initiator, responder, request_id, messages):
+        self.initiator = initiator
+        self.responder = responder
+        self.request_id = request_id
+        self.messages = messages
+        self.started = time.perf_counter()
+        self.initiator_socket = None
+        self.responder_socket = None
+        self.received = 0
+
+
+class LoadGenerator:
+    """Treibt viele LoadClients aus einem Selector-Loop und sammelt Latenzen.
+
+    Aktionen werden offen getaktet (feste Rate, unabhängig von Antworten),
+    damit ein langsamer Server sich in den Latenzen zeigt statt in einer
+    gedrosselten Last.
+    """
+
+    OPERATIONS = ('broadcast', 'get_users', 'churn', 'chat')
+
+    def __init__(self, port, clients, chat_peers, protocol_version, chat_messages):
+        self.port = port
+        self.selector = selectors.DefaultSelector()
+        self.recv_view = memoryview(bytearray(65536))
+        self.clients = [LoadClient(i, protocol_version, self.recv_view) for i in range(clients)]
+        self.chat_peers = self.clients[:chat_peers]
+        self.chat_messages = chat_messages
+        self.latencies = {name: [] for name in ('broadcast', 'get_users', 'register', 'chat_request',
+                                                'chat_connect', 'chat_msg')}
+        self.sent = {name: 0 for name in self.OPERATIONS}
+        self.broadcast_expected = 0
+        self.broadcast_delivered = 0
+        self.frames_received = 0
+        self.errors = 0
+        self.rejected = 0  # vom Rate Limit des Servers abgewiesene Nachrichten
+        self.chats = {}  # {request_id: ChatSession}
+        self.sequence = 0
+
+    def connect_all(self, timeout):
+        for client in self.chat_peers:
+            client.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client.udp_socket.bind(('127.0.0.1', 0))
+            client.udp_socket.setblocking(False)
+            self.selector.register(client.udp_socket, selectors.EVENT_READ, ('udp', client))
+            client.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client.listener.bind(('127.0.0.1', 0))
+            client.listener.listen(16)
+            client.listener.setblocking(False)
+            self.selector.register(client.listener, selectors.EVENT_READ, ('listen', client))
+
+        for client in self.clients:
+            client.socket = socket.create_connection(('127.0.0.1', self.port))
+            client.register_started = time.perf_counter()
+            client.busy = True
+            client.socket.sendall(client.register_frame())
+            client.socket.setblocking(False)
+            self.selector.register(client.socket, selectors.EVENT_READ, ('server', client))
+            self.poll(0)
+
+        deadline = time.time() + timeout
+        while time.time() < deadline and not all(client.registered for client in self.clients):
+            self.poll(0.05)
+        # Registrierungen der Aufbauphase nicht als Churn-Latenz werten
+        self.latencies['register'].clear()
+        return sum(client.registered for client in self.clients)
+
+    def run(self, duration, rate, mix):
+        names = [name for name in self.OPERATIONS if mix.get(name)]
+        weights = [mix[name] for name in names]
+        interval = 1.0 / rate
+        started = time.perf_counter()
+        next_due = started
+        end = started + duration
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                break
+            while next_due <= now:
+                self.issue(random.choices(names, weights)[0])
+                next_due += interval
+            self.poll(max(0.0, min(next_due, end) - time.perf_counter()))
+        return time.perf_counter() - started
+
+    def settle(self, timeout):
+        """Ausstehende Antworten nach dem Lastlauf noch einsammeln"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if (self.broadcast_delivered >= self.broadcast_expected and not self.chats
+                    and not any(client.pending_users or client.busy for client in self.clients)):
+                return
+            self.poll(0.05)
+
+    def issue(self, operation):
+        ready = [client for client in random.sample(self.clients, min(8, len(self.clients)))
+                 if client.registered and not client.busy]
+        if not ready:
+            return
+        client = ready[0]
+
+        if operation == 'broadcast':
+            self.sequence += 1
+            stamp = repr(time.perf_counter())
+            self.send(client, client.frame('BROADCAST', {'message': f"load:{stamp}"}))
+            self.broadcast_expected += sum(other.registered for other in self.clients) - 1
+        elif operation == 'get_users':
+            client.pending_users.append(time.perf_counter())
+            # Request-ID, damit ein abgelehntes GET_USERS seinem Zeitstempel zugeordnet werden kann
+            self.send(client, client.frame('GET_USERS', None, {'Request-ID': 'users'}))
+        elif operation == 'churn':
+            if client.pending_users:
+                return
+            client.busy = True
+            self.send(client, client.frame('UNREGISTER'))
+        elif operation == 'chat':
+            if not self.start_chat():
+                return
+        self.sent[operation] += 1
+
+    def start_chat(self):
+        idle = [client for client in self.chat_peers if client.chat is None and client.registered]
+        if len(idle) < 2:
+            return False
+        initiator, responder = random.sample(idle, 2)
+        self.sequence += 1
+        request_id = f"{initiator.nickname}_{self.sequence}"
+        session = ChatSession(initiator, responder, request_id, self.chat_messages)
+        initiator.chat = responder.chat = session
+        self.chats[request_id] = session
+        frame = initiator.frame('CHAT_REQUEST', {'tcp_port': initiator.listener.getsockname()[1]},
+                                {'From': initiator.nickname, 'To': responder.nickname, 'Request-ID': request_id},
+                                PROTOCOL_V1)
+        initiator.udp_socket.sendto(frame, responder.udp_socket.getsockname())
+        return True
+
+    def send(self, client, frame):
+        try:
+            client.socket.sendall(frame)
+        except BlockingIOError:
+            # Sendepuffer voll: kurz blockierend nachschieben, der Server hängt hinterher
+            client.socket.setblocking(True)
+            client.socket.sendall(frame)
+            client.socket.setblocking(False)
+        except OSError:
+            self.errors += 1
+
+    def poll(self, timeout):
+        for key, _ in self.selector.select(timeout):
+            kind, client = key.data
+            if kind == 'server':
+                self.read_server(client)
+            elif kind == 'udp':
+                self.read_udp(client)
+            elif kind == 'listen':
+                self.accept_chat(client)
+            else:
+                self.read_chat(key.fileobj, client)
+
+    def read_server(self, client):
+        try:
+            received = client.decoder.recv_from(client.socket)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            received = 0
+        if not received:
+            self.errors += 1
+            self.selector.unregister(client.socket)
+            client.registered = False
+            return
+
+        now = time.perf_counter()
+        for message_type, headers, body in client.decoder.frames():
+            self.frames_received += 1
+            if message_type == 'BROADCAST_MSG':
+                message = json.loads(body).get('message', '')
+                if message.startswith('load:'):
+                    self.broadcast_delivered += 1
+                    self.latencies['broadcast'].append(now - float(message[5:]))
+            elif message_type == 'USER_LIST':
+                if client.skip_lists:
+                    client.skip_lists -= 1
+                elif client.pending_users:
+                    self.latencies['get_users'].append(now - client.pending_users.popleft())
+            elif message_type == 'REGISTER_OK':
+                client.protocol_version = headers.get('Protocol-Version', PROTOCOL_V1)
+                client.registered = True
+                client.busy = False
+                client.skip_lists += 1
+                self.latencies['register'].append(now - client.register_started)
+            elif message_type == 'UNREGISTER_OK':
+                client.registered = False
+                client.register_started = now
+                self.send(client, client.register_frame())
+            elif message_type == 'ERROR':
+                if json.loads(body).get('code') == 'rate_limited':
+                    self.rejected += 1
+                else:
+                    self.errors += 1
+                if headers.get('Request-ID') == 'users' and client.pending_users:
+                    client.pending_users.popleft()
+                if client.busy and not client.registered:
+                    client.busy = False
+
+    def read_udp(self, client):
+        try:
+            data, address = client.udp_socket.recvfrom(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        header_text, _, body = data.decode('utf-8').partition('\r\n\r\n')
+        message_type, _, headers = parse_header_block(header_text)
+        session = self.chats.get(headers.get('Request-ID'))
+        if session is None:
+            return
+
+        if message_type == 'CHAT_REQUEST':
+            responder = session.responder
+            response = responder.frame('CHAT_RESPONSE', {'accepted': True, 'tcp_port': responder.listener.getsockname()[1]},
+                                       {'From': responder.nickname, 'To': session.initiator.nickname,
+                                        'Request-ID': session.request_id}, PROTOCOL_V1)
+            responder.udp_socket.sendto(response, address)
+            chat_socket = socket.create_connection(('127.0.0.1', json.loads(body)['tcp_port']))
+            chat_socket.sendall(responder.frame('CHAT_HELLO', {'nickname': responder.nickname},
+                                                {'From': responder.nickname, 'Request-ID': session.request_id},
+                                                PROTOCOL_V1))
+            chat_socket.setblocking(False)
+            session.responder_socket = chat_socket
+            self.selector.register(chat_socket, selectors.EVENT_READ, ('chat', FrameDecoder(self.recv_view)))
+        elif message_type == 'CHAT_RESPONSE':
+            self.latencies['chat_request'].append(time.perf_counter() - session.started)
+
+    def accept_chat(self, client):
+        try:
+            chat_socket, _ = client.listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        chat_socket.setblocking(False)
+        self.selector.register(chat_socket, selectors.EVENT_READ, ('chat', FrameDecoder(self.recv_view)))
+
+    def read_chat(self, chat_socket, decoder):
+        try:
+            received = decoder.recv_from(chat_socket)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            received = 0
+        if not received:
+            self.selector.unregister(chat_socket)
+            chat_socket.close()
+            return
+
+        now = time.perf_counter()
+        for message_type, headers, body in decoder.frames():
+            if message_type == 'CHAT_HELLO':
+                session = self.chats.get(headers.get('Request-ID'))
+                if session is None:
+                    continue
+                self.latencies['chat_connect'].append(now - session.started)
+                session.initiator_socket = chat_socket
+                for _ in range(session.messages):
+                    chat_socket.sendall(session.initiator.frame(
+                        'CHAT_MSG', {'message': repr(time.perf_counter())},
+                        {'From': session.initiator.nickname, 'Request-ID': session.request_id}, PROTOCOL_V1))
+            elif message_type == 'CHAT_MSG':
+                self.latencies['chat_msg'].append(now - float(json.loads(body)['message']))
+                session = self.chats.get(headers.get('Request-ID'))
+                if session is None:
+                    continue
+                session.received += 1
+                if session.received == session.messages:
+                    self.finish_chat(session)
+
+    def finish_chat(self, session):
+        self.chats.pop(session.request_id, None)
+        session.initiator.chat = session.responder.chat = None
+        if session.responder_socket is not None:
+            session.responder_socket.sendall(session.responder.frame('CHAT_CLOSE', None, None, PROTOCOL_V1))
+            self.selector.unregister(session.responder_socket)
+            session.responder_socket.close()
+
+    def close(self):
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in LoadGenerator.OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unbekannte Aktion: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def bench_load(args):
+    port = free_port()
+    extra_args = ['--rate-limit', args.rate_limit]
+    if args.workers > 1:
+        extra_args += ['--workers', str(args.workers)]
+    server = start_server(args.mode, port, extra_args)
+    generator = LoadGenerator(port, args.clients, min(args.chat_peers, args.clients), args.protocol,
+                              args.chat_messages)
+    result = {
+        'config': {
+            'mode': args.mode,
+            'workers': args.workers,
+            'clients': args.clients,
+            'protocol': args.protocol,
+            'duration': args.duration,
+            'rate': args.rate,
+            'mix': args.mix,
+            'rate_limit': args.rate_limit
+        }
+    }
+
+    try:
+        time.sleep(0.5)
+        idle = cluster_stats(server.pid)
+        started = time.perf_counter()
+        registered = generator.connect_all(args.timeout)
+        result['setup'] = {'registered': registered, 'seconds': round(time.perf_counter() - started, 3)}
+
+        before = cluster_stats(server.pid)
+        elapsed = generator.run(args.duration, args.rate, args.mix)
+        generator.settle(args.settle)
+        after = cluster_stats(server.pid)
+
+        operations = sum(generator.sent.values())
+        cpu_seconds = after['cpu_seconds'] - before['cpu_seconds']
+        result['operations'] = dict(generator.sent)
+        result['throughput'] = {
+            'operations_per_second': round(operations / elapsed, 1),
+            'frames_received_per_second': round(generator.frames_received / elapsed, 1),
+            'broadcast_deliveries_per_second': round(generator.broadcast_delivered / elapsed, 1)
+        }
+        result['broadcast'] = {'expected': generator.broadcast_expected, 'delivered': generator.broadcast_delivered}
+        result['latency_ms'] = {name: percentiles(samples) for name, samples in generator.latencies.items()}
+        result['server'] = {
+            'processes': after['processes'],
+            'threads': after['threads'],
+            'rss_kib_idle': idle['rss_kib'],
+            'rss_kib': after['rss_kib'],
+            'cpu_seconds': round(cpu_seconds, 3),
+            'cpu_percent': round(100 * cpu_seconds / elapsed, 1)
+        }
+        result['errors'] = generator.errors
+        result['rejected'] = generator.rejected
+    finally:
+        generator.close()
+        server.terminate()
+        server.wait()
+
+    return result
+
+
+def cmd_load(args):
+    result = bench_load(args)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(result, output, indent=2)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print(f"{result['setup']['registered']}/{args.clients} Clients registriert in {result['setup']['seconds']}s")
+    if 'throughput' not in result:
+        return
+    throughput = result['throughput']
+    print(f"{throughput['operations_per_second']} Aktionen/s, {throughput['frames_received_per_second']} Frames/s "
+          f"empfangen, Broadcasts {result['broadcast']['delivered']}/{result['broadcast']['expected']} zugestellt")
+    for name, stats in result['latency_ms'].items():
+        if stats['count']:
+            print(f"  {name:13} n={stats['count']:<7} p50 {stats['p50']} ms  p99 {stats['p99']} ms  "
+                  f"p999 {stats['p999']} ms  max {stats['max']} ms")
+    server_stats = result['server']
+    print(f"Server: RSS {server_stats['rss_kib']} KiB, CPU {server_stats['cpu_percent']}%, "
+          f"{server_stats['threads']} Threads in {server_stats['processes']} Prozess(en), Fehler {result['errors']}, "
+          f"abgewiesen {result['rejected']}")
+
+
+def legacy_read_frame(sock):
+    """Der frühere Leser: Header byteweise per recv(1)"""
+    header_lines = []
+    current_line = b''
+    while True:
+        char = sock.recv(1)
+        if not char:
+            return None, None, None
+        if char == b'\n':
+            line = current_line.decode('utf-8').rstrip('\r')
+            if not line:
+                break
+            header_lines.append(line)
+            current_line = b''
+        else:
+            current_line += char
+
+    headers = {}
+    for line in header_lines[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip()] = value.strip()
+
+    body_data = b''
+    content_length = int(headers.get('Content-Length', 0))
+    while len(body_data) < content_length:
+        chunk = sock.recv(content_length - len(body_data))
+        if not chunk:
+            return None, None, None
+        body_data += chunk
+    return header_lines[0].split()[0], headers, body_data.decode('utf-8')
+
+
+def bench_parse(reader_name, messages, payload):
+    frame = encode_frame('BROADCAST_MSG', {'sender': 'bench', 'message': payload, 'timestamp': time.time()})
+    reader_sock, writer_sock = socket.socketpair()
+    writer = threading.Thread(target=lambda: writer_sock.sendall(frame * messages), daemon=True)
+
+    if reader_name == 'recv1':
+        read = lambda: legacy_read_frame(reader_sock)
+    else:
+        decoder = FrameDecoder()
+        read = lambda: read_frame(reader_sock, decoder)
+
+    started = time.perf_counter()
+    writer.start()
+    for _ in range(messages):
+        message_type, _, _ = read()
+        if message_type != 'BROADCAST_MSG':
+            raise RuntimeError(f"Unerwartete Nachricht: {message_type}")
+    elapsed = time.perf_counter() - started
+
+    writer.join()
+    reader_sock.close()
+    writer_sock.close()
+    return {
+        'reader': reader_name,
+        'messages': messages,
+        'frame_bytes': len(frame),
+        'seconds': round(elapsed, 4),
+        'messages_per_second': round(messages / elapsed)
+    }
+
+
+def cmd_parse(args):
+    payload = 'x' * args.payload
+    results = [bench_parse(reader, args.messages, payload) for reader in ('recv1', 'decoder')]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print(f"[{result['reader']}] {result['messages_per_second']} Nachrichten/s pro Verbindung "
+              f"({result['frame_bytes']} Bytes/Nachricht)")
+
+
+def bench_framing(protocol_version, messages, payload):
+    """Bytes pro Nachricht sowie Kodier- und Parse-Zeit für eine Protokollversion"""
+    json_data = {'sender': 'bench', 'message': payload, 'timestamp': time.time()}
+    headers = {'Host': '127.0.0.1'} if protocol_version == PROTOCOL_V1 else None
+
+    started = time.perf_counter()
+    for _ in range(messages):
+        frame = encode_protocol_frame('BROADCAST_MSG', protocol_version, headers,
+                                      encode_body(json_data, protocol_version))
+    encode_seconds = time.perf_counter() - started
+
+    data = frame * messages
+    decoder = FrameDecoder()
+    started = time.perf_counter()
+    decoder.feed(data)
+    parsed = 0
+    for message_type, _, body in decoder.frames():
+        json.loads(body)
+        parsed += 1
+    parse_seconds = time.perf_counter() - started
+    if parsed != messages:
+        raise RuntimeError(f"{parsed} von {messages} Nachrichten geparst")
+
+    return {
+        'protocol_version': protocol_version,
+        'messages': messages,
+        'frame_bytes': len(frame),
+        'encode_seconds': round(encode_seconds, 4),
+        'parse_seconds': round(parse_seconds, 4),
+        'parsed_per_second': round(messages / parse_seconds)
+    }
+
+
+def cmd_framing(args):
+    payload = 'x' * args.payload
+    results = [bench_framing(version, args.messages, payload) for version in (PROTOCOL_V1, PROTOCOL_V2)]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print(f"[{result['protocol_version']}] {result['frame_bytes']} Bytes/Nachricht, "
+              f"kodieren {result['encode_seconds']}s, parsen {result['parse_seconds']}s "
+              f"({result['parsed_per_second']} Nachrichten/s)")
+
+
+class LossyDatagramSocket:
+    """UDP-Socket bzw. -Transport, der ausgehende Datagramme mit Wahrscheinlichkeit loss verwirft"""
+
+    def __init__(self, sock, loss, rng):
+        self.sock = sock
+        self.loss = loss
+        self.rng = rng
+        self.dropped = 0
+
+    def sendto(self, data, address):
+        if self.rng.random() < self.loss:
+            self.dropped += 1
+            return len(data)
+        return self.sock.sendto(data, address)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+async def async_wait_until(predicate, timeout, interval=0.01):
+    """wait_until für Code in der Event-Loop"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        await asyncio.sleep(interval)
+    return predicate()
+
+
+async def handshake_engine(nickname, loss, rng):
+    """ChatEngine ohne Server: nur UDP-Endpunkt und TCP-Listener"""
+    engine = ChatEngine(nickname)
+    engine.my_ip = '127.0.0.1'
+    await engine.open_endpoints()
+    engine.udp_transport = LossyDatagramSocket(engine.udp_transport, loss, rng)
+    return engine
+
+
+async def run_handshakes(loss, runs, seed):
+    rng = random.Random(seed)
+    initiator = await handshake_engine('initiator', loss, rng)
+    responder = await handshake_engine('responder', loss, rng)
+    for engine, peer in ((initiator, responder), (responder, initiator)):
+        engine.peer_list[peer.nickname] = {'ip': '127.0.0.1', 'udp_port': peer.udp_port}
+
+    timeout = initiator.handshakes.overall_timeout + 1
+    reopen_latencies = []
+    for _ in range(runs):
+        initiator.start_chat('responder')
+        await async_wait_until(lambda: 'responder' in initiator.active_chats
+                               or not initiator.handshakes.pending_for('responder'), timeout)
+        if 'responder' not in initiator.active_chats:
+            continue
+        initiator.close_chat('responder')
+        await async_wait_until(lambda: 'initiator' not in responder.active_chats, 5.0)
+
+        # Zweiter Chat über die gepoolte Verbindung: CHAT_OPEN statt UDP-Handshake
+        started = time.perf_counter()
+        initiator.start_chat('responder')
+        if await async_wait_until(lambda: 'initiator' in responder.active_chats, 5.0, interval=0):
+            reopen_latencies.append(time.perf_counter() - started)
+        initiator.close_chat('responder')
+        await async_wait_until(lambda: 'initiator' not in responder.active_chats, 5.0)
+
+        # Verbindung abbauen, damit der nächste Durchlauf wieder den vollen Handshake misst
+        link = initiator.peer_links.get('responder')
+        if link is not None:
+            initiator.close_peer_link(link)
+        await async_wait_until(lambda: not initiator.peer_links and not responder.peer_links, 5.0)
+
+    dropped = initiator.udp_transport.dropped + responder.udp_transport.dropped
+    await initiator.stop()
+    await responder.stop()
+    return initiator.handshakes, dropped, reopen_latencies
+
+
+def bench_handshake(loss, runs, seed):
+    """Dauer des Chat-Aufbaus (CHAT_REQUEST bis CHAT_HELLO) bei verlustbehaftetem UDP"""
+    handshakes, dropped, reopen_latencies = asyncio.run(run_handshakes(loss, runs, seed))
+    stats = handshakes.stats()
+    return {
+        'loss': loss,
+        'runs': runs,
+        'completed': stats['completed'],
+        'failed': stats['failed'],
+        'retransmits': stats['retransmits'],
+        'dropped_datagrams': dropped,
+        'setup_ms': percentiles(list(handshakes.latencies)),
+        'reopen_ms': percentiles(reopen_latencies)
+    }
+
+
+def cmd_handshake(args):
+    results = [bench_handshake(loss, args.runs, args.seed) for loss in args.loss]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        setup = result['setup_ms']
+        reopen = result['reopen_ms']
+        print(f"[{result['loss']:.0%} Verlust] {result['completed']}/{result['runs']} Chats aufgebaut, "
+              f"{result['failed']} gescheitert, {result['retransmits']} Wiederholungen, "
+              f"Aufbau p50 {setup.get('p50')} ms, p99 {setup.get('p99')} ms, max {setup.get('max')} ms; "
+              f"erneut über gepoolte Verbindung p50 {reopen.get('p50')} ms, p99 {reopen.get('p99')} ms")
+
+
+async def run_batching(port, batched, messages, receivers, timeout):
+    prefix = 'batch' if batched else 'single'
+    sender = ChatEngine(f'{prefix}-sender')
+    await sender.start('127.0.0.1', port)
+    readers = [ChatEngine(f'{prefix}-leser{i}') for i in range(receivers)]
+    for reader in readers:
+        await reader.start('127.0.0.1', port)
+    received = [0]
+
+    def count(name, data):
+        if name == 'broadcast':
+            received[0] += 1
+
+    for reader in readers:
+        reader.on_event = count
+    before = await sender.request_stats()
+
+    started = time.perf_counter()
+    acks = []
+    for i in range(messages):
+        if batched:
+            acks.append(sender.broadcast_batched(f'nachricht {i}'))
+        else:
+            acks.append(sender.broadcast(f'nachricht {i}'))
+        if i % 500 == 0:
+            await sender.drain()
+    if batched:
+        sender.flush_batch()
+    await asyncio.gather(*acks)
+    delivered = await async_wait_until(lambda: received[0] >= messages * receivers, timeout, interval=0.001)
+    seconds = time.perf_counter() - started
+
+    after = await sender.request_stats()
+    for engine in (sender, *readers):
+        await engine.stop()
+
+    def delta(direction, *message_types):
+        return sum(after[direction].get(t, 0) - before[direction].get(t, 0) for t in message_types)
+
+    return {
+        'batched': batched,
+        'messages': messages,
+        'receivers': receivers,
+        'delivered': delivered,
+        'seconds': round(seconds, 3),
+        'messages_per_second': round(messages / seconds),
+        'frames_in_per_message': round(delta('messages_in', 'BROADCAST', 'BATCH') / messages, 4),
+        'acks_per_message': round(delta('messages_out', 'BROADCAST_OK', 'BATCH_OK') / messages, 4),
+        'frames_out_per_delivery': round(delta('messages_out', 'BROADCAST_MSG', 'BROADCAST_BATCH')
+                                         / (messages * receivers), 4)
+    }
+
+
+def bench_batching(mode, messages, receivers, timeout):
+    """Broadcast-Durchsatz eines Bots: einzelne BROADCAST gegen gesammelte BATCH"""
+    port = free_port()
+    server = start_server(mode, port, ('--log-level', 'WARNING', '--rate-limit', 'none'))
+    try:
+        return [asyncio.run(run_batching(port, batched, messages, receivers, timeout)) for batched in (False, True)]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def cmd_batching(args):
+    results = bench_batching(args.mode, args.messages, args.receivers, args.timeout)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        label = 'BATCH' if result['batched'] else 'BROADCAST'
+        print(f"[{label}] {result['messages']} Nachrichten an {result['receivers']} Leser in {result['seconds']}s "
+              f"({result['messages_per_second']} /s{'' if result['delivered'] else ', unvollständig'}), "
+              f"Frames zum Server/Nachricht {result['frames_in_per_message']}, "
+              f"Bestätigungen/Nachricht {result['acks_per_message']}, "
+              f"Frames pro Zustellung {result['frames_out_per_delivery']}")
+
+
+def bench_memory(record_type, users):
+    """Bytes pro angemeldetem Benutzer im ClientRegistry, mit record_type als Eintrag (tracemalloc)"""
+    # Platzhalter statt Sockets als Schlüssel; sie gehören zur Verbindung und werden nicht mitgezählt
+    keys = [RemoteClient(f"user{index}") for index in range(users)]
+    gc.collect()
+    tracemalloc.start()
+    try:
+        registry = ClientRegistry()
+        for index, key in enumerate(keys):
+            record = record_type(key.nickname, f"10.0.{index // 256 % 256}.{index % 256}", 40000 + index % 20000)
+            entry = {'nickname': record.nickname, 'ip': record.ip, 'udp_port': record.udp_port}
+            registry.register(key, record, json.dumps(entry).encode('utf-8'))
+        registry_bytes = tracemalloc.get_traced_memory()[0]
+        # Nur die Einträge selbst, Strings und Zahlen teilen sie mit dem Registry
+        items = registry.snapshot()
+        before = tracemalloc.get_traced_memory()[0]
+        records = [record_type(record.nickname, record.ip, record.udp_port) for _, record in items]
+        record_bytes = tracemalloc.get_traced_memory()[0] - before - sys.getsizeof(records)
+    finally:
+        tracemalloc.stop()
+    return {
+        'record': record_type.__name__,
+        'users': users,
+        'bytes_per_user': round(registry_bytes / users),
+        'record_bytes': round(record_bytes / users),
+        'total_mib': round(registry_bytes / 1024 / 1024, 1)
+    }
+
+
+def cmd_memory(args):
+    results = [bench_memory(record_type, args.users) for record_type in (ClientInfo, ClientSession)]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print(f"[{result['record']}] {result['users']} Benutzer: {result['bytes_per_user']} Bytes/Benutzer "
+              f"({result['total_mib']} MiB), davon Eintrag {result['record_bytes']} Bytes")
+
+
+def cmd_connections(args):
+    results = [bench_connections(mode, args.clients, args.timeout) for mode in args.modes]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print(f"[{result['mode']}] {result['registered']}/{result['clients']} Clients registriert "
+              f"in {result['register_seconds']}s, RSS {result.get('rss_kib')} KiB "
+              f"({result.get('kib_per_client')} KiB/Client), Threads {result.get('threads')}, "
+              f"Broadcast-Fan-out {result.get('broadcast_fanout_seconds')}s")
+
+
+def main():
+    raise_fd_limit()
+    parser = argparse.ArgumentParser(description="Benchmarks für den Gruppenchat")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    connections = sub.add_parser('connections', help="Threaded- und Selector-Modus bei vielen Verbindungen")
+    connections.add_argument('--clients', type=int, default=2000)
+    connections.add_argument('--modes', nargs='+', default=['threaded', 'selector'])
+    connections.add_argument('--timeout', type=float, default=120.0)
+    connections.add_argument('--json', action='store_true')
+    connections.set_defaults(func=cmd_connections)
+
+    parse = sub.add_parser('parse', help="Nachrichten/s pro Verbindung: recv(1)-Leser gegen FrameDecoder")
+    parse.add_argument('--messages', type=int, default=20000)
+    parse.add_argument('--payload', type=int, default=64, help="Länge der Chat-Nachricht in Zeichen")
+    parse.add_argument('--json', action='store_true')
+    parse.set_defaults(func=cmd_parse)
+
+    framing = sub.add_parser('framing', help="Bytes und Parse-Zeit: Text-Protokoll 1.0 gegen binäres 2.0")
+    framing.add_argument('--messages', type=int, default=100000)
+    framing.add_argument('--payload', type=int, default=64, help="Länge der Chat-Nachricht in Zeichen")
+    framing.add_argument('--json', action='store_true')
+    framing.set_defaults(func=cmd_framing)
+
+    sharding = sub.add_parser('sharding', help="Broadcast-Durchsatz mit mehreren Worker-Prozessen")
+    sharding.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    sharding.add_argument('--clients', type=int, default=200)
+    sharding.add_argument('--senders', type=int, default=10)
+    sharding.add_argument('--broadcasts', type=int, default=100, help="Broadcasts pro Sender")
+    sharding.add_argument('--mode', choices=['threaded', 'selector'], default='selector')
+    sharding.add_argument('--timeout', type=float, default=120.0)
+    sharding.add_argument('--json', action='store_true')
+    sharding.set_defaults(func=cmd_sharding)
+
+    load = sub.add_parser('load', help="Lastlauf mit synthetischen Clients: Durchsatz, Latenzen, RSS/CPU")
+    load.add_argument('--clients', type=int, default=1000)
+    load.add_argument('--duration', type=float, default=10.0, help="Dauer des Lastlaufs in Sekunden")
+    load.add_argument('--rate', type=float, default=500.0, help="Aktionen pro Sekunde über alle Clients")
+    load.add_argument('--mix', type=parse_mix, default=parse_mix('broadcast=70,get_users=20,churn=5,chat=5'),
+                      help="Gewichte der Aktionen, z.B. broadcast=70,get_users=20,churn=5,chat=5")
+    load.add_argument('--chat-peers', type=int, default=50, help="Clients mit UDP-/TCP-Sockets für P2P-Chats")
+    load.add_argument('--chat-messages', type=int, default=5, help="CHAT_MSG pro Chat")
+    load.add_argument('--protocol', choices=[PROTOCOL_V1, PROTOCOL_V2], default=PROTOCOL_V2)
+    load.add_argument('--mode', choices=['threaded', 'selector'], default='selector')
+    load.add_argument('--workers', type=int, default=1)
+    load.add_argument('--rate-limit', default='none',
+                      help="Rate Limits des Servers wie bei Server.py --rate-limit (Standard: keine)")
+    load.add_argument('--timeout', type=float, default=120.0, help="Zeitlimit für die Registrierung")
+    load.add_argument('--settle', type=float, default=5.0, help="Nachlaufzeit für ausstehende Antworten")
+    load.add_argument('--output', help="Ergebnis zusätzlich als JSON in diese Datei schreiben")
+    load.add_argument('--json', action='store_true')
+    load.set_defaults(func=cmd_load)
+
+    handshake = sub.add_parser('handshake', help="Chat-Aufbau über UDP mit künstlichem Paketverlust")
+    handshake.add_argument('--loss', type=float, nargs='+', default=[0.0, 0.1, 0.2],
+                           help="Verlustwahrscheinlichkeit pro Datagramm")
+    handshake.add_argument('--runs', type=int, default=200)
+    handshake.add_argument('--seed', type=int, default=1)
+    handshake.add_argument('--json', action='store_true')
+    handshake.set_defaults(func=cmd_handshake)
+
+    batching = sub.add_parser('batching', help="Broadcasts eines Bots einzeln gegen als BATCH gesammelt")
+    batching.add_argument('--messages', type=int, default=20000)
+    batching.add_argument('--receivers', type=int, default=5)
+    batching.add_argument('--mode', choices=['threaded', 'selector'], default='selector')
+    batching.add_argument('--timeout', type=float, default=60.0)
+    batching.add_argument('--json', action='store_true')
+    batching.set_defaults(func=cmd_batching)
+
+    memory = sub.add_parser('memory', help="Speicher pro angemeldetem Benutzer: ClientInfo gegen ClientSession")
+    memory.add_argument('--users', type=int, default=100000)
+    memory.add_argument('--json', action='store_true')
+    memory.set_defaults(func=cmd_memory)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,41 @@
-import socket
+import asyncio
 import threading
-import json
 import time
-import random
-from common import ClientInfo
+
+from engine import ChatEngine
 
 
 class GroupChatClient:
-    PROTOCOL_VERSION = "1.0"
+    """Text-Oberfläche über der ChatEngine.
+
+    Die Engine läuft mit ihrer asyncio-Schleife in einem Hintergrund-Thread;
+    Befehle aus der Eingabe werden per call_soon_threadsafe in die Schleife
+    gereicht, Ereignisse der Engine hier ausgegeben.
+    """
 
     def __init__(self):
-        self.info = ClientInfo()
+        self.engine = None
+        self.loop = None
+        self.running = False
 
     def start(self, server_host='localhost', server_port=8888):
         try:
-            self.info.nickname = input("Nickname eingeben: ").strip()
-            if not self.info.nickname:
+            nickname = input("Nickname eingeben: ").strip()
+            if not nickname:
                 print("Ungültiger Nickname")
                 return
 
-            self.setup_udp_socket()
-            self.setup_tcp_chat_socket()
-            self.connect_to_server(server_host, server_port)
-            self.register_with_server()
-
-            self.info.running = True
+            self.engine = ChatEngine(nickname, on_event=self.handle_event)
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, daemon=True).start()
 
-            threading.Thread(target=self.handle_server_messages, daemon=True).start()
-            threading.Thread(target=self.handle_udp_messages, daemon=True).start()
-            threading.Thread(target=self.tcp_chat_server, daemon=True).start()
+            asyncio.run_coroutine_threadsafe(self.engine.open_endpoints(), self.loop).result()
+            print(f"UDP Socket auf Port {self.engine.udp_port}")
+            print(f"TCP Chat Socket auf Port {self.engine.tcp_port}")
+            asyncio.run_coroutine_threadsafe(self.engine.connect(server_host, server_port), self.loop).result()
+            print(f"Mit Server verbunden: {server_host}:{server_port}")
 
+            self.running = True
             self.TUI()
 
         except Exception as e:
@@ -37,528 +43,118 @@ class GroupChatClient:
         finally:
             self.stop()
 
-    def setup_udp_socket(self):
-        self.info.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.info.udp_socket.bind(('', 0))
-        self.info.udp_port = self.info.udp_socket.getsockname()[1]
-        print(f"UDP Socket auf Port {self.info.udp_port}")
-
-    def setup_tcp_chat_socket(self):
-        self.info.tcp_chat_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.info.tcp_chat_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.info.tcp_chat_socket.bind(('', 0))
-        self.info.tcp_port = self.info.tcp_chat_socket.getsockname()[1]
-        self.info.tcp_chat_socket.listen(5)
-        print(f"TCP Chat Socket auf Port {self.info.tcp_port}")
-
-    def connect_to_server(self, host, port):
-        self.info.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.info.server_socket.connect((host, port))
-        self.info.my_ip = self.info.server_socket.getsockname()[0]
-        print(f"Mit Server verbunden: {host}:{port}")
-
-    def register_with_server(self):
-        register_data = {
-            'nickname': self.info.nickname,
-            'ip': self.info.my_ip,
-            'udp_port': self.info.udp_port
-        }
-        self.send_to_server('REGISTER', register_data)
-
-    def send_to_server(self, message_type, json_data=None, additional_headers=None):
-        try:
-            body = json.dumps(json_data) if json_data else ""
-            headers = [
-                f"{message_type} {self.PROTOCOL_VERSION}",
-                f"Host: {self.info.my_ip}",
-                f"Content-Length: {len(body.encode('utf-8'))}"
-            ]
-            if additional_headers:
-                for key, value in additional_headers.items():
-                    headers.append(f"{key}: {value}")
-            message = "\r\n".join(headers) + "\r\n\r\n" + body
-            self.info.server_socket.send(message.encode('utf-8'))
-            return True
-        except Exception as e:
-            print(f"Fehler beim Senden an Server: {e}")
-            return False
-
-    def receive_from_server(self):
-        try:
-            header_lines = []
-            current_line = b''
-
-            while True:
-                char = self.info.server_socket.recv(1)  # FEHLER: war self.server_socket
-                if not char:
-                    return None, None, None
-
-                if char == b'\n':  # Bytestring endet mit \n
-                    line = current_line.decode('utf-8').rstrip('\r')
-                    if not line:  # Leere Zeile = Ende der Header
-                        break
-                    header_lines.append(line)
-                    current_line = b''
-                else:
-                    current_line += char
-
-            if not header_lines:
-                return None, None, None
-
-            # Erste Zeile parsen: MESSAGE_TYPE PROTOCOL_VERSION
-            first_line = header_lines[0].split()
-            if len(first_line) != 2:
-                return None, None, None
-
-            message_type = first_line[0]
-            protocol_version = first_line[1]
-
-            # Header parsen
-            headers = {}
-            for line in header_lines[1:]:
-                if ':' in line:
-                    key, value = line.split(':', 1)
-                    headers[key.strip()] = value.strip()
-
-            # Body lesen falls Content-Length vorhanden
-            body = ""
-            if 'Content-Length' in headers:
-                content_length = int(headers['Content-Length'])
-                if content_length > 0:
-                    body_data = b''
-                    while len(body_data) < content_length:
-                        chunk = self.info.server_socket.recv(
-                            content_length - len(body_data))  # FEHLER: war self.server_socket
-                        if not chunk:
-                            return None, None, None
-                        body_data += chunk
-                    body = body_data.decode('utf-8')
-
-            return message_type, headers, body
-
-        except Exception:
-            return None, None, None
-
-    def send_udp_header_message(self, message_type, json_data, target_ip, target_port, additional_headers=None):
-        try:
-            body = json.dumps(json_data) if json_data else ""
-
-            headers = []
-            headers.append(f"{message_type} {self.PROTOCOL_VERSION} ")
-            headers.append(f"From: {self.info.nickname}")  # FEHLER: war self.info.nickname
-            headers.append(f"Host: {self.info.my_ip}")  # FEHLER: war self.info.my_ip
-            headers.append(f"Content-Length: {len(body.encode('utf-8'))}")
-
-            if additional_headers:
-                for key, value in additional_headers.items():
-                    headers.append(f"{key}: {value}")
-
-            message = "\r\n".join(headers) + "\r\n\r\n" + body
-
-            self.info.udp_socket.sendto(message.encode('utf-8'),
-                                        (target_ip, target_port))  # FEHLER: war self.info.udp_socket
-            return True
-        except Exception as e:
-            print(f"Fehler beim UDP-Senden: {e}")
-            return False
-
-    def parse_udp_header_message(self, data):
-        try:
-            message_str = data.decode('utf-8')
-
-            if '\r\n\r\n' not in message_str:
-                return None, None, None
-
-            header_part, body = message_str.split('\r\n\r\n', 1)
-            header_lines = header_part.split('\r\n')
-
-            if not header_lines:
-                return None, None, None
-
-            first_line = header_lines[0].split()
-            if len(first_line) != 2:
-                return None, None, None
-
-            message_type = first_line[0]
-            protocol_version = first_line[1]
-
-            headers = {}
-            for line in header_lines[1:]:
-                if ':' in line:
-                    key, value = line.split(':', 1)
-                    headers[key.strip()] = value.strip()
-
-            return message_type, headers, body
-
-        except Exception as e:
-            print(f"Fehler beim UDP-Parsen: {e}")
-            return None, None, None
-
-    def send_tcp_header_message(self, socket_obj, message_type, json_data=None, additional_headers=None):
-        try:
-            body = json.dumps(json_data) if json_data else ""
-
-            headers = []
-            headers.append(f"{message_type} {self.PROTOCOL_VERSION} ")
-            headers.append(f"From: {self.info.nickname}")  # FEHLER: war self.info.nickname
-            headers.append(f"Host: {self.info.my_ip}")  # FEHLER: war self.info.my_ip
-            headers.append(f"Content-Length: {len(body.encode('utf-8'))}")
-
-            if additional_headers:
-                for key, value in additional_headers.items():
-                    headers.append(f"{key}: {value}")
-
-            message = "\r\n".join(headers) + "\r\n\r\n" + body
-
-            socket_obj.send(message.encode('utf-8'))
-            return True
-        except Exception as e:
-            print(f"Fehler beim TCP-Senden: {e}")
-            return False
-
-    def receive_tcp_header_message(self, socket_obj):
-        try:
-            header_lines = []
-            current_line = b''
-
-            while True:
-                char = socket_obj.recv(1)
-                if not char:
-                    return None, None, None
-
-                if char == b'\n':
-                    line = current_line.decode('utf-8').rstrip('\r')
-                    if not line:  # Leere Zeile = Ende der Header
-                        break
-                    header_lines.append(line)
-                    current_line = b''
-                else:
-                    current_line += char
-
-            if not header_lines:
-                return None, None, None
-
-            first_line = header_lines[0].split()
-            if len(first_line) != 2:
-                return None, None, None
-
-            message_type = first_line[0]
-            protocol_version = first_line[1]
-
-            headers = {}
-            for line in header_lines[1:]:
-                if ':' in line:
-                    key, value = line.split(':', 1)
-                    headers[key.strip()] = value.strip()
-
-            body = ""
-            if 'Content-Length' in headers:
-                content_length = int(headers['Content-Length'])
-                if content_length > 0:
-                    body_data = b''
-                    while len(body_data) < content_length:
-                        chunk = socket_obj.recv(content_length - len(body_data))
-                        if not chunk:
-                            return None, None, None
-                        body_data += chunk
-                    body = body_data.decode('utf-8')
-
-            return message_type, headers, body
-
-        except Exception:
-            return None, None, None
-
-    def handle_server_messages(self):
-        while self.info.running:  # FEHLER: war self.info.running
-            try:
-                message_type, headers, body = (self.receive_from_server())
-                if not message_type:
-                    break
-
-                json_data = json.loads(body) if body else {}
-
-                if message_type == 'REGISTER_OK':
-                    print(f"✓ {json_data.get('message')}")
-                elif message_type == 'USER_LIST':
-                    self.update_peer_list(json_data.get('users', []))
-                elif message_type == 'USER_JOINED':
-                    self.handle_user_joined(json_data)
-                elif message_type == 'USER_LEFT':
-                    self.handle_user_left(json_data)
-                elif message_type == 'BROADCAST_MSG':
-                    self.handle_broadcast_message(json_data)
-                elif message_type == 'ERROR':
-                    print(f"Server-Fehler: {json_data.get('message')}")
-                elif message_type == 'BROADCAST_OK':
-                    print("Broadcast gesendet")
-
-            except Exception as e:
-                if self.info.running:  # FEHLER: war self.info.running
-                    print(f"Fehler bei Server-Kommunikation: {e}")
-                break
-
-    def update_peer_list(self, users):
-        self.info.peer_list = {}
-        for user in users:
-            self.info.peer_list[user['nickname']] = {
-                'ip': user['ip'],
-                'udp_port': user['udp_port']
-            }
-
-    def handle_user_joined(self, json_data):
-        nickname = json_data.get('nickname')
-        self.info.peer_list[nickname] = {
-            'ip': json_data.get('ip'),
-            'udp_port': json_data.get('udp_port')
-        }
-        print(f"\n{nickname} ist beigetreten")
-
-    def handle_user_left(self, json_data):
-        nickname = json_data.get('nickname')
-        if nickname in self.info.peer_list:
-            del self.info.peer_list[nickname]
-        if nickname in self.info.active_chats:
-            self.info.active_chats[nickname].close()
-            del self.info.active_chats[nickname]
-        print(f"\n{nickname} hat den Chat verlassen")
-
-    def handle_broadcast_message(self, json_data):
-        sender = json_data.get('sender')
-        msg = json_data.get('message')
-        print(f"[BROADCAST] {sender}: {msg}")
-
-    def handle_udp_messages(self):
-        while self.info.running:
-            try:
-                data, addr = self.info.udp_socket.recvfrom(4096)  # Größerer Buffer für Header
-                message_type, headers, body = self.parse_udp_header_message(data)
-
-                if not message_type:
-                    continue
-
-                json_data = json.loads(body) if body else {}
-
-                if message_type == 'CHAT_REQUEST':
-                    self.handle_chat_request(headers, json_data, addr)
-                elif message_type == 'CHAT_RESPONSE':
-                    self.handle_chat_response(headers, json_data, addr)
-
-            except Exception as e:
-                if self.info.running:
-                    print(f"UDP-Fehler: {e}")
-
-    def handle_chat_request(self, headers, json_data, addr):
-        initiator = headers.get('From')
-        tcp_port = json_data.get('tcp_port')
-
-        print(f"Chat-Anfrage von {initiator} erhalten")
-
-        # Antwort senden
-        response_data = {
-            'accepted': True,
-            'tcp_port': self.info.tcp_port
-        }
-
-        additional_headers = {
-            'To': initiator,
-            'Request-ID': headers.get('Request-ID', 'unknown')
-        }
-
-        self.send_udp_header_message(
-            'CHAT_RESPONSE',
-            response_data,
-            addr[0],
-            addr[1],
-            additional_headers
-        )
-
-        # TCP-Verbindung zum Initiator aufbauen
-        try:
-            chat_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            chat_socket.connect((addr[0], tcp_port))
-
-            hello_data = {
-                'nickname': self.info.nickname
-            }
-
-            self.send_tcp_header_message(chat_socket, 'CHAT_HELLO', hello_data)
-
-            self.info.active_chats[initiator] = chat_socket
-
-            chat_thread = threading.Thread(
-                target=self.handle_peer_chat,
-                args=(chat_socket, initiator)
-            )
-            chat_thread.daemon = True
-            chat_thread.start()
-
-            print(f"Chat mit {initiator} erfolgreich gestartet")
-
-        except Exception as e:
-            print(f"Fehler beim Verbinden mit {initiator}: {e}")
-
-    def handle_chat_response(self, headers, json_data, addr):
-        responder = headers.get('From')
-        accepted = json_data.get('accepted', False)
-
-        if accepted:
-            print(f"Chat-Anfrage von {responder} akzeptiert")
-        else:
-            print(f"Chat-Anfrage von {responder} abgelehnt")
-
-    def tcp_chat_server(self):
-        while self.info.running:
-            try:
-                client_socket, client_addr = self.info.tcp_chat_socket.accept()
-
-                # Warten auf Identifikation (Header-basiert)
-                try:
-                    message_type, headers, body = self.receive_tcp_header_message(client_socket)
-
-                    if message_type == 'CHAT_HELLO':
-                        json_data = json.loads(body) if body else {}
-                        peer_nickname = json_data.get('nickname')
-
-                        if not peer_nickname:
-                            peer_nickname = headers.get('From', 'Unknown')
-
-                        self.info.active_chats[peer_nickname] = client_socket
-
-                        chat_thread = threading.Thread(
-                            target=self.handle_peer_chat,
-                            args=(client_socket, peer_nickname)
-                        )
-                        chat_thread.daemon = True
-                        chat_thread.start()
-
-                        print(f"Chat mit {peer_nickname} erfolgreich gestartet")
-
-                except Exception as e:
-                    print(f"Fehler bei Chat-Identifikation: {e}")
-                    client_socket.close()
-
-            except Exception as e:
-                if self.info.running:
-                    print(f"TCP Chat Server Fehler: {e}")
-
-    def handle_peer_chat(self, chat_socket, peer_nickname):
-        try:
-            while self.info.running:
-                message_type, headers, body = self.receive_tcp_header_message(chat_socket)
-                if not message_type:
-                    break
-
-                if message_type == 'CHAT_MSG':
-                    json_data = json.loads(body) if body else {}
-                    msg_text = json_data.get('message')
-                    timestamp = headers.get('Timestamp', '')
-
-                    if timestamp:
-                        print(f"[{peer_nickname}] ({timestamp}): {msg_text}")
-                    else:
-                        print(f"[{peer_nickname}]: {msg_text}")
-                elif message_type == 'CHAT_CLOSE':
-                    print(f"Chat mit {peer_nickname} wurde von der Gegenseite beendet")
-                    break
-
-        except Exception as e:
-            print(f"Chat-Fehler mit {peer_nickname}: {e}")
-        finally:
-            if peer_nickname in self.info.active_chats:
-                del self.info.active_chats[peer_nickname]
-            chat_socket.close()
-            print(f"Chat mit {peer_nickname} beendet")
-
-    def start_chat_with_peer(self, peer_nickname):
-        if peer_nickname not in self.info.peer_list:
-            print(f"Benutzer {peer_nickname} nicht gefunden")
-            return
-
-        if peer_nickname in self.info.active_chats:
-            print(f"Chat mit {peer_nickname} bereits aktiv")
-            return
-
-        peer_info = self.info.peer_list[peer_nickname]
-
-        chat_request_data = {
-            'tcp_port': self.info.tcp_port
-        }
-
-        request_id = f"{self.info.nickname}_{int(time.time())}_{random.randint(1000, 9999)}"
-
-        additional_headers = {
-            'To': peer_nickname,
-            'Request-ID': request_id
-        }
-
-        try:
-            self.send_udp_header_message(
-                'CHAT_REQUEST',
-                chat_request_data,
-                peer_info['ip'],
-                peer_info['udp_port'],
-                additional_headers
-            )
-            print(f"Chat-Anfrage an {peer_nickname} gesendet - warte auf Verbindung...")
-        except Exception as e:
-            print(f"Fehler beim Senden der Chat-Anfrage: {e}")
-
-    def send_chat_message(self, peer_nickname, message):
-        if peer_nickname not in self.info.active_chats:
-            print(f"Kein aktiver Chat mit {peer_nickname}")
-            return
-
-        chat_msg_data = {
-            'message': message
-        }
-
-        # Timestamp hinzufügen
-        additional_headers = {
-            'To': peer_nickname,
-            'Timestamp': time.strftime('%H:%M:%S')
-        }
-
-        try:
-            self.send_tcp_header_message(
-                self.info.active_chats[peer_nickname],
-                'CHAT_MSG',
-                chat_msg_data,
-                additional_headers
-            )
-        except Exception as e:
-            print(f"Fehler beim Senden an {peer_nickname}: {e}")
-
-    def close_chat_with_peer(self, peer_nickname):
-        if peer_nickname not in self.info.active_chats:
-            print(f"Kein aktiver Chat mit {peer_nickname}")
+    def call(self, method, *args):
+        """Engine-Methode im Thread der Event-Loop ausführen"""
+        self.loop.call_soon_threadsafe(method, *args)
+
+    def query(self, method, *args):
+        """Engine-Methode im Thread der Event-Loop ausführen und ihr Ergebnis zurückgeben"""
+        async def run():
+            return method(*args)
+        return asyncio.run_coroutine_threadsafe(run(), self.loop).result(timeout=2)
+
+    def handle_event(self, name, data):
+        if name == 'registered':
+            print(f"✓ {data.get('message')}")
+        elif name == 'presence':
+            joined, left = data['joined'], data['left']
+            if len(joined) + len(left) > 5:
+                print(f"\n{len(joined)} Benutzer beigetreten, {len(left)} verlassen")
+                return
+            for user in joined:
+                print(f"\n{user['nickname']} ist beigetreten")
+            for nickname in left:
+                print(f"\n{nickname} hat den Chat verlassen")
+        elif name == 'broadcast':
+            print(f"[BROADCAST] {data.get('sender')}: {data.get('message')}")
+        elif name == 'broadcast_ok':
+            print("Broadcast gesendet")
+        elif name == 'server_error':
+            print(f"Server-Fehler: {data.get('message')}")
+        elif name == 'stats':
+            self.print_stats(data)
+        elif name == 'history':
+            self.print_history(data)
+        elif name == 'search':
+            self.print_search_result(data)
+        elif name == 'room_joined':
+            members = [user['nickname'] for user in data.get('members', [])]
+            print(f"Raum {data['room']} betreten, Mitglieder: {members}")
+        elif name == 'room_left':
+            print(f"Raum {data['room']} verlassen")
+        elif name == 'room_presence':
+            for user in data.get('joined', []):
+                print(f"\n{user['nickname']} hat {data['room']} betreten")
+            for nickname in data.get('left', []):
+                print(f"\n{nickname} hat {data['room']} verlassen")
+        elif name == 'room_message':
+            print(f"[{data.get('room')}] {data.get('sender')}: {data.get('message')}")
+        elif name == 'chat_request':
+            print(f"Chat-Anfrage von {data['nickname']} erhalten")
+        elif name == 'chat_requested':
+            print(f"Chat-Anfrage an {data['nickname']} gesendet - warte auf Verbindung...")
+        elif name == 'chat_response':
+            if data['accepted']:
+                print(f"Chat-Anfrage von {data['nickname']} akzeptiert")
+            else:
+                print(f"Chat-Anfrage von {data['nickname']} abgelehnt")
+        elif name == 'chat_timeout':
+            print(f"Chat-Anfrage an {data['nickname']} unbeantwortet (Zeitüberschreitung)")
+        elif name == 'chat_started':
+            if data['reused']:
+                print(f"Chat mit {data['nickname']} erfolgreich gestartet (bestehende Verbindung)")
+            elif data['latency'] is not None:
+                print(f"Chat mit {data['nickname']} erfolgreich gestartet ({data['latency'] * 1000:.0f} ms)")
+            else:
+                print(f"Chat mit {data['nickname']} erfolgreich gestartet")
+        elif name == 'chat_message':
+            if data['timestamp']:
+                print(f"[{data['nickname']}] ({data['timestamp']}): {data['message']}")
+            else:
+                print(f"[{data['nickname']}]: {data['message']}")
+        elif name == 'chat_closed':
+            if data['by_peer']:
+                print(f"Chat mit {data['nickname']} wurde von der Gegenseite beendet")
+            else:
+                print(f"Chat mit {data['nickname']} beendet")
+        elif name == 'error':
+            print(data['message'])
+        elif name == 'disconnected':
+            print("Verbindung zum Server getrennt")
+
+    def print_history(self, json_data):
+        messages = json_data.get('messages', [])
+        if not messages:
             return
-
-        try:
-            # CHAT_CLOSE Nachricht senden
-            additional_headers = {
-                'To': peer_nickname
-            }
-
-            self.send_tcp_header_message(
-                self.info.active_chats[peer_nickname],
-                'CHAT_CLOSE',
-                None,
-                additional_headers
-            )
-
-            self.info.active_chats[peer_nickname].close()
-            del self.info.active_chats[peer_nickname]
-
-            print(f"Chat mit {peer_nickname} beendet")
-
-        except Exception as e:
-            print(f"Fehler beim Beenden des Chats mit {peer_nickname}: {e}")
-
-    def broadcast_message(self, message):
-        broadcast_data = {
-            'message': message
-        }
-        self.send_to_server('BROADCAST', broadcast_data)
+        print(f"--- Verlauf: {len(messages)} Nachricht(en) ---")
+        for message in messages:
+            timestamp = time.strftime('%H:%M:%S', time.localtime(message.get('timestamp', 0)))
+            print(f"[{timestamp}] {message.get('sender')}: {message.get('message')}")
+        print("---")
+
+    def print_search_result(self, json_data):
+        hits = json_data.get('hits', [])
+        print(f"--- Suche \"{json_data.get('query')}\": {len(hits)} Treffer ---")
+        for hit in hits:
+            timestamp = time.strftime('%d.%m. %H:%M:%S', time.localtime(hit.get('timestamp', 0)))
+            print(f"[{timestamp}] {hit.get('sender')}: {hit.get('message')}")
+        print("---")
+
+    def print_stats(self, stats):
+        queues = stats.get('queues', {})
+        print(f"Server seit {stats.get('uptime_seconds')}s: {stats.get('connections')} Verbindungen, "
+              f"{stats.get('clients')} Clients, {stats.get('bytes_in')} Bytes empfangen, "
+              f"{stats.get('bytes_out')} Bytes gesendet")
+        print(f"Warteschlangen: {queues.get('frames')} Frames / {queues.get('bytes')} Bytes, "
+              f"{queues.get('lagging')} hängen hinterher, {queues.get('dropped_frames')} verworfen")
+        rejected = stats.get('rejected', {})
+        if rejected:
+            print("Wegen Rate-Limit abgelehnt: " + ", ".join(f"{message_type} {count}"
+                                                          for message_type, count in sorted(rejected.items())))
+        for message_type, count in sorted(stats.get('messages_in', {}).items()):
+            timing = stats.get('handle_seconds', {}).get(message_type, {})
+            average = timing.get('sum', 0) / timing['count'] * 1000 if timing.get('count') else 0
+            print(f"  {message_type}: {count} empfangen, Ø {average:.3f} ms")
 
     def TUI(self):
         print("\n*************** Peer Group Chat ***************\n")
@@ -569,10 +165,16 @@ class GroupChatClient:
         print(" 4 <Name>                - Chat mit Benutzer beenden")
         print(" 5                       - Aktive Chats anzeigen")
         print(" 6 <Nachricht>           - Broadcast-Nachricht")
+        print(" 7                       - Server-Statistik")
+        print(" 8 [Anzahl]              - Broadcast-Verlauf anzeigen")
+        print(" 9 <Suchbegriffe>        - Verlauf durchsuchen (from:<Name> für Absender)")
+        print(" 10 <Raum>               - Raum betreten")
+        print(" 11 <Raum>               - Raum verlassen")
+        print(" 12 <Raum> <Nachricht>   - Nachricht an einen Raum")
         print(" exit                    - Chat verlassen")
         print()
 
-        while self.info.running:
+        while self.running:
             try:
                 command = input("Aktion eingeben: \n").strip()
                 if command:
@@ -581,58 +183,102 @@ class GroupChatClient:
                         break
             except KeyboardInterrupt:
                 print("\nBeende Client...")
-                self.info.running = False
+                self.running = False
                 break
             except EOFError:
                 print("\nEingabe beendet, beende Client...")
-                self.info.running = False
+                self.running = False
                 break
 
     def handle_command(self, command):
         parts = command.split(' ', 2)
         cmd = parts[0].lower()
+        engine = self.engine
 
         if cmd == 'exit':
-            self.info.running = False
+            self.running = False
         elif cmd == '1':
-            print(f"Aktuelle Benutzer: {list(self.info.peer_list.keys())}")
+            print(f"Aktuelle Benutzer: {list(engine.peer_list)}")
+            for room, members in list(engine.rooms.items()):
+                print(f"Raum {room}: {list(members)}")
 
         elif cmd == '2':
             if len(parts) < 2:
                 print("Bitte geben Sie den Nickname des Benutzers ein")
                 return
-            self.start_chat_with_peer(parts[1])
+            self.call(engine.start_chat, parts[1])
         elif cmd == '3':
             if len(parts) < 3:
                 print("Bitte geben Sie den Nickname des Benutzers und die Nachricht ein")
                 return
-            self.send_chat_message(parts[1], parts[2])
+            self.call(engine.send_chat, parts[1], parts[2])
         elif cmd == '4':
             if len(parts) < 2:
                 print("Bitte geben Sie den Nickname des Benutzers ein mit dem sie den chat beenden wollen")
                 return
-            self.close_chat_with_peer(parts[1])
+            self.call(engine.close_chat, parts[1])
         elif cmd == '5':
-            if self.info.active_chats:
-                print(f"Aktive Chats: {list(self.info.active_chats.keys())}")
+            active = list(engine.active_chats)
+            if active:
+                print(f"Aktive Chats: {active}")
             else:
                 print("Keine aktiven Chats")
+            idle = [nickname for nickname in list(engine.peer_links) if nickname not in active]
+            if idle:
+                print(f"Offene Verbindungen ohne Chat: {idle}")
         elif cmd == '6':
             if len(parts) < 2:
                 print("Bitte geben Sie eine Nachricht für den Broadcast ein")
                 return
-            self.broadcast_message(' '.join(parts[1:]))
+            self.call(engine.broadcast, ' '.join(parts[1:]))
+        elif cmd == '7':
+            self.call(engine.request_stats)
+            # Die Engine gehört der Schleife: Kopien dort ziehen, hier nur ausgeben
+            handshakes = self.query(engine.handshakes.stats)
+            print(f"Chat-Handshakes: {handshakes['completed']} aufgebaut, {handshakes['failed']} gescheitert, "
+                  f"{handshakes['retransmits']} Wiederholungen, p50 {handshakes['p50_ms']} ms, "
+                  f"p99 {handshakes['p99_ms']} ms")
+            for message_type, latency in sorted(self.query(engine.latency_stats).items()):
+                print(f"Antwortzeit {message_type}: {latency['count']} Anfragen, p50 {latency['p50_ms']} ms, "
+                      f"p99 {latency['p99_ms']} ms")
+        elif cmd == '8':
+            count = parts[1] if len(parts) > 1 else '20'
+            if not count.isdigit():
+                print("Bitte eine Anzahl angeben")
+                return
+            self.call(engine.request_history, int(count))
+        elif cmd == '9':
+            if len(parts) < 2:
+                print("Bitte Suchbegriffe eingeben")
+                return
+            self.call(engine.search, ' '.join(parts[1:]))
+        elif cmd in ('10', '11'):
+            if len(parts) < 2:
+                print("Bitte einen Raum angeben")
+                return
+            self.call(engine.join if cmd == '10' else engine.leave, parts[1])
+        elif cmd == '12':
+            if len(parts) < 3:
+                print("Bitte Raum und Nachricht angeben")
+                return
+            if parts[1] not in engine.rooms:
+                print(f"Raum {parts[1]} nicht betreten")
+                return
+            self.call(engine.send_room, parts[1], parts[2])
         else:
             print("Unbekannter Befehl")
 
     def stop(self):
-        self.info.running = False
-        for socket_obj in [self.info.server_socket, self.info.udp_socket, self.info.tcp_chat_socket]:
-            if socket_obj:
-                try:
-                    socket_obj.close()
-                except:
-                    pass
+        self.running = False
+        loop, self.loop = self.loop, None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.engine.stop(), loop).result(timeout=2)
+        except Exception:
+            pass
+        loop.call_soon_threadsafe(loop.stop)
+
 
 def main():
     client = GroupChatClient()
@@ -658,4 +304,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,146 +1,764 @@
+import argparse
+import collections
+import multiprocessing
+import os
+import selectors
+import signal
 import socket
+import tempfile
 import threading
 import json
+import logging
 import time
-from common import ClientInfo
+from cluster import ShardBus, ShardHub
+from common import (CODECS, MAX_IOV, PROTOCOL_V1, PROTOCOL_V2, RECV_SIZE, FrameDecoder,
+                    accepted_encodings, advance_buffers, encode_body, encode_frame_parts, read_frame, send_buffers,
+                    set_cork, set_keepalive, set_nodelay)
+from history import BroadcastLog
+from metrics import MetricsEndpoint, ServerMetrics, configure_logging
+from ratelimit import RATE_LIMITS, TokenBucket, parse_rate_limits
+from registry import ClientRegistry, ClientSession
+from rooms import RoomIndex, valid_room
+from search import BackgroundIndexer, SearchIndex
+from timers import TimerWheel
+
+log = logging.getLogger('chatroom.server')
+
+
+class Connection:
+    """Eingangspuffer und begrenzte ausgehende Warteschlange einer Client-Verbindung.
+
+    Frames werden als fertige Frame-Objekte (Kopf und Body getrennt)
+    zusammen mit ihrem Nachrichtentyp eingereiht und von einem Writer
+    (eigener Thread bzw. der Event-Loop) per sendmsg abgearbeitet, ohne sie
+    vorher zusammenzukopieren. In outq liegen nur Frames, deren Versand noch
+    nicht begonnen hat; die Restpuffer eines angefangenen sendmsg liegen in
+    partial.
+    """
+
+    def __init__(self, client_socket, address, recv_view=None):
+        set_nodelay(client_socket)
+        self.socket = client_socket
+        self.address = address
+        self.decoder = FrameDecoder(recv_view)
+        self.outq = collections.deque()  # (message_type, frame)
+        self.partial = None  # [Puffer] eines angefangenen sendmsg
+        self.queued_bytes = 0
+        self.dropped_frames = 0
+        self.cond = threading.Condition()
+        self.writing = False
+        self.corked = False
+        self.batched_presence = False  # Client versteht PRESENCE statt USER_JOINED/USER_LEFT
+        self.batched_broadcasts = False  # Client versteht BROADCAST_BATCH statt einzelner BROADCAST_MSG
+        self.keepalive = False  # Client beantwortet PING (Keepalive-Header bei REGISTER)
+        self.last_seen = time.monotonic()  # letzter Empfang, für den Leerlauf-Timeout
+        self.buckets = {}  # {Nachrichtentyp: TokenBucket}, nur vom Leser der Verbindung benutzt
+        self.protocol_version = PROTOCOL_V1  # bei REGISTER ausgehandelt
+        self.content_encoding = None  # bei REGISTER per Accept-Encoding ausgehandelt
+        self.lagging = False
+        self.closing = False
+        self.close_deadline = None
+        self.closed = False
+
+    def enqueue(self, message_type, frame):
+        with self.cond:
+            if self.closed or self.closing:
+                return False
+            self.outq.append((message_type, frame))
+            self.queued_bytes += frame.size
+            self.cond.notify()
+        return True
+
+    def take(self, limit=RECV_SIZE):
+        """Puffer für das nächste sendmsg: Rest des angefangenen oder neue Frames.
+
+        Aufeinanderfolgende kleine Frames werden zu einem Puffer verbunden,
+        große gehen als Kopf und Body ohne Kopie hinaus.
+        """
+        with self.cond:
+            if self.partial is not None:
+                buffers, self.partial = self.partial, None
+                return buffers
+
+            buffers = []
+            small = []
+            size = 0
+            outq = self.outq
+            while outq and size < limit:
+                frame = outq.popleft()[1]
+                size += frame.size
+                if frame.data is not None:
+                    small.append(frame.data)
+                    continue
+                if small:
+                    buffers.append(b''.join(small))
+                    small = []
+                buffers.append(frame.head)
+                buffers.append(frame.body)
+                if len(buffers) >= MAX_IOV - 3:
+                    break
+            if small:
+                buffers.append(b''.join(small))
+            return buffers
+
+    def sent(self, buffers, count):
+        """count Bytes aus buffers wurden geschrieben; den Rest für den nächsten Versuch merken"""
+        with self.cond:
+            if self.closed:
+                return
+            self.queued_bytes -= count
+            if count < sum(map(len, buffers)):
+                self.partial = advance_buffers(buffers, count)
+            elif self.queued_bytes == 0:
+                self.lagging = False  # Rückstand vollständig abgebaut
+
+    def has_pending(self):
+        return self.partial is not None or bool(self.outq)
+
+    def queue_depth(self):
+        with self.cond:
+            return len(self.outq) + (self.partial is not None), self.queued_bytes
+
+    def drop_oldest(self, message_types, limit):
+        """Älteste noch nicht begonnene Frames der angegebenen Typen verwerfen, bis limit erreicht ist"""
+        with self.cond:
+            kept = collections.deque()
+            for entry in self.outq:
+                if self.queued_bytes > limit and entry[0] in message_types:
+                    self.queued_bytes -= len(entry[1])
+                    self.dropped_frames += 1
+                else:
+                    kept.append(entry)
+            self.outq = kept
+
+    def replace_types(self, message_types, message_type, frame):
+        """Noch nicht begonnene Frames der angegebenen Typen durch einen einzigen Frame ersetzen"""
+        with self.cond:
+            kept = collections.deque()
+            removed = 0
+            for entry in self.outq:
+                if entry[0] in message_types:
+                    self.queued_bytes -= len(entry[1])
+                    removed += 1
+                else:
+                    kept.append(entry)
+            if removed:
+                kept.append((message_type, frame))
+                self.queued_bytes += len(frame)
+                self.dropped_frames += removed - 1
+            self.outq = kept
+            return removed
+
+    def close_with(self, message_type, frame, deadline):
+        """Ausstehende Frames verwerfen, nur noch frame senden und danach schließen"""
+        with self.cond:
+            if self.closed or self.closing:
+                return
+            self.dropped_frames += len(self.outq)
+            # Nur die verworfenen Frames abziehen: ein gerade laufendes sendmsg
+            # (Writer-Thread) meldet seine Bytes noch über sent() zurück
+            self.queued_bytes += len(frame) - sum(len(entry[1]) for entry in self.outq)
+            self.outq = collections.deque([(message_type, frame)])
+            self.closing = True
+            self.close_deadline = deadline
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.outq.clear()
+            self.partial = None
+            self.queued_bytes = 0
+            self.cond.notify_all()
+
+
+class EncodedMessage:
+    """Nachricht für den Fan-out, die pro Protokollversion und Content-Encoding höchstens einmal kodiert wird"""
+
+    def __init__(self, server, message_type, json_data=None, additional_headers=None, compact_body=None):
+        self.server = server
+        self.message_type = message_type
+        self.json_data = json_data
+        self.additional_headers = additional_headers
+        self.compact_body = compact_body  # bereits kompakt serialisierter Body, z.B. aus dem Verlauf
+        self.frames = {}  # {(protocol_version, content_encoding): bytes}
+
+    def frame(self, protocol_version, content_encoding=None):
+        key = (protocol_version, content_encoding)
+        frame = self.frames.get(key)
+        if frame is None:
+            if self.compact_body is not None and protocol_version == PROTOCOL_V2:
+                frame = self.server.build_frame(self.message_type, self.compact_body,
+                                                self.additional_headers, protocol_version, content_encoding)
+            else:
+                frame = self.server.build_message(self.message_type, self.json_data,
+                                                  self.additional_headers, protocol_version, content_encoding)
+            self.frames[key] = frame
+        return frame
 
 
 class GroupChatServer:
-    PROTOCOL_VERSION = "1.0"
+    PROTOCOL_VERSION = PROTOCOL_V1
+    SUPPORTED_VERSIONS = (PROTOCOL_V1, PROTOCOL_V2)
+    MODES = ('threaded', 'selector')
+    SLOW_CONSUMER_POLICIES = ('drop_oldest', 'coalesce', 'disconnect')
+    ROSTER_TYPES = ('USER_LIST', 'USER_JOINED', 'USER_LEFT', 'USER_DELTA', 'PRESENCE')
+    # Warteschlangentyp für USER_LIST/USER_DELTA als Antwort auf GET_USERS mit Request-ID:
+    # coalesce darf sie nicht ersetzen, sonst wartet der Client vergeblich auf seine Antwort
+    ROSTER_REPLY = 'ROSTER_REPLY'
+    TIMER_TICK = 0.05
+    HISTORY_FLUSH_INTERVAL = 1.0  # Verlauf höchstens so oft auf die Platte bringen und aufräumen
+    HISTORY_LIMIT = 500  # höchstens so viele Nachrichten pro HISTORY_OK
+    BATCH_LIMIT = 1000  # höchstens so viele Nachrichten pro BATCH
+    SEARCH_LIMIT = 50  # höchstens so viele Treffer pro SEARCH_OK
 
-    def __init__(self, host='localhost', port=8888):
+    def __init__(self, host='localhost', port=8888, mode='threaded', backlog=128,
+                 send_buffer_limit=256 * 1024, slow_consumer_policy='drop_oldest',
+                 disconnect_grace=5.0, presence_interval=0.2, reuse_port=False, bus_path=None,
+                 metrics_port=None, history_dir=None, history_retention_bytes=256 * 1024 * 1024,
+                 history_retention_seconds=7 * 24 * 3600, ping_interval=30.0, idle_timeout=90.0,
+                 rate_limits=None):
+        if mode not in self.MODES:
+            raise ValueError(f"Unbekannter Server-Modus: {mode}")
+        if slow_consumer_policy not in self.SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unbekannte Slow-Consumer-Policy: {slow_consumer_policy}")
+        if idle_timeout <= ping_interval:
+            raise ValueError("Der Leerlauf-Timeout muss länger als das PING-Intervall sein")
         self.host = host
         self.port = port
-        self.clients = {}  # {client_socket: ClientInfo}
+        self.mode = mode
+        self.backlog = backlog
+        self.send_buffer_limit = send_buffer_limit  # High-Water-Mark pro Verbindung in Bytes
+        self.hard_send_buffer_limit = 4 * send_buffer_limit
+        self.slow_consumer_policy = slow_consumer_policy
+        self.disconnect_grace = disconnect_grace
+        self.presence_interval = presence_interval  # Sammelfenster für Beitritte/Abgänge in Sekunden
+        self.ping_interval = ping_interval  # so lange still, dann PING
+        self.idle_timeout = idle_timeout  # so lange still, dann wird die Verbindung getrennt
+        self.timers = TimerWheel(time.monotonic())  # ein Leerlauf-Zeitgeber pro Verbindung
+        # {Nachrichtentyp: (Nachrichten/s, Burst)} pro Client, {} = ohne Limits
+        self.rate_limits = RATE_LIMITS if rate_limits is None else rate_limits
+        self.reuse_port = reuse_port  # mehrere Worker-Prozesse teilen sich den Port (SO_REUSEPORT)
+        self.bus_path = bus_path  # Unix-Socket des ShardHub, None ohne Sharding
+        self.bus = None
+        self.metrics = ServerMetrics()
+        self.metrics_port = metrics_port  # HTTP-Scrape-Endpunkt auf localhost, None = aus
+        self.metrics_endpoint = None
+        self.history = None
+        if history_dir is not None:
+            self.history = BroadcastLog(history_dir, retention_bytes=history_retention_bytes,
+                                        retention_seconds=history_retention_seconds)
+        # Suche nur über den Verlauf: der Index hält Offsets, die Texte liegen im Log
+        self.search_index = None
+        self.indexer = None
+        if self.history is not None:
+            self.search_index = SearchIndex(self.history.first_offset)
+            self.indexer = BackgroundIndexer(self.search_index, self.history)
+        self._registering = set()  # Sockets, deren Nickname gerade beim Hub angefragt ist
+        self.clients = ClientRegistry()
+        self.rooms = RoomIndex()
+        self.connections = {}  # {client_socket: Connection}
+        self.selector = None
+        self._recv_view = None
         self.server_socket = None
         self.running = False
+        self._pending_close = []
+        self._dirty = set()  # Verbindungen mit neuen Frames (Selector-Modus)
+        self._closing = set()  # Verbindungen, die nach dem letzten Frame geschlossen werden
+        self._presence_lock = threading.Lock()
+        self._presence = {}  # {nickname: [war_vorher_da, client_socket, ClientSession oder None]}
+        self._presence_from = 0  # Roster-Version beim letzten PRESENCE
+        self._presence_due = None
+        self._history_flushed = time.monotonic()
 
     def start(self):
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
+            self.server_socket.listen(self.backlog)
             self.running = True
 
-            print(f"Server gestartet auf {self.host}:{self.port}")
-
-            while self.running:
-                try:
-                    client_socket, client_addr = self.server_socket.accept()
-                    print(f"Neue Verbindung von {client_addr}")
+            if self.bus_path is not None:
+                self.bus = ShardBus(self.bus_path, self)
+            if self.indexer is not None:
+                self.indexer.start()
+            if self.metrics_port is not None:
+                self.metrics_endpoint = MetricsEndpoint(self, self.metrics_port)
+                self.metrics_endpoint.start()
+                log.info("Metriken auf http://127.0.0.1:%s/metrics", self.metrics_port)
 
-                    client_thread = threading.Thread(
-                        target=self.handle_client,
-                        args=(client_socket,)
-                    )
-                    client_thread.daemon = True
-                    client_thread.start()
+            log.info("Server gestartet auf %s:%s (%s, PID %s)", self.host, self.port, self.mode, os.getpid())
 
-                except Exception as e:
-                    if self.running:
-                        print(f"Fehler beim Akzeptieren von Verbindungen: {e}")
+            if self.mode == 'selector':
+                self.serve_selector()
+            else:
+                self.serve_threaded()
 
         except Exception as e:
-            print(f"Server-Start-Fehler: {e}")
+            log.error("Server-Start-Fehler: %s", e)
         finally:
             self.stop()
 
+    def serve_threaded(self):
+        """Ein Thread pro Verbindung"""
+        threading.Thread(target=self.timer_loop, daemon=True).start()
+        if self.bus is not None:
+            threading.Thread(target=self.bus.run, daemon=True).start()
+
+        while self.running:
+            try:
+                client_socket, client_addr = self.server_socket.accept()
+                log.debug("Neue Verbindung von %s", client_addr)
+                connection = Connection(client_socket, client_addr)
+                self.connections[client_socket] = connection
+                self.watch_connection(connection)
+
+                client_thread = threading.Thread(
+                    target=self.handle_client,
+                    args=(client_socket,)
+                )
+                client_thread.daemon = True
+                client_thread.start()
+
+                writer_thread = threading.Thread(
+                    target=self.write_loop,
+                    args=(connection,)
+                )
+                writer_thread.daemon = True
+                writer_thread.start()
+
+            except Exception as e:
+                if self.running:
+                    log.warning("Fehler beim Akzeptieren von Verbindungen: %s", e)
+
+    def serve_selector(self):
+        """Ein Event-Loop für Accept, Lesen, Dispatch und Schreiben aller Verbindungen"""
+        self.selector = selectors.DefaultSelector()
+        self._recv_view = memoryview(bytearray(RECV_SIZE))  # von allen Verbindungen geteilt
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+        if self.bus is not None:
+            self.selector.register(self.bus, selectors.EVENT_READ, self.bus)
+
+        while self.running:
+            timeout = self.TIMER_TICK if self._presence_due is not None or self._closing else 1.0
+            for key, events in self.selector.select(timeout=timeout):
+                if key.data is None:
+                    self.accept_connections()
+                    continue
+                if key.data is self.bus:
+                    self.bus.read()
+                    continue
+
+                connection = key.data
+                if events & selectors.EVENT_READ and not connection.closed:
+                    self.read_connection(connection)
+                if events & selectors.EVENT_WRITE and not connection.closed:
+                    self.flush_connection(connection)
+
+            self.run_timers(time.time())
+
+            # Alles, was in diesem Durchlauf eingereiht wurde, gesammelt schreiben
+            while self._dirty:
+                connection = self._dirty.pop()
+                if not connection.closed:
+                    self.flush_connection(connection)
+
+            while self._pending_close:
+                self.disconnect_client(self._pending_close.pop().socket)
+
+    def accept_connections(self):
+        while True:
+            try:
+                client_socket, client_addr = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except Exception as e:
+                if self.running:
+                    log.warning("Fehler beim Akzeptieren von Verbindungen: %s", e)
+                return
+
+            log.debug("Neue Verbindung von %s", client_addr)
+            client_socket.setblocking(False)
+            connection = Connection(client_socket, client_addr, self._recv_view)
+            self.connections[client_socket] = connection
+            self.watch_connection(connection)
+            self.selector.register(client_socket, selectors.EVENT_READ, connection)
+
+    def watch_connection(self, connection):
+        """Leerlauf-Zeitgeber der Verbindung starten"""
+        # Der Kernel-Keepalive wacht über Clients, die PING nicht beantworten können
+        set_keepalive(connection.socket, self.idle_timeout)
+        self.timers.schedule(connection, connection.last_seen + self.ping_interval)
+
+    def read_connection(self, connection):
+        try:
+            received = connection.decoder.recv_from(connection.socket)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            received = 0
+
+        if not received:
+            self.close_connection(connection)
+            return
+        connection.last_seen = time.monotonic()
+
+        try:
+            for message_type, headers, body in connection.decoder.frames():
+                self.dispatch_message(connection.socket, message_type, headers, body)
+                if connection.closed:
+                    return
+        except Exception as e:
+            log.warning("Client-Handler-Fehler: %s", e)
+            self.close_connection(connection)
+
+    def flush_connection(self, connection):
+        buffers = []
+        # Braucht der Rückstand mehrere sendmsg, gehen nur volle Segmente hinaus;
+        # einzelne kleine Frames verlassen den Server dank TCP_NODELAY sofort.
+        corked = connection.queued_bytes > RECV_SIZE
+        if corked:
+            set_cork(connection.socket, True)
+        try:
+            while True:
+                buffers = connection.take()
+                if not buffers:
+                    break
+                count = send_buffers(connection.socket, buffers)
+                connection.sent(buffers, count)
+                buffers = []
+                if connection.partial is not None:
+                    break
+        except (BlockingIOError, InterruptedError):
+            connection.sent(buffers, 0)
+        except OSError:
+            self.close_connection(connection)
+            return
+        finally:
+            if corked:
+                set_cork(connection.socket, False)
+
+        if connection.closing and not connection.has_pending():
+            self.close_connection(connection)
+            return
+
+        # Nur auf EVENT_WRITE warten, solange noch Daten ausstehen
+        wants_write = connection.has_pending()
+        if wants_write != connection.writing:
+            connection.writing = wants_write
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if wants_write else 0)
+            self.selector.modify(connection.socket, events, connection)
+
+    def timer_loop(self):
+        """Zeitgesteuerte Aufgaben im Threaded-Modus"""
+        while self.running:
+            time.sleep(self.TIMER_TICK)
+            self.run_timers(time.time())
+
+    def run_timers(self, now):
+        if self._presence_due is not None and now >= self._presence_due:
+            self.flush_presence()
+        if self._closing:
+            self.expire_closing(now)
+        monotonic = time.monotonic()
+        self.check_idle(monotonic)
+        if self.history is not None and monotonic - self._history_flushed >= self.HISTORY_FLUSH_INTERVAL:
+            # Gepufferte Verlaufseinträge gesammelt statt pro Broadcast schreiben
+            self._history_flushed = monotonic
+            self.history.flush()
+
+    def expire_closing(self, now):
+        """Verbindungen schließen, deren letzter Frame nicht rechtzeitig abgenommen wurde"""
+        for connection in list(self._closing):
+            if connection.closed:
+                self._closing.discard(connection)
+            elif connection.close_deadline <= now:
+                self._closing.discard(connection)
+                self.close_connection(connection)
+
+    def check_idle(self, now):
+        """Fällige Leerlauf-Zeitgeber: stillen Verbindungen PING senden, toten den Abgang einleiten.
+
+        Pro Nachricht wird nur last_seen gesetzt; erst wenn der Zeitgeber
+        fällig wird, wird er anhand von last_seen neu gestellt. Der
+        Leerlauf-Timeout gilt für jede Verbindung, nur das PING bekommen
+        allein Clients, die es per Keepalive-Header angekündigt haben.
+        """
+        for connection in self.timers.advance(now):
+            if connection.closed or connection.closing:
+                continue
+            idle = now - connection.last_seen
+            if idle >= self.idle_timeout:
+                log.info("Verbindung %s seit %.0f s ohne Lebenszeichen, wird getrennt",
+                         self.nickname_of(connection.socket) or connection.address, idle)
+                self.metrics.record_idle_disconnect()
+                self.reap_connection(connection)
+                continue
+            if idle < self.ping_interval:
+                deadline = connection.last_seen + self.ping_interval
+            else:
+                if connection.keepalive:
+                    self.send_message(connection.socket, 'PING')
+                deadline = connection.last_seen + self.idle_timeout
+            self.timers.schedule(connection, deadline)
+
+    def reap_connection(self, connection):
+        """Tote Verbindung abbauen, der Abgang läuft wie bei einem Verbindungsabbruch über disconnect_client"""
+        if self.mode == 'selector':
+            self.close_connection(connection)
+        else:
+            # recv im Handler-Thread kehrt zurück, der Handler trennt den Client
+            self.shutdown_socket(connection.socket)
+
+    def close_connection(self, connection):
+        """Verbindung nach dem aktuellen Loop-Durchlauf schließen"""
+        if not connection.closed:
+            connection.closed = True
+            self._pending_close.append(connection)
+
+    def write_loop(self, connection):
+        """Writer-Thread einer Verbindung im Threaded-Modus"""
+        try:
+            while True:
+                with connection.cond:
+                    while not connection.has_pending() and not connection.closed:
+                        if connection.closing:
+                            raise ConnectionAbortedError("Slow Consumer getrennt")
+                        connection.cond.wait()
+                    if connection.closed:
+                        return
+                # Bei Rückstand bis zum Leerlaufen nur volle Segmente senden
+                if not connection.corked and connection.queued_bytes > RECV_SIZE:
+                    connection.corked = True
+                    set_cork(connection.socket, True)
+                buffers = rest = connection.take()
+                while rest:
+                    rest = advance_buffers(rest, send_buffers(connection.socket, rest))
+                connection.sent(buffers, sum(map(len, buffers)))
+                if connection.corked and not connection.has_pending():
+                    connection.corked = False
+                    set_cork(connection.socket, False)
+        except OSError:
+            # Lesenden Handler wecken, damit er die Verbindung abbaut
+            try:
+                connection.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
     def handle_client(self, client_socket):
+        connection = self.connections[client_socket]
         try:
             while self.running:
                 message_type, headers, body = self.receive_message(client_socket)
 
                 if not message_type:
                     break
+                connection.last_seen = time.monotonic()
 
-                json_data = json.loads(body) if body else {}
-
-                if message_type == 'REGISTER':
-                    self.handle_register(client_socket, headers, json_data)
-                elif message_type == 'UNREGISTER':
-                    self.handle_unregister(client_socket)
-                elif message_type == 'BROADCAST':
-                    self.handle_broadcast(client_socket, json_data)
-                elif message_type == 'GET_USERS':
-                    self.handle_get_users(client_socket)
-                else:
-                    self.send_error(client_socket, f"Unbekannter Nachrichten typ: {message_type}")
+                self.dispatch_message(client_socket, message_type, headers, body)
 
         except Exception as e:
-            print(f"Client-Handler-Fehler: {e}")
+            log.warning("Client-Handler-Fehler: %s", e)
         finally:
             self.disconnect_client(client_socket)
 
-    def send_message(self, client_socket, message_type, json_data=None, additional_headers=None):
+    def dispatch_message(self, client_socket, message_type, headers, body):
+        started = time.perf_counter()
+        connection = self.connections.get(client_socket)
         try:
-            body = json.dumps(json_data) if json_data else ""
-            headers = [
-                f"{message_type} {self.PROTOCOL_VERSION}",
-                f"Host: {self.host}",
-                f"Content-Length: {len(body.encode('utf-8'))}"
-            ]
-
-            if additional_headers:
-                for key, value in additional_headers.items():
-                    headers.append(f"{key}: {value}")
-
-            message = "\r\n".join(headers) + "\r\n\r\n" + body
-            client_socket.send(message.encode('utf-8'))
+            if message_type in self.rate_limits and connection is not None:
+                if not self.admit(connection, message_type, headers):
+                    return
+            self.handle_message(client_socket, message_type, headers, body)
+        finally:
+            size = connection.decoder.frame_size if connection is not None else 0
+            self.metrics.record_in(message_type, size, time.perf_counter() - started)
+
+    def admit(self, connection, message_type, headers, cost=1):
+        """Token Bucket des Clients für message_type um cost belasten; leer: ERROR mit Retry-After und False"""
+        now = time.monotonic()
+        bucket = connection.buckets.get(message_type)
+        if bucket is None:
+            rate, burst = self.rate_limits[message_type]
+            bucket = connection.buckets[message_type] = TokenBucket(rate, burst, now)
+        retry_after = bucket.take(now, cost)
+        if not retry_after:
             return True
+        self.metrics.record_rejected(message_type)
+        log.debug("%s von %s abgelehnt, Limit erreicht", message_type, self.nickname_of(connection.socket))
+        self.send_error(connection.socket, f"Zu viele {message_type}, bitte später erneut senden", headers,
+                        'rate_limited', {'Retry-After': f"{retry_after:.3f}"})
+        return False
+
+    def handle_message(self, client_socket, message_type, headers, body):
+        json_data = json.loads(body) if body else {}
+
+        if message_type == 'REGISTER':
+            self.handle_register(client_socket, headers, json_data)
+        elif message_type == 'UNREGISTER':
+            self.handle_unregister(client_socket, headers)
+        elif message_type == 'BROADCAST':
+            self.handle_broadcast(client_socket, headers, json_data)
+        elif message_type == 'BATCH':
+            self.handle_batch(client_socket, headers, json_data)
+        elif message_type == 'GET_USERS':
+            self.handle_get_users(client_socket, headers)
+        elif message_type == 'STATS':
+            self.handle_stats(client_socket, headers)
+        elif message_type == 'HISTORY':
+            self.handle_history(client_socket, headers)
+        elif message_type == 'SEARCH':
+            self.handle_search(client_socket, headers, json_data)
+        elif message_type == 'JOIN':
+            self.handle_join(client_socket, headers)
+        elif message_type == 'LEAVE':
+            self.handle_leave(client_socket, headers)
+        elif message_type == 'ROOM_MSG':
+            self.handle_room_message(client_socket, headers, json_data)
+        elif message_type == 'PING':
+            self.send_message(client_socket, 'PONG', None, self.reply_headers(headers))
+        elif message_type == 'PONG':
+            pass  # Lebenszeichen, last_seen ist schon gesetzt
+        else:
+            self.send_error(client_socket, f"Unbekannter Nachrichten typ: {message_type}", headers)
+
+    def build_message(self, message_type, json_data=None, additional_headers=None, protocol_version=PROTOCOL_V1,
+                      content_encoding=None):
+        body = encode_body(json_data, protocol_version)
+        return self.build_frame(message_type, body, additional_headers, protocol_version, content_encoding)
+
+    def build_frame(self, message_type, body, additional_headers=None, protocol_version=PROTOCOL_V1,
+                    content_encoding=None):
+        """Frame aus einem bereits serialisierten Body bauen; der Body wird nicht kopiert"""
+        if protocol_version == PROTOCOL_V2:
+            # Binäre Frames lassen den Host-Header weg, der Client kennt seinen Server
+            return encode_frame_parts(message_type, protocol_version, additional_headers, body, content_encoding)
+        return encode_frame_parts(message_type, protocol_version, additional_headers, body, content_encoding,
+                                  (('Host', self.host),))
+
+    def version_of(self, client_socket):
+        connection = self.connections.get(client_socket)
+        return connection.protocol_version if connection is not None else PROTOCOL_V1
+
+    def encoding_of(self, client_socket):
+        connection = self.connections.get(client_socket)
+        return connection.content_encoding if connection is not None else None
+
+    def build_for(self, client_socket, message_type, body, additional_headers=None):
+        """Frame aus fertigem Body in Protokollversion und Content-Encoding des Empfängers"""
+        return self.build_frame(message_type, body, additional_headers, self.version_of(client_socket),
+                                self.encoding_of(client_socket))
+
+    def reply_headers(self, headers, additional_headers=None):
+        """Request-ID der Anfrage in die Antwort übernehmen, damit der Client sie zuordnen kann"""
+        request_id = headers.get('Request-ID') if headers else None
+        if request_id is None:
+            return additional_headers
+        reply = dict(additional_headers) if additional_headers else {}
+        reply['Request-ID'] = request_id
+        return reply
+
+    def send_message(self, client_socket, message_type, json_data=None, additional_headers=None, queue_type=None):
+        try:
+            frame = self.build_message(message_type, json_data, additional_headers, self.version_of(client_socket),
+                                       self.encoding_of(client_socket))
+            return self.send_frame(client_socket, frame, message_type, queue_type)
         except Exception as e:
-            print(f"Fehler beim Senden: {e}")
+            log.warning("Fehler beim Senden: %s", e)
             return False
 
-    def receive_message(self, client_socket):
+    def send_encoded(self, client_socket, message):
+        """EncodedMessage in der Protokollversion des Empfängers einreihen"""
+        connection = self.connections.get(client_socket)
+        if connection is None:
+            return False
+        return self.send_frame(client_socket, message.frame(connection.protocol_version, connection.content_encoding),
+                               message.message_type)
+
+    def send_frame(self, client_socket, frame, message_type=None, queue_type=None):
+        """Fertigen Frame in die Warteschlange des Empfängers legen, ohne auf den Versand zu warten.
+
+        queue_type ersetzt message_type in der Warteschlange, wenn die
+        Slow-Consumer-Policy den Frame anders behandeln soll als seinen Typ.
+        """
+        connection = self.connections.get(client_socket)
+        if connection is None or not connection.enqueue(queue_type or message_type, frame):
+            return False
+        self.metrics.record_out(message_type, frame.size)
+        if connection.queued_bytes > self.send_buffer_limit and self.mode == 'selector':
+            # Erst versuchen, den Puffer abzugeben; nur echte Slow Consumer bleiben darüber
+            self.flush_connection(connection)
+        if connection.queued_bytes > self.send_buffer_limit:
+            self.apply_backpressure(connection)
+        if self.mode == 'selector':
+            self._dirty.add(connection)
+        return True
+
+    def apply_backpressure(self, connection):
+        """Slow-Consumer-Policy anwenden, sobald die High-Water-Mark überschritten ist"""
+        if not connection.lagging:
+            connection.lagging = True
+            frames, queued = connection.queue_depth()
+            log.warning("Client %s hängt hinterher: %s Frames / %s Bytes ausstehend (%s)",
+                        self.nickname_of(connection.socket), frames, queued, self.slow_consumer_policy)
+
+        if self.slow_consumer_policy == 'drop_oldest':
+            connection.drop_oldest(('BROADCAST_MSG', 'BROADCAST_BATCH'), self.send_buffer_limit)
+        elif self.slow_consumer_policy == 'coalesce':
+            # Einzelne Roster-Updates durch eine aktuelle Benutzerliste ersetzen; Antworten
+            # auf GET_USERS (ROSTER_REPLY) bleiben stehen, damit ihre Request-ID ankommt
+            if any(entry[0] in self.ROSTER_TYPES for entry in list(connection.outq)):
+                frame = self.user_list_frame(connection.socket)
+                connection.replace_types(self.ROSTER_TYPES, 'USER_LIST', frame)
+
+        if self.slow_consumer_policy == 'disconnect' or connection.queued_bytes > self.hard_send_buffer_limit:
+            self.disconnect_slow_consumer(connection)
+
+    def disconnect_slow_consumer(self, connection):
+        error = self.build_message('ERROR', {'message': "Verbindung zu langsam, Client wird getrennt"},
+                                   protocol_version=connection.protocol_version)
+        connection.close_with('ERROR', error, time.time() + self.disconnect_grace)
+        if self.mode == 'selector':
+            self._closing.add(connection)
+        else:
+            # Ein im sendall blockierter Writer wird nach Ablauf der Frist geweckt
+            timer = threading.Timer(self.disconnect_grace, self.shutdown_socket, args=(connection.socket,))
+            timer.daemon = True
+            timer.start()
+
+    def shutdown_socket(self, client_socket):
         try:
-            header_lines = []
-            current_line = b''
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
-            while True:
-                char = client_socket.recv(1)
-                if not char:
-                    return None, None, None
-
-                if char == b'\n':
-                    line = current_line.decode('utf-8').rstrip('\r')
-                    if not line:
-                        break
-                    header_lines.append(line)
-                    current_line = b''
-                else:
-                    current_line += char
-
-            if not header_lines:
-                return None, None, None
-
-            first_line = header_lines[0].split()
-            if len(first_line) != 2:
-                return None, None, None
-
-            message_type = first_line[0]
-            protocol_version = first_line[1]
-
-            headers = {}
-            for line in header_lines[1:]:
-                if ':' in line:
-                    key, value = line.split(':', 1)
-                    headers[key.strip()] = value.strip()
-
-            body = ""
-            if 'Content-Length' in headers:
-                content_length = int(headers['Content-Length'])
-                if content_length > 0:
-                    body_data = b''
-                    while len(body_data) < content_length:
-                        chunk = client_socket.recv(content_length - len(body_data))
-                        if not chunk:
-                            return None, None, None
-                        body_data += chunk
-                    body = body_data.decode('utf-8')
-
-            return message_type, headers, body
+    def nickname_of(self, client_socket):
+        client_info = self.clients.get(client_socket)
+        return client_info.nickname if client_info else None
+
+    def queue_depths(self):
+        """Ausstehende Frames und Bytes pro Client, größte Rückstände zuerst"""
+        depths = []
+        for client_socket, connection in list(self.connections.items()):
+            frames, queued = connection.queue_depth()
+            depths.append({
+                'nickname': self.nickname_of(client_socket),
+                'address': f"{connection.address[0]}:{connection.address[1]}",
+                'frames': frames,
+                'bytes': queued,
+                'dropped': connection.dropped_frames,
+                'lagging': connection.lagging
+            })
+        depths.sort(key=lambda depth: depth['bytes'], reverse=True)
+        return depths
 
+    def receive_message(self, client_socket):
+        try:
+            return read_frame(client_socket, self.connections[client_socket].decoder)
         except Exception:
             return None, None, None
 
@@ -151,50 +769,101 @@ class GroupChatServer:
             udp_port = json_data.get('udp_port')
 
             if not nickname or not ip or not udp_port:
-                self.send_error(client_socket, "Fehlende Eingabe")
+                self.send_error(client_socket, "Fehlende Eingabe", headers)
+                return
+
+            if client_socket in self.clients or client_socket in self._registering:
+                self.send_error(client_socket, "Bereits registriert", headers)
+                return
+
+            client_info = ClientSession(nickname, ip, udp_port)
+
+            if self.bus is None:
+                self.complete_register(client_socket, headers, client_info, True)
                 return
 
-            if any(info.nickname == nickname for info in self.clients.values()):
-                self.send_error(client_socket, "Nickname existiert bereits")
+            # Nickname zuerst clusterweit beim Hub reservieren, die Antwort kommt über den Bus
+            self._registering.add(client_socket)
+            self.bus.claim(self.user_entry(client_info),
+                           lambda granted: self.complete_register(client_socket, headers, client_info, granted))
+
+        except Exception as e:
+            self.send_error(client_socket, f"Registration fehlgeschlagen: {e}", headers)
+
+    def complete_register(self, client_socket, headers, client_info, granted):
+        self._registering.discard(client_socket)
+        nickname = client_info.nickname
+        try:
+            if granted and client_socket not in self.connections:
+                # Verbindung während der Anfrage beim Hub abgebrochen
+                self.bus.release(nickname)
                 return
 
-            client_info = ClientInfo(nickname, ip, udp_port)
-            client_info.server_socket = client_socket
+            entry_json = json.dumps(self.user_entry(client_info)).encode('utf-8')
+            if not granted or not self.clients.register(client_socket, client_info, entry_json):
+                if granted and self.bus is not None:
+                    self.bus.release(nickname)
+                self.send_error(client_socket, "Nickname existiert bereits", headers)
+                return
 
-            self.clients[client_socket] = client_info
+            protocol_version = PROTOCOL_V1
+            connection = self.connections.get(client_socket)
+            if connection is not None:
+                connection.batched_presence = headers.get('Presence') == 'batch'
+                connection.batched_broadcasts = headers.get('Batch') == 'broadcast'
+                connection.keepalive = headers.get('Keepalive') == 'ping'
+                # Angebotene Version aus der Startzeile von REGISTER übernehmen, falls unterstützt
+                if connection.decoder.version in self.SUPPORTED_VERSIONS:
+                    connection.protocol_version = connection.decoder.version
+                protocol_version = connection.protocol_version
+                # Ohne Accept-Encoding (ältere Clients) bleiben alle Bodies unkomprimiert
+                encodings = accepted_encodings(headers.get('Accept-Encoding'))
+                connection.content_encoding = encodings[0] if encodings else None
 
+            response_headers = {'Protocol-Version': protocol_version}
+            if 'Accept-Encoding' in headers:
+                response_headers['Accept-Encoding'] = ', '.join(CODECS)
+            if 'Batch' in headers:
+                # Client darf BATCH senden
+                response_headers['Batch'] = 'broadcast'
+            if 'Keepalive' in headers:
+                # Server sendet PING und beantwortet PING des Clients mit PONG
+                response_headers['Keepalive'] = 'ping'
             response_data = {'message': f'Erfolgreich registriert als {nickname}'}
-            self.send_message(client_socket, 'REGISTER_OK', response_data)
+            self.send_message(client_socket, 'REGISTER_OK', response_data,
+                              self.reply_headers(headers, response_headers))
             self.send_user_list(client_socket)
 
-            self.broadcast_user_update('USER_JOINED', nickname, ip, udp_port, exclude=client_socket)
-            print(f"Client {nickname} registriert von {ip}:{udp_port}")
+            self.announce_presence(client_socket, client_info)
+            log.info("Client %s registriert von %s:%s", nickname, client_info.ip, client_info.udp_port)
 
         except Exception as e:
-            self.send_error(client_socket, f"Registration fehlgeschlagen: {e}")
+            self.send_error(client_socket, f"Registration fehlgeschlagen: {e}", headers)
 
-    def handle_unregister(self, client_socket):
-        if client_socket in self.clients:
-            client_info = self.clients[client_socket]
+    def handle_unregister(self, client_socket, headers):
+        client_info = self.clients.unregister(client_socket)
+        if client_info is not None:
             nickname = client_info.nickname
 
             response_data = {
                 'message': f'Erfolgreich abgemeldet {nickname}'
             }
-            self.send_message(client_socket, 'UNREGISTER_OK', response_data)
-
-            del self.clients[client_socket]
+            self.send_message(client_socket, 'UNREGISTER_OK', response_data, self.reply_headers(headers))
 
-            self.broadcast_user_update('USER_LEFT', nickname, '', 0, exclude=client_socket)
+            self.leave_rooms(client_socket)
+            self.announce_presence(client_socket, client_info, left=True)
+            if self.bus is not None:
+                self.bus.release(nickname)
 
-            print(f"Client {nickname} abgemeldet")
+            log.info("Client %s abgemeldet", nickname)
 
-    def handle_broadcast(self, client_socket, json_data):
-        if client_socket not in self.clients:
-            self.send_error(client_socket, "Nicht registriert")
+    def handle_broadcast(self, client_socket, headers, json_data):
+        client_info = self.clients.get(client_socket)
+        if client_info is None:
+            self.send_error(client_socket, "Nicht registriert", headers)
             return
 
-        sender = self.clients[client_socket].nickname
+        sender = client_info.nickname
         broadcast_message = json_data.get('message', '')
 
         broadcast_data = {
@@ -203,64 +872,405 @@ class GroupChatServer:
             'timestamp': time.time()
         }
 
-        for other_socket, other_info in self.clients.items():
-            if other_socket != client_socket:
-                self.send_message(other_socket, 'BROADCAST_MSG', broadcast_data)
+        self.deliver_broadcast(client_socket, broadcast_data)
+        if self.bus is not None:
+            self.bus.broadcast(broadcast_data)
 
         response_data = {
             'message': 'Message broadcasted'
         }
-        self.send_message(client_socket, 'BROADCAST_OK', response_data)
+        self.send_message(client_socket, 'BROADCAST_OK', response_data, self.reply_headers(headers))
 
-        print(f"Broadcast von {sender}: {broadcast_message}")
+        log.debug("Broadcast von %s: %s", sender, broadcast_message)
+
+    def handle_batch(self, client_socket, headers, json_data):
+        """Mehrere Broadcasts eines Absenders in einem Frame; eine Bestätigung für alle"""
+        client_info = self.clients.get(client_socket)
+        if client_info is None:
+            self.send_error(client_socket, "Nicht registriert", headers)
+            return
+
+        messages = json_data.get('messages')
+        if not isinstance(messages, list) or not messages:
+            self.send_error(client_socket, "BATCH ohne Nachrichten", headers)
+            return
+        if len(messages) > self.BATCH_LIMIT:
+            self.send_error(client_socket, f"BATCH mit mehr als {self.BATCH_LIMIT} Nachrichten", headers)
+            return
+        # Jede Nachricht wird an alle verteilt wie ein einzelner BROADCAST und kostet daher auch so viel
+        connection = self.connections.get(client_socket)
+        if 'BROADCAST' in self.rate_limits and connection is not None:
+            if not self.admit(connection, 'BROADCAST', headers, len(messages)):
+                return
 
-    def handle_get_users(self, client_socket):
-        """Aktuelle Benutzerliste senden"""
-        self.send_user_list(client_socket)
+        sender = client_info.nickname
+        timestamp = time.time()
+        batch = [{'sender': sender, 'message': str(message), 'timestamp': timestamp} for message in messages]
 
-    def send_user_list(self, client_socket):
-        user_list = []
-        for other_socket, client_info in self.clients.items():
-            if other_socket != client_socket:  # Eigenen Client nicht in Liste
-                user_list.append({
-                    'nickname': client_info.nickname,
-                    'ip': client_info.ip,
-                    'udp_port': client_info.udp_port
-                })
+        self.deliver_batch(client_socket, batch)
+        if self.bus is not None:
+            self.bus.broadcast_batch(batch)
 
         response_data = {
-            'users': user_list
+            'message': 'Messages broadcasted',
+            'count': len(batch)
         }
-        self.send_message(client_socket, 'USER_LIST', response_data)
+        self.send_message(client_socket, 'BATCH_OK', response_data, self.reply_headers(headers))
 
-    def broadcast_user_update(self, update_type, nickname, ip, udp_port, exclude=None):
-        update_data = {
-            'nickname': nickname,
-            'ip': ip,
-            'udp_port': udp_port,
+        log.debug("Batch von %s: %d Nachrichten", sender, len(batch))
+
+    def record_broadcast(self, broadcast_data):
+        """Broadcast im Verlauf ablegen und indizieren; gibt den kompakten Body zurück, ohne Verlauf None"""
+        if self.history is None:
+            return None
+        compact_body = self.history.append(broadcast_data)
+        self.indexer.submit(broadcast_data['offset'], broadcast_data['sender'], broadcast_data['message'])
+        return compact_body
+
+    def deliver_broadcast(self, sender_socket, broadcast_data):
+        """BROADCAST_MSG im Verlauf ablegen und an alle lokalen Clients außer dem Absender verteilen"""
+        compact_body = self.record_broadcast(broadcast_data)
+        message = EncodedMessage(self, 'BROADCAST_MSG', broadcast_data, compact_body=compact_body)
+        for other_socket, _ in self.clients.snapshot():
+            if other_socket != sender_socket:
+                self.send_encoded(other_socket, message)
+
+    def deliver_batch(self, sender_socket, batch):
+        """Broadcasts eines BATCH ablegen und als ein BROADCAST_BATCH pro Empfänger verteilen.
+
+        Der Body des Sammelframes wird aus den kompakten Bodies des Verlaufs
+        zusammengesetzt statt neu serialisiert. Clients ohne "Batch:
+        broadcast" bekommen die Nachrichten weiterhin einzeln als
+        BROADCAST_MSG, diese werden erst beim ersten solchen Empfänger kodiert.
+        """
+        compact_bodies = [self.record_broadcast(broadcast_data) for broadcast_data in batch]
+        compact_body = None
+        if self.history is not None:
+            compact_body = b'{"messages":[' + b','.join(compact_bodies) + b']}'
+        message = EncodedMessage(self, 'BROADCAST_BATCH', {'messages': batch}, compact_body=compact_body)
+        singles = None
+        for other_socket, _ in self.clients.snapshot():
+            if other_socket == sender_socket:
+                continue
+            connection = self.connections.get(other_socket)
+            if connection is None:
+                continue
+            if connection.batched_broadcasts:
+                self.send_encoded(other_socket, message)
+                continue
+            if singles is None:
+                singles = [EncodedMessage(self, 'BROADCAST_MSG', broadcast_data, compact_body=body)
+                           for broadcast_data, body in zip(batch, compact_bodies)]
+            for single in singles:
+                self.send_encoded(other_socket, single)
+
+    def add_remote_client(self, remote_key, client_info):
+        """Beitritt auf einem anderen Shard ins lokale Roster übernehmen"""
+        entry_json = json.dumps(self.user_entry(client_info)).encode('utf-8')
+        if self.clients.register(remote_key, client_info, entry_json, remote=True):
+            self.announce_presence(remote_key, client_info)
+
+    def remove_remote_client(self, nickname):
+        remote_key = self.clients.find(nickname)
+        if remote_key is None or remote_key in self.connections:
+            return
+        client_info = self.clients.unregister(remote_key)
+        if client_info is not None:
+            self.leave_rooms(remote_key)
+            self.announce_presence(remote_key, client_info, left=True)
+
+    def update_remote_room(self, room, nickname, left=False):
+        """Raumwechsel eines Clients auf einem anderen Shard übernehmen"""
+        remote_key = self.clients.find(nickname)
+        if remote_key is None or remote_key in self.connections:
+            return
+        if left:
+            client_info = self.rooms.leave(room, remote_key)
+            if client_info is not None:
+                self.announce_room(room, remote_key, client_info, left=True)
+            return
+        client_info = self.clients.remote_info(remote_key)
+        if client_info is not None and self.rooms.join(room, remote_key, client_info):
+            self.announce_room(room, remote_key, client_info)
+
+    def handle_join(self, client_socket, headers):
+        """Raum betreten; JOIN_OK enthält die übrigen Mitglieder, die ein ROOM_PRESENCE bekommen"""
+        client_info = self.clients.get(client_socket)
+        if client_info is None:
+            self.send_error(client_socket, "Nicht registriert", headers)
+            return
+        room = headers.get('Room', '')
+        if not valid_room(room):
+            self.send_error(client_socket, f"Ungültiger Raum: {room!r}", headers)
+            return
+
+        if self.rooms.join(room, client_socket, client_info):
+            self.announce_room(room, client_socket, client_info)
+            if self.bus is not None:
+                self.bus.publish('SHARD_ROOM_JOIN', {'room': room, 'nickname': client_info.nickname})
+        members = [self.user_entry(info) for member, info in self.rooms.members(room) if member != client_socket]
+        self.send_message(client_socket, 'JOIN_OK', {'room': room, 'members': members}, self.reply_headers(headers))
+
+    def handle_leave(self, client_socket, headers):
+        room = headers.get('Room', '')
+        client_info = self.rooms.leave(room, client_socket)
+        if client_info is None:
+            self.send_error(client_socket, f"Nicht im Raum: {room!r}", headers)
+            return
+        self.announce_room(room, client_socket, client_info, left=True)
+        if self.bus is not None:
+            self.bus.publish('SHARD_ROOM_LEAVE', {'room': room, 'nickname': client_info.nickname})
+        self.send_message(client_socket, 'LEAVE_OK', {'room': room}, self.reply_headers(headers))
+
+    def leave_rooms(self, client_socket):
+        """Beim Abmelden/Trennen alle Räume verlassen; andere Shards räumen bei SHARD_LEFT selbst auf"""
+        for room, client_info in self.rooms.leave_all(client_socket):
+            self.announce_room(room, client_socket, client_info, left=True)
+
+    def announce_room(self, room, client_socket, client_info, left=False):
+        """Beitritt/Abgang sofort an die übrigen Mitglieder des Raums melden"""
+        if left:
+            update = {'room': room, 'joined': [], 'left': [client_info.nickname]}
+        else:
+            update = {'room': room, 'joined': [self.user_entry(client_info)], 'left': []}
+        self.deliver_room(client_socket, room, EncodedMessage(self, 'ROOM_PRESENCE', update))
+
+    def handle_room_message(self, client_socket, headers, json_data):
+        room = headers.get('Room', '')
+        client_info = self.clients.get(client_socket)
+        if client_info is None or not self.rooms.is_member(room, client_socket):
+            self.send_error(client_socket, f"Nicht im Raum: {room!r}", headers)
+            return
+        room_data = {
+            'room': room,
+            'sender': client_info.nickname,
+            'message': json_data.get('message', ''),
             'timestamp': time.time()
         }
+        self.deliver_room_message(client_socket, room_data)
+        if self.bus is not None:
+            self.bus.publish('SHARD_ROOM_MSG', room_data)
+        self.send_message(client_socket, 'ROOM_MSG_OK', {'room': room}, self.reply_headers(headers))
+
+    def deliver_room_message(self, sender_socket, room_data):
+        self.deliver_room(sender_socket, room_data['room'], EncodedMessage(self, 'ROOM_MSG', room_data))
+
+    def deliver_room(self, sender_socket, room, message):
+        """Nachricht nur an die lokalen Mitglieder eines Raums verteilen, O(Raumgröße)"""
+        for member_socket, _ in self.rooms.members(room):
+            if member_socket != sender_socket:
+                self.send_encoded(member_socket, message)
+
+    def handle_stats(self, client_socket, headers):
+        """Zähler, Histogramme und Warteschlangen wie auf dem Scrape-Endpunkt /stats"""
+        self.send_message(client_socket, 'STATS_OK', self.metrics.snapshot(self), self.reply_headers(headers))
+
+    def handle_history(self, client_socket, headers):
+        """Gespeicherte Broadcasts ab Since (Offset) oder Since-Time (Zeitstempel) senden.
+
+        Die Nachrichten werden als fertige JSON-Bytes aus den Segmenten
+        übernommen und nur in das umschließende Objekt eingesetzt.
+        """
+        try:
+            limit = min(int(headers.get('Limit', 50)), self.HISTORY_LIMIT)
+            since = int(headers['Since']) if 'Since' in headers else None
+            since_time = float(headers['Since-Time']) if 'Since-Time' in headers else None
+        except ValueError:
+            self.send_error(client_socket, "Ungültige HISTORY-Parameter", headers)
+            return
+
+        if self.history is None or limit <= 0:
+            first = following = 0
+            messages = b''
+        else:
+            first, following, messages = self.history.read(since, since_time, limit)
+        body = b''.join((
+            f'{{"from": {first}, "next": {following}, "messages": ['.encode('utf-8'),
+            messages,
+            b']}'
+        ))
+        self.send_frame(client_socket, self.build_for(client_socket, 'HISTORY_OK', body, self.reply_headers(headers)),
+                        'HISTORY_OK')
+
+    def handle_search(self, client_socket, headers, json_data):
+        """Volltextsuche im Verlauf; Treffer kommen mit Absender, Zeitstempel und Bewertung"""
+        query = str(json_data.get('query', '')).strip()
+        try:
+            limit = min(int(headers.get('Limit', 20)), self.SEARCH_LIMIT)
+        except ValueError:
+            self.send_error(client_socket, "Ungültige SEARCH-Parameter", headers)
+            return
+        if not query:
+            self.send_error(client_socket, "Leere Suchanfrage", headers)
+            return
+
+        hits = []
+        if self.search_index is not None:
+            for offset, score in self.search_index.search(query, limit, self.history.first_offset):
+                body = self.history.get(offset)
+                if body is None:
+                    continue
+                hit = json.loads(body)
+                hit['score'] = round(score, 4)
+                hits.append(hit)
+        self.send_message(client_socket, 'SEARCH_OK', {'query': query, 'hits': hits}, self.reply_headers(headers))
+
+    def handle_get_users(self, client_socket, headers):
+        """Aktuelle Benutzerliste senden, mit Since/Epoch nur die Änderungen seitdem"""
+        try:
+            since = int(headers['Since']) if 'Since' in headers else None
+        except ValueError:
+            self.send_error(client_socket, "Ungültiger Since-Header", headers)
+            return
+
+        if since is not None and headers.get('Epoch') == self.clients.epoch:
+            delta = self.clients.changes_since(since)
+            if delta is not None:
+                self.send_roster_delta(client_socket, since, *delta, headers=headers)
+                return
+        self.send_user_list(client_socket, headers)
+
+    def send_user_list(self, client_socket, headers=None):
+        self.send_frame(client_socket, self.user_list_frame(client_socket, headers), 'USER_LIST',
+                        self.roster_queue_type(headers))
+
+    def roster_queue_type(self, headers):
+        return self.ROSTER_REPLY if headers and 'Request-ID' in headers else None
+
+    def user_list_frame(self, client_socket, headers=None):
+        """USER_LIST aus dem vorserialisierten Roster zusammensetzen"""
+        version, users = self.clients.roster_json(exclude=client_socket)
+        body = b''.join((
+            b'{"users": ', users,
+            f', "epoch": "{self.clients.epoch}", "version": {version}}}'.encode('utf-8')
+        ))
+        return self.build_for(client_socket, 'USER_LIST', body, self.reply_headers(headers))
+
+    def send_roster_delta(self, client_socket, since, version, changes, headers=None):
+        own = self.nickname_of(client_socket)
+        joined = []
+        left = []
+        for nickname, client_info in changes.items():
+            if nickname == own:
+                continue
+            if client_info is None:
+                left.append(nickname)
+            else:
+                joined.append(self.user_entry(client_info))
+
+        response_data = {
+            'epoch': self.clients.epoch,
+            'from_version': since,
+            'version': version,
+            'joined': joined,
+            'left': left
+        }
+        self.send_message(client_socket, 'USER_DELTA', response_data, self.reply_headers(headers),
+                          self.roster_queue_type(headers))
+
+    def user_entry(self, client_info):
+        return {
+            'nickname': client_info.nickname,
+            'ip': client_info.ip,
+            'udp_port': client_info.udp_port
+        }
 
-        for client_socket, client_info in self.clients.items():
-            if client_socket != exclude:
-                self.send_message(client_socket, update_type, update_data)
+    def announce_presence(self, client_socket, client_info, left=False):
+        """Beitritt/Abgang für das nächste gesammelte PRESENCE vormerken"""
+        with self._presence_lock:
+            pending = self._presence.get(client_info.nickname)
+            if pending is None:
+                # war_vorher_da: der Nickname war beim letzten PRESENCE schon bekannt
+                pending = self._presence[client_info.nickname] = [left, None, None]
+            pending[1] = client_socket
+            pending[2] = None if left else client_info
+            if self._presence_due is None:
+                self._presence_due = time.time() + self.presence_interval
 
-    def send_error(self, client_socket, error_message):
+        if self.presence_interval <= 0:
+            self.flush_presence()
+
+    def flush_presence(self):
+        """Gesammelte Beitritte/Abgänge einmal kodieren und an alle verteilen.
+
+        Clients mit "Presence: batch" bekommen ein PRESENCE pro Fenster, ältere
+        Clients weiterhin einzelne USER_JOINED/USER_LEFT.
+        """
+        with self._presence_lock:
+            pending, self._presence = self._presence, {}
+            self._presence_due = None
+            from_version = self._presence_from
+            self._presence_from = self.clients.version
+
+        joined = []
+        left = []
+        legacy = []  # (EncodedMessage, betroffener Socket)
+        timestamp = time.time()
+        # Wer im selben Fenster beigetreten und wieder gegangen ist, taucht gar nicht auf
+        for nickname, (existed, subject_socket, client_info) in pending.items():
+            if client_info is not None:
+                entry = self.user_entry(client_info)
+                joined.append(entry)
+                legacy.append((EncodedMessage(self, 'USER_JOINED', dict(entry, timestamp=timestamp)), subject_socket))
+            elif existed:
+                left.append(nickname)
+                update_data = {'nickname': nickname, 'ip': '', 'udp_port': 0, 'timestamp': timestamp}
+                legacy.append((EncodedMessage(self, 'USER_LEFT', update_data), subject_socket))
+
+        if not joined and not left:
+            return
+
+        presence = EncodedMessage(self, 'PRESENCE', {
+            'epoch': self.clients.epoch,
+            'from_version': from_version,
+            'version': self._presence_from,
+            'joined': joined,
+            'left': left
+        })
+        for client_socket, _ in self.clients.snapshot():
+            connection = self.connections.get(client_socket)
+            if connection is None:
+                continue
+            if connection.batched_presence:
+                self.send_encoded(client_socket, presence)
+                continue
+            for message, subject_socket in legacy:
+                if client_socket != subject_socket:
+                    self.send_encoded(client_socket, message)
+
+    def send_error(self, client_socket, error_message, headers=None, code=None, additional_headers=None):
         error_data = {
             'message': error_message
         }
-        self.send_message(client_socket, 'ERROR', error_data)
+        if code is not None:
+            # Maschinenlesbarer Fehlertyp, z.B. 'rate_limited'
+            error_data['code'] = code
+        self.send_message(client_socket, 'ERROR', error_data, self.reply_headers(headers, additional_headers))
 
     def disconnect_client(self, client_socket):
-        if client_socket in self.clients:
-            client_info = self.clients[client_socket]
+        client_info = self.clients.unregister(client_socket)
+        if client_info is not None:
             nickname = client_info.nickname
 
-            del self.clients[client_socket]
+            self.leave_rooms(client_socket)
+            self.announce_presence(client_socket, client_info, left=True)
+            if self.bus is not None:
+                self.bus.release(nickname)
 
-            self.broadcast_user_update('USER_LEFT', nickname, '', 0, exclude=client_socket)
+            log.info("Client %s getrennt", nickname)
 
-            print(f"Client {nickname} getrennt")
+        connection = self.connections.pop(client_socket, None)
+        if connection is not None:
+            self.timers.cancel(connection)
+            self.metrics.record_closed(connection)
+            connection.close()
+            self._dirty.discard(connection)
+            self._closing.discard(connection)
+            if self.selector is not None:
+                try:
+                    self.selector.unregister(client_socket)
+                except Exception:
+                    pass
 
         try:
             client_socket.close()
@@ -271,15 +1281,124 @@ class GroupChatServer:
         self.running = False
         if self.server_socket:
             self.server_socket.close()
+        if self.bus is not None:
+            self.bus.close()
+        if self.metrics_endpoint is not None:
+            self.metrics_endpoint.stop()
+            self.metrics_endpoint = None
+        if self.indexer is not None:
+            self.indexer.stop()
+        if self.history is not None:
+            self.history.close()
+
+
+def run_worker(server_options, log_level):
+    configure_logging(log_level)
+    server = GroupChatServer(**server_options)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+def serve_sharded(server_options, workers, log_level='INFO'):
+    """workers Server-Prozesse auf demselben Port (SO_REUSEPORT), verbunden über einen ShardHub"""
+    bus_dir = tempfile.mkdtemp(prefix='chatroom-')
+    bus_path = os.path.join(bus_dir, 'bus.sock')
+    hub = ShardHub(bus_path)
+    server_options = dict(server_options, reuse_port=True, bus_path=bus_path)
+    metrics_port = server_options.get('metrics_port')
+    history_dir = server_options.get('history_dir')
+
+    processes = []
+    for index in range(workers):
+        if metrics_port is not None:
+            # Jeder Worker hat seine eigenen Zähler und damit seinen eigenen Port
+            server_options = dict(server_options, metrics_port=metrics_port + index)
+        if history_dir is not None:
+            # Jeder Worker führt einen vollständigen Verlauf mit eigenen Offsets
+            server_options = dict(server_options, history_dir=os.path.join(history_dir, f"worker-{index}"))
+        process = multiprocessing.Process(target=run_worker, args=(server_options, log_level), daemon=True)
+        process.start()
+        processes.append(process)
+    log.info("%s Worker gestartet, Shard-Bus auf %s", workers, bus_path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: hub.stop())
+
+    try:
+        hub.serve()
+    except KeyboardInterrupt:
+        log.info("Server wird beendet...")
+    finally:
+        hub.stop()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        os.unlink(bus_path)
+        os.rmdir(bus_dir)
+        log.info("Server beendet")
+
 
 def main():
-    server = GroupChatServer()
+    parser = argparse.ArgumentParser(description="Gruppenchat-Server")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--mode', choices=GroupChatServer.MODES, default='threaded',
+                        help="threaded: ein Thread pro Client, selector: ein Event-Loop für alle")
+    parser.add_argument('--send-buffer-limit', type=int, default=256 * 1024,
+                        help="High-Water-Mark der Sendewarteschlange pro Client in Bytes")
+    parser.add_argument('--slow-consumer-policy', choices=GroupChatServer.SLOW_CONSUMER_POLICIES,
+                        default='drop_oldest')
+    parser.add_argument('--presence-interval', type=float, default=0.2,
+                        help="Sammelfenster für Beitritte/Abgänge in Sekunden (0 = sofort)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Anzahl Server-Prozesse auf demselben Port (1 = kein Sharding)")
+    parser.add_argument('--metrics-port', type=int,
+                        help="HTTP-Endpunkt /metrics und /stats auf 127.0.0.1 (Worker i: Port + i)")
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO',
+                        help="DEBUG protokolliert auch jede Verbindung und jeden Broadcast")
+    parser.add_argument('--history-dir',
+                        help="Broadcasts in diesem Verzeichnis speichern und per HISTORY ausliefern")
+    parser.add_argument('--history-retention-mb', type=int, default=256,
+                        help="Ältere Segmente löschen, sobald der Verlauf größer ist")
+    parser.add_argument('--history-retention-hours', type=float, default=7 * 24,
+                        help="Segmente löschen, deren letzte Nachricht älter ist")
+    parser.add_argument('--ping-interval', type=float, default=30.0,
+                        help="PING an Clients, von denen so viele Sekunden nichts kam")
+    parser.add_argument('--idle-timeout', type=float, default=90.0,
+                        help="Clients nach so vielen Sekunden ohne Lebenszeichen trennen")
+    parser.add_argument('--rate-limit', type=parse_rate_limits,
+                        help="Limits pro Client ersetzen, z.B. BROADCAST=50/200,GET_USERS=5/20 "
+                             "(Nachrichten/s und Burst), none = ohne Limits")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    server_options = {
+        'host': args.host,
+        'port': args.port,
+        'mode': args.mode,
+        'send_buffer_limit': args.send_buffer_limit,
+        'slow_consumer_policy': args.slow_consumer_policy,
+        'presence_interval': args.presence_interval,
+        'metrics_port': args.metrics_port,
+        'history_dir': args.history_dir,
+        'history_retention_bytes': args.history_retention_mb * 1024 * 1024,
+        'history_retention_seconds': args.history_retention_hours * 3600,
+        'ping_interval': args.ping_interval,
+        'idle_timeout': args.idle_timeout,
+        'rate_limits': args.rate_limit
+    }
+    if args.workers > 1:
+        serve_sharded(server_options, args.workers, args.log_level)
+        return
+
+    server = GroupChatServer(**server_options)
     try:
         server.start()
     except KeyboardInterrupt:
-        print("\nServer wird beendet...")
+        log.info("Server wird beendet...")
         server.stop()
-        print("Server beendet")
+        log.info("Server beendet")
 
 
 if __name__ == "__main__":
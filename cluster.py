@@ -0,0 +1,259 @@
+import json
+import logging
+import selectors
+import socket
+import threading
+
+from common import PROTOCOL_V2, FrameDecoder, encode_body, encode_frame, read_frame
+from registry import ClientSession
+
+log = logging.getLogger('chatroom.cluster')
+
+
+def bus_frame(message_type, json_data):
+    """Nachricht auf dem Shard-Bus: binärer 2.0-Frame mit kompaktem JSON-Body"""
+    return encode_frame(message_type, PROTOCOL_V2, None, encode_body(json_data, PROTOCOL_V2))
+
+
+class RemoteClient:
+    """Platzhalter-Schlüssel im ClientRegistry für einen Client auf einem anderen Shard"""
+    __slots__ = ('nickname',)
+
+    def __init__(self, nickname):
+        self.nickname = nickname
+
+    def __repr__(self):
+        return f"RemoteClient({self.nickname!r})"
+
+
+class ShardHub:
+    """Vermittler zwischen den Worker-Prozessen über einen Unix-Socket.
+
+    Der Hub vergibt Nicknames für alle Shards (SHARD_CLAIM -> SHARD_GRANT
+    oder SHARD_DENY) und leitet Beitritte, Abgänge, Broadcasts und
+    Raumereignisse an die jeweils anderen Shards weiter. Da er jede
+    Nachricht in Eingangsreihenfolge weiterreicht, sieht jeder Shard das
+    SHARD_LEFT eines Nicknames vor einem erneuten SHARD_JOINED. Bricht ein Worker weg, gibt der Hub dessen
+    Nicknames frei.
+
+    Alle Sockets sind nicht-blockierend mit eigenem Ausgangspuffer, damit
+    ein voller Worker den Hub nicht anhält.
+    """
+
+    RELAYED = ('SHARD_BROADCAST', 'SHARD_BROADCAST_BATCH', 'SHARD_ROOM_JOIN', 'SHARD_ROOM_LEAVE', 'SHARD_ROOM_MSG')
+
+    def __init__(self, path):
+        self.path = path
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, None)
+        self.peers = {}  # {socket: [FrameDecoder, bytearray ausstehend]}
+        self.nicknames = {}  # {nickname: (socket des Shards, Listeneintrag)}
+        self.running = False
+
+    def serve(self):
+        self.running = True
+        while self.running:
+            for key, events in self.selector.select(timeout=1.0):
+                if key.data is None:
+                    self.accept()
+                    continue
+                if events & selectors.EVENT_READ:
+                    self.read(key.fileobj)
+                if events & selectors.EVENT_WRITE and key.fileobj in self.peers:
+                    self.flush(key.fileobj)
+
+    def accept(self):
+        try:
+            peer, _ = self.listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        peer.setblocking(False)
+        self.peers[peer] = [FrameDecoder(), bytearray()]
+        self.selector.register(peer, selectors.EVENT_READ, peer)
+        # Neuer oder neu gestarteter Shard: bestehende Nicknames nachliefern
+        for _, entry in self.nicknames.values():
+            self.send(peer, bus_frame('SHARD_JOINED', entry))
+
+    def read(self, peer):
+        decoder = self.peers[peer][0]
+        try:
+            received = decoder.recv_from(peer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            received = 0
+        if not received:
+            self.drop(peer)
+            return
+
+        for message_type, _, body in decoder.frames():
+            json_data = json.loads(body) if body else {}
+            if message_type == 'SHARD_CLAIM':
+                self.claim(peer, json_data)
+            elif message_type == 'SHARD_LEFT':
+                owner = self.nicknames.get(json_data.get('nickname'))
+                if owner is not None and owner[0] is peer:
+                    del self.nicknames[json_data['nickname']]
+                    self.relay(peer, bus_frame('SHARD_LEFT', json_data))
+            elif message_type in self.RELAYED:
+                self.relay(peer, encode_frame(message_type, PROTOCOL_V2, None, body.encode('utf-8')))
+
+    def claim(self, peer, json_data):
+        entry = json_data['entry']
+        nickname = entry['nickname']
+        if nickname in self.nicknames:
+            self.send(peer, bus_frame('SHARD_DENY', {'nickname': nickname}))
+            return
+        self.nicknames[nickname] = (peer, entry)
+        self.send(peer, bus_frame('SHARD_GRANT', {'nickname': nickname}))
+        self.relay(peer, bus_frame('SHARD_JOINED', entry))
+
+    def relay(self, origin, frame):
+        for peer in list(self.peers):
+            if peer is not origin:
+                self.send(peer, frame)
+
+    def send(self, peer, frame):
+        pending = self.peers[peer][1]
+        was_empty = not pending
+        pending += frame
+        if was_empty:
+            self.flush(peer)
+
+    def flush(self, peer):
+        pending = self.peers[peer][1]
+        try:
+            while pending:
+                count = peer.send(pending)
+                del pending[:count]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.drop(peer)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if pending else 0)
+        self.selector.modify(peer, events, peer)
+
+    def drop(self, peer):
+        if self.peers.pop(peer, None) is None:
+            return
+        self.selector.unregister(peer)
+        peer.close()
+        for nickname, (owner, _) in list(self.nicknames.items()):
+            if owner is peer:
+                del self.nicknames[nickname]
+                self.relay(peer, bus_frame('SHARD_LEFT', {'nickname': nickname}))
+
+    def stop(self):
+        self.running = False
+
+
+class ShardBus:
+    """Verbindung eines Worker-Prozesses zum ShardHub.
+
+    Im Threaded-Modus liest ein eigener Thread den Bus (run), im
+    Selector-Modus liegt der Socket im Selector des Servers und wird bei
+    Lesbarkeit mit read() abgearbeitet. Der Socket bleibt blockierend;
+    geschrieben wird unter einem Lock, weil mehrere Handler-Threads
+    gleichzeitig veröffentlichen können.
+    """
+
+    def __init__(self, path, server):
+        self.server = server
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.decoder = FrameDecoder()
+        self._send_lock = threading.Lock()
+        self._claims_lock = threading.Lock()
+        self._claims = {}  # {nickname: callback(granted)}
+
+    def publish(self, message_type, json_data):
+        frame = bus_frame(message_type, json_data)
+        with self._send_lock:
+            self.socket.sendall(frame)
+
+    def claim(self, entry, callback):
+        """Nickname clusterweit reservieren; callback(granted) kommt aus dem Bus-Leser"""
+        with self._claims_lock:
+            if entry['nickname'] in self._claims:
+                granted = False
+            else:
+                self._claims[entry['nickname']] = callback
+                granted = None
+        if granted is None:
+            self.publish('SHARD_CLAIM', {'entry': entry})
+        else:
+            callback(granted)
+
+    def release(self, nickname):
+        self.publish('SHARD_LEFT', {'nickname': nickname})
+
+    def broadcast(self, broadcast_data):
+        self.publish('SHARD_BROADCAST', broadcast_data)
+
+    def broadcast_batch(self, batch):
+        self.publish('SHARD_BROADCAST_BATCH', {'messages': batch})
+
+    def run(self):
+        """Bus im eigenen Thread lesen (Threaded-Modus)"""
+        while True:
+            try:
+                message_type, _, body = read_frame(self.socket, self.decoder)
+            except OSError:
+                message_type = None
+            if not message_type:
+                self.lost()
+                return
+            self.handle(message_type, json.loads(body) if body else {})
+
+    def read(self):
+        """Vorhandene Nachrichten abarbeiten, nachdem der Selector den Socket als lesbar meldet"""
+        try:
+            received = self.decoder.recv_from(self.socket)
+        except OSError:
+            received = 0
+        if not received:
+            self.lost()
+            return
+        for message_type, _, body in self.decoder.frames():
+            self.handle(message_type, json.loads(body) if body else {})
+
+    def lost(self):
+        """Ohne Hub ist die Eindeutigkeit der Nicknames nicht mehr gesichert: Worker beenden"""
+        if self.server.running:
+            log.error("Verbindung zum Shard-Hub verloren, Worker wird beendet")
+            self.server.stop()
+
+    def handle(self, message_type, json_data):
+        if message_type in ('SHARD_GRANT', 'SHARD_DENY'):
+            with self._claims_lock:
+                callback = self._claims.pop(json_data.get('nickname'), None)
+            if callback is not None:
+                callback(message_type == 'SHARD_GRANT')
+        elif message_type == 'SHARD_JOINED':
+            client_info = ClientSession(json_data['nickname'], json_data['ip'], json_data['udp_port'])
+            self.server.add_remote_client(RemoteClient(client_info.nickname), client_info)
+        elif message_type == 'SHARD_LEFT':
+            self.server.remove_remote_client(json_data['nickname'])
+        elif message_type == 'SHARD_BROADCAST':
+            self.server.deliver_broadcast(None, json_data)
+        elif message_type == 'SHARD_BROADCAST_BATCH':
+            self.server.deliver_batch(None, json_data['messages'])
+        elif message_type in ('SHARD_ROOM_JOIN', 'SHARD_ROOM_LEAVE'):
+            self.server.update_remote_room(json_data['room'], json_data['nickname'],
+                                           left=message_type == 'SHARD_ROOM_LEAVE')
+        elif message_type == 'SHARD_ROOM_MSG':
+            self.server.deliver_room_message(None, json_data)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        try:
+            self.socket.close()
+        except OSError:
+            pass
@@ -1,3 +1,10 @@
+import functools
+import json
+import socket
+import struct
+import zlib
+
+
 class ClientInfo:
     def __init__(self, nickname=None, ip=None, udp_port=None):
         self.nickname = nickname
@@ -22,3 +29,395 @@ class ClientInfo:
     def from_message(msg):
         _, nickname, ip, port = msg.split()
         return ClientInfo(nickname, ip, int(port))
+
+
+RECV_SIZE = 65536
+MAX_BODY_SIZE = 16 * 1024 * 1024  # größerer Body (Content-Length bzw. Längenfeld) beendet den Stream
+MAX_IOV = 1024  # höchstens so viele Puffer pro sendmsg (IOV_MAX unter Linux)
+GATHER_THRESHOLD = 4096  # kleinere Frames werden einmal zusammenhängend kodiert statt als Kopf + Body
+
+PROTOCOL_V1 = "1.0"
+PROTOCOL_V2 = "2.0"
+
+# Protokoll 2.0: binärer Frame-Header statt Text-Headern.
+# magic (0xB2) | Typ-Code | Länge Header-Block (u16) | Länge Body (u32) | Header-Block | Body
+# Header-Block: pro Header Schlüssel-Code (u8, 0 = Schlüssel folgt als u8-Länge + Text)
+# und Wert als u16-Länge + UTF-8. Typ-Code 0: Typname steht als u8-Länge + Text vorne im Block.
+# Neue Typen und Header nur hinten anhängen, die Codes sind Teil des Protokolls.
+BINARY_MAGIC = 0xB2
+BINARY_HEADER = struct.Struct('!BBHI')
+MESSAGE_TYPES = (
+    'REGISTER', 'REGISTER_OK', 'UNREGISTER', 'UNREGISTER_OK', 'GET_USERS', 'USER_LIST', 'USER_DELTA',
+    'PRESENCE', 'USER_JOINED', 'USER_LEFT', 'BROADCAST', 'BROADCAST_MSG', 'BROADCAST_OK', 'ERROR',
+    'CHAT_REQUEST', 'CHAT_RESPONSE', 'CHAT_HELLO', 'CHAT_MSG', 'CHAT_CLOSE', 'STATS', 'STATS_OK',
+    'HISTORY', 'HISTORY_OK', 'SEARCH', 'SEARCH_OK', 'CHAT_OPEN', 'JOIN', 'JOIN_OK', 'LEAVE', 'LEAVE_OK',
+    'ROOM_MSG', 'ROOM_MSG_OK', 'ROOM_PRESENCE', 'BATCH', 'BATCH_OK', 'BROADCAST_BATCH', 'PING', 'PONG'
+)
+MESSAGE_CODES = {message_type: code for code, message_type in enumerate(MESSAGE_TYPES, 1)}
+HEADER_KEYS = ('Host', 'From', 'To', 'Request-ID', 'Timestamp', 'Presence', 'Since', 'Epoch', 'Protocol-Version',
+               'Since-Time', 'Limit', 'Content-Encoding', 'Accept-Encoding', 'Stream-ID', 'Room', 'Batch',
+               'Keepalive', 'Retry-After')
+HEADER_CODES = {key: code for code, key in enumerate(HEADER_KEYS, 1)}
+
+# Content-Encoding: Bodies ab COMPRESSION_THRESHOLD Bytes werden komprimiert, sofern die
+# Gegenseite den Codec per Accept-Encoding angeboten hat. Ein Codec besteht aus
+# compress(data) und decompress(data, max_size); weitere mit register_codec eintragen.
+COMPRESSION_THRESHOLD = 1024
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+CODECS = {}
+
+
+def register_codec(name, compress, decompress):
+    CODECS[name] = (compress, decompress)
+
+
+def _deflate(data):
+    compressor = zlib.compressobj(wbits=-15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _inflater(wbits):
+    def decompress(data, max_size):
+        decompressor = zlib.decompressobj(wbits)
+        result = decompressor.decompress(data, max_size)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Entpackter Body zu groß")
+        return result
+    return decompress
+
+
+register_codec('zlib', zlib.compress, _inflater(15))
+register_codec('deflate', _deflate, _inflater(-15))
+
+
+def accepted_encodings(header_value):
+    """Bekannte Codecs aus einem Accept-Encoding-Header, in der angegebenen Reihenfolge"""
+    if not header_value:
+        return []
+    return [name for name in (part.strip() for part in header_value.split(',')) if name in CODECS]
+
+
+def compress_body(body, content_encoding, threshold=COMPRESSION_THRESHOLD):
+    """(Body, verwendetes Content-Encoding oder None); klein oder unkomprimierbar bleibt roh"""
+    if content_encoding is None or len(body) < threshold:
+        return body, None
+    compressed = CODECS[content_encoding][0](body)
+    if len(compressed) >= len(body):
+        return body, None
+    return compressed, content_encoding
+
+
+def decompress_body(body, content_encoding, max_size=MAX_DECOMPRESSED_SIZE):
+    if content_encoding == 'identity':
+        return body
+    codec = CODECS.get(content_encoding)
+    if codec is None:
+        raise ValueError(f"Unbekanntes Content-Encoding: {content_encoding}")
+    return codec[1](body, max_size)
+
+
+def encode_body(json_data, protocol_version=PROTOCOL_V1):
+    """JSON-Body serialisieren; Protokoll 2.0 ohne Leerzeichen"""
+    if not json_data:
+        return b''
+    if protocol_version == PROTOCOL_V2:
+        return json.dumps(json_data, separators=(',', ':')).encode('utf-8')
+    return json.dumps(json_data).encode('utf-8')
+
+
+def parse_header_block(header_text):
+    """Startzeile und Header einer Text-Nachricht parsen: (message_type, protocol_version, headers)"""
+    header_lines = header_text.split('\r\n')
+    first_line = header_lines[0].split()
+    if len(first_line) != 2:
+        raise ValueError(f"Ungültige Startzeile: {header_lines[0]!r}")
+
+    headers = {}
+    for line in header_lines[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip()] = value.strip()
+
+    return first_line[0], first_line[1], headers
+
+
+class Frame:
+    """Kodierte Nachricht für sendmsg: große Bodies werden nie hinter den Kopf kopiert.
+
+    Ab GATHER_THRESHOLD Bytes bleiben Kopf und Body getrennte Puffer, der
+    Body (Verlauf, Fan-out an viele Empfänger) geht ohne Kopie an sendmsg.
+    Kleinere Frames liegen zusätzlich zusammenhängend in data, ein kurzer
+    memcpy beim Kodieren ist billiger als zwei iovec-Einträge pro Empfänger.
+    len() zählt die Bytes auf der Leitung.
+    """
+    __slots__ = ('head', 'body', 'size', 'data')
+
+    def __init__(self, head, body=b''):
+        self.head = head
+        self.body = body
+        self.size = len(head) + len(body)
+        self.data = head + body if self.size < GATHER_THRESHOLD else None
+
+    def __len__(self):
+        return self.size
+
+    def __bytes__(self):
+        return self.data if self.data is not None else self.head + self.body
+
+    def buffers(self):
+        return (self.data,) if self.data is not None else (self.head, self.body)
+
+
+@functools.lru_cache(maxsize=512)
+def frame_prefix(message_type, protocol_version, static_headers=()):
+    """Startzeile bzw. Typ-Code-Teil des Header-Blocks samt fester Header, einmal pro Kombination kodiert"""
+    if protocol_version == PROTOCOL_V2:
+        block = bytearray()
+        if not MESSAGE_CODES.get(message_type, 0):
+            name = message_type.encode('utf-8')
+            block.append(len(name))
+            block += name
+        encode_binary_headers(block, static_headers)
+        return bytes(block)
+    # Text bleibt str, damit der ganze Kopf nur einmal kodiert wird
+    lines = [f"{message_type} {protocol_version}\r\n"]
+    lines.extend(f"{key}: {value}\r\n" for key, value in static_headers)
+    return ''.join(lines)
+
+
+def encode_binary_headers(block, headers):
+    for key, value in headers:
+        key_code = HEADER_CODES.get(key, 0)
+        block.append(key_code)
+        if not key_code:
+            key_bytes = key.encode('utf-8')
+            block.append(len(key_bytes))
+            block += key_bytes
+        value_bytes = str(value).encode('utf-8')
+        block += len(value_bytes).to_bytes(2, 'big')
+        block += value_bytes
+
+
+def encode_frame_parts(message_type, protocol_version, headers=None, body=b'', content_encoding=None,
+                       static_headers=()):
+    """Nachricht als Frame(Kopf, Body) kodieren, Body ggf. komprimiert.
+
+    static_headers sind (Schlüssel, Wert)-Paare, die für viele Nachrichten
+    gleich bleiben (z.B. Host); sie landen im zwischengespeicherten Präfix,
+    nur headers wird pro Nachricht kodiert.
+    """
+    if content_encoding is not None:
+        body, content_encoding = compress_body(body, content_encoding)
+        if content_encoding is not None:
+            headers = dict(headers or {}, **{'Content-Encoding': content_encoding})
+    prefix = frame_prefix(message_type, protocol_version, static_headers)
+    if protocol_version == PROTOCOL_V2:
+        if headers:
+            block = bytearray(prefix)
+            encode_binary_headers(block, headers.items())
+        else:
+            block = prefix
+        head = BINARY_HEADER.pack(BINARY_MAGIC, MESSAGE_CODES.get(message_type, 0), len(block), len(body)) + block
+        return Frame(head, body)
+
+    text = prefix
+    if headers:
+        for key, value in headers.items():
+            text += f"{key}: {value}\r\n"
+    return Frame(f"{text}Content-Length: {len(body)}\r\n\r\n".encode('utf-8'), body)
+
+
+def encode_frame(message_type, protocol_version, headers=None, body=b'', content_encoding=None):
+    """Nachricht einmalig in unveränderliche Bytes serialisieren, Body ggf. komprimiert"""
+    return bytes(encode_frame_parts(message_type, protocol_version, headers, body, content_encoding))
+
+
+def encode_binary_frame(message_type, headers=None, body=b''):
+    return bytes(encode_frame_parts(message_type, PROTOCOL_V2, headers, body))
+
+
+def set_nodelay(sock):
+    """Kleine Frames sofort senden statt auf Nagle zu warten"""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+
+def set_keepalive(sock, idle, interval=10, count=3):
+    """TCP-Keepalive des Kernels: nach idle Sekunden Stille count Proben im Abstand interval.
+
+    Für Gegenseiten ohne PING/PONG; eine verschwundene Gegenstelle lässt
+    dann recv mit einem Fehler zurückkehren statt ewig zu warten.
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(idle)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(interval)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    except OSError:
+        pass
+
+
+def set_cork(sock, corked):
+    """TCP_CORK (nur Linux): solange gesetzt, gehen nur volle Segmente hinaus; Lösen sendet den Rest"""
+    if not hasattr(socket, 'TCP_CORK'):
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if corked else 0)
+    except OSError:
+        pass
+
+
+def send_buffers(sock, buffers):
+    """Puffer mit einem Systemaufruf schreiben (writev); ein einzelner Puffer per send, das ist billiger"""
+    if len(buffers) == 1:
+        return sock.send(buffers[0])
+    return sock.sendmsg(buffers)
+
+
+def advance_buffers(buffers, count):
+    """Nach einem teilweisen sendmsg die noch nicht gesendeten Puffer (ggf. als memoryview-Rest) liefern"""
+    for index, buffer in enumerate(buffers):
+        if count < len(buffer):
+            rest = [memoryview(buffer)[count:]] if count else [buffer]
+            return rest + list(buffers[index + 1:])
+        count -= len(buffer)
+    return []
+
+
+def parse_binary_header_block(code, block):
+    """(message_type, headers) aus einem binären Header-Block"""
+    position = 0
+    if code:
+        message_type = MESSAGE_TYPES[code - 1]
+    else:
+        length = block[0]
+        message_type = bytes(block[1:1 + length]).decode('utf-8')
+        position = 1 + length
+
+    headers = {}
+    end = len(block)
+    while position < end:
+        key_code = block[position]
+        position += 1
+        if key_code:
+            key = HEADER_KEYS[key_code - 1]
+        else:
+            length = block[position]
+            key = bytes(block[position + 1:position + 1 + length]).decode('utf-8')
+            position += 1 + length
+        length = int.from_bytes(block[position:position + 2], 'big')
+        headers[key] = bytes(block[position + 2:position + 2 + length]).decode('utf-8')
+        position += 2 + length
+
+    return message_type, headers
+
+
+class FrameDecoder:
+    """Inkrementeller Parser für Header-basierte Nachrichten eines Streams.
+
+    Gelesen wird blockweise in einen wiederverwendbaren Puffer; angefangene
+    Nachrichten bleiben im Puffer, bis der Rest eintrifft. Mehrere Decoder,
+    die im selben Thread lesen, können sich über recv_view einen Lesepuffer teilen.
+    """
+
+    def __init__(self, recv_view=None, recv_size=16384, max_header_size=65536, max_body_size=MAX_BODY_SIZE):
+        self.recv_size = recv_size
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.buffer = bytearray()
+        self.offset = 0
+        self._scan_from = 0
+        self._pending = None  # (message_type, headers, body_start, frame_end, version)
+        self._recv_view = recv_view
+        self.version = None  # Protokollversion der zuletzt gelieferten Nachricht
+        self.frame_size = 0  # Größe der zuletzt gelieferten Nachricht in Bytes
+
+    def feed(self, data):
+        self.buffer += data
+
+    def recv_from(self, sock):
+        """Einmal vom Socket lesen; 0 bedeutet, dass die Gegenseite geschlossen hat"""
+        if self._recv_view is None:
+            self._recv_view = memoryview(bytearray(self.recv_size))
+        received = sock.recv_into(self._recv_view)
+        if received:
+            self.buffer += self._recv_view[:received]
+        return received
+
+    def next_frame(self):
+        """Nächste vollständige Nachricht als (message_type, headers, body) oder None"""
+        if self._pending is None and len(self.buffer) > self.offset and self.buffer[self.offset] == BINARY_MAGIC:
+            if len(self.buffer) - self.offset < BINARY_HEADER.size:
+                return None
+            _, code, header_length, body_length = BINARY_HEADER.unpack_from(self.buffer, self.offset)
+            if body_length > self.max_body_size:
+                raise ValueError(f"Body zu groß: {body_length} Bytes")
+            block_start = self.offset + BINARY_HEADER.size
+            body_start = block_start + header_length
+            if len(self.buffer) < body_start:
+                return None
+            message_type, headers = parse_binary_header_block(code, memoryview(self.buffer)[block_start:body_start])
+            self._pending = (message_type, headers, body_start, body_start + body_length, PROTOCOL_V2)
+
+        if self._pending is None:
+            start = max(self.offset, self._scan_from)
+            header_end = self.buffer.find(b'\r\n\r\n', start)
+            if header_end < 0:
+                if len(self.buffer) - self.offset > self.max_header_size:
+                    raise ValueError("Header zu groß")
+                # Beim nächsten Mal nur die neuen Bytes durchsuchen
+                self._scan_from = max(self.offset, len(self.buffer) - 3)
+                return None
+
+            header_text = self.buffer[self.offset:header_end].decode('utf-8')
+            message_type, version, headers = parse_header_block(header_text)
+            content_length = int(headers.get('Content-Length', 0))
+            if content_length < 0:
+                raise ValueError(f"Ungültige Content-Length: {content_length}")
+            if content_length > self.max_body_size:
+                raise ValueError(f"Body zu groß: {content_length} Bytes")
+            body_start = header_end + 4
+            self._pending = (message_type, headers, body_start, body_start + content_length, version)
+
+        message_type, headers, body_start, frame_end, version = self._pending
+        if len(self.buffer) < frame_end:
+            return None
+
+        body = self.buffer[body_start:frame_end]
+        if 'Content-Encoding' in headers:
+            body = decompress_body(body, headers['Content-Encoding'])
+        body = body.decode('utf-8')
+        self._pending = None
+        self.version = version
+        self.frame_size = frame_end - self.offset
+        self.offset = frame_end
+        self._compact()
+        return message_type, headers, body
+
+    def frames(self):
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+    def _compact(self):
+        if self.offset == len(self.buffer):
+            self.buffer.clear()
+            self.offset = 0
+        elif self.offset >= RECV_SIZE:
+            del self.buffer[:self.offset]
+            self.offset = 0
+        self._scan_from = self.offset
+
+
+def read_frame(sock, decoder):
+    """Blockierend bis zur nächsten vollständigen Nachricht lesen"""
+    while True:
+        frame = decoder.next_frame()
+        if frame is not None:
+            return frame
+        if not decoder.recv_from(sock):
+            return None, None, None
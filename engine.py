@@ -0,0 +1,913 @@
+import asyncio
+import collections
+import itertools
+import json
+import random
+import socket
+import time
+
+from common import (CODECS, PROTOCOL_V1, PROTOCOL_V2, RECV_SIZE, FrameDecoder, accepted_encodings, encode_body,
+                    encode_frame, encode_frame_parts)
+from handshake import HandshakeTracker
+from timers import TimerWheel
+
+
+SERVER_TIMER = 'server'  # Schlüssel der Serververbindung im TimerWheel
+
+
+class PeerLink:
+    """Dauerhafte TCP-Verbindung zu einem Peer, über die nacheinander oder parallel mehrere Chats laufen.
+
+    Jeder Chat ist ein Stream mit eigener Stream-ID. Die verbindende Seite
+    vergibt ungerade, die annehmende gerade IDs, sodass beide ohne Absprache
+    neue Streams öffnen können. Ohne Stream-ID im CHAT_HELLO (ältere Peers)
+    gilt die alte Regel: ein Chat pro Verbindung.
+    """
+
+    def __init__(self, reader, writer, nickname, connected, multiplexed, decoder=None):
+        self.reader = reader
+        self.writer = writer
+        self.nickname = nickname
+        self.multiplexed = multiplexed
+        self.decoder = decoder or FrameDecoder()
+        self.protocol_version = PROTOCOL_V1  # per CHAT_HELLO ausgehandelt
+        self.content_encoding = None  # aus Accept-Encoding von CHAT_REQUEST bzw. CHAT_HELLO
+        self.streams = set()  # offene Stream-IDs
+        self.next_stream = 1 if connected else 2
+        self.keepalive = False  # beide Seiten beantworten PING (Keepalive-Header im Handshake)
+        self.last_active = time.monotonic()  # letzte Chat-Nachricht in eine der beiden Richtungen
+        self.last_seen = self.last_active  # letzter Empfang, auch PING/PONG
+
+    def open_stream(self):
+        stream_id = self.next_stream
+        self.next_stream += 2
+        self.streams.add(stream_id)
+        return stream_id
+
+
+class RateLimitedError(RuntimeError):
+    """ERROR mit code 'rate_limited': der Server hat die Anfrage wegen seines Limits abgelehnt"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after  # Sekunden, nach denen ein neuer Versuch durchgeht
+
+
+class InFlightRequest:
+    __slots__ = ('request_id', 'message_type', 'reply_type', 'future', 'started', 'timer')
+
+    def __init__(self, request_id, message_type, reply_type, future, started, timer):
+        self.request_id = request_id
+        self.message_type = message_type
+        self.reply_type = reply_type
+        self.future = future
+        self.started = started
+        self.timer = timer
+
+
+class UdpEndpoint(asyncio.DatagramProtocol):
+    def __init__(self, engine):
+        self.engine = engine
+
+    def datagram_received(self, data, addr):
+        self.engine.handle_datagram(data, addr)
+
+    def error_received(self, exc):
+        pass
+
+
+async def read_frame_async(reader, decoder):
+    """Nächste vollständige Nachricht eines StreamReader; None, wenn die Gegenseite geschlossen hat"""
+    while True:
+        frame = decoder.next_frame()
+        if frame is not None:
+            return frame
+        data = await reader.read(RECV_SIZE)
+        if not data:
+            return None
+        decoder.feed(data)
+
+
+class ChatEngine:
+    """Client-Kern auf einer einzigen asyncio-Schleife.
+
+    Serververbindung, UDP-Endpunkt, TCP-Listener und alle Peer-Verbindungen
+    laufen als Tasks bzw. Protokolle derselben Schleife statt in je einem
+    Thread. Ergebnisse und eingehende Nachrichten meldet die Engine als
+    Ereignis on_event(name, data) und an jeden Leser von events(); Ein- und
+    Ausgabe übernimmt ein Front-End wie die TUI in Client.py oder ein Bot.
+    Alle Methoden müssen im Thread der Schleife aufgerufen werden.
+
+    Server- und Peer-Verbindungen, über die PING_INTERVAL Sekunden nichts
+    kam, bekommen ein PING; nach IDLE_TIMEOUT ohne Lebenszeichen werden sie
+    geschlossen. Die Zeitgeber liegen in einem TimerWheel, das ein einziger
+    Task jede Sekunde weiterdreht, statt eines Lese-Timeouts pro Verbindung.
+
+    Anfragen an den Server (broadcast, request_history, search,
+    request_stats, join, ...) schreiben nur in den Sendepuffer und geben
+    sofort ein Future zurück, das mit dem Body der Antwort erfüllt wird bzw.
+    bei ERROR mit RuntimeError (RateLimitedError mit retry_after, wenn das
+    Limit des Servers erreicht ist), ohne Antwort mit TimeoutError fehlschlägt.
+    Jede Anfrage trägt eine Request-ID, die der Server in der Antwort
+    zurückgibt; beliebig viele Anfragen können gleichzeitig offen sein.
+    Server ohne dieses Echo antworten der Reihe nach, dann wird in
+    Sendereihenfolge zugeordnet. Wer schneller sendet, als die Verbindung
+    abnimmt, wartet zwischendurch auf drain().
+
+    broadcast_batched() sammelt Broadcasts bis zu batch_linger Sekunden oder
+    batch_size Nachrichten und sendet sie als ein BATCH: ein Frame, ein
+    write und eine Bestätigung statt je einer pro Nachricht.
+    """
+
+    PROTOCOL_VERSION = PROTOCOL_V1
+    PREFERRED_VERSION = PROTOCOL_V2
+    HISTORY_ON_JOIN = 20
+    PEER_IDLE_TIMEOUT = 60.0  # Verbindung ohne offenen Chat so lange im Pool halten
+    PING_INTERVAL = 30.0  # so lange nichts empfangen, dann PING
+    IDLE_TIMEOUT = 90.0  # so lange nichts empfangen, dann gilt die Verbindung als tot
+    REGISTER_TIMEOUT = 10.0
+    REQUEST_TIMEOUT = 30.0
+    BATCH_LINGER = 0.005  # so lange wartet ein angefangener BATCH auf weitere Nachrichten
+    BATCH_SIZE = 200  # ab so vielen Nachrichten wird sofort gesendet (Server erlaubt bis 1000)
+
+    def __init__(self, nickname, on_event=None, batch_linger=BATCH_LINGER, batch_size=BATCH_SIZE):
+        self.nickname = nickname
+        self.on_event = on_event
+        self.batch_linger = batch_linger
+        self.batch_size = batch_size
+        self.my_ip = None
+        self.udp_port = None
+        self.tcp_port = None
+        self.udp_transport = None
+        self.tcp_server = None
+        self.server_reader = None
+        self.server_writer = None
+        self.server_decoder = FrameDecoder()
+        self.server_version = self.PROTOCOL_VERSION  # wechselt nach REGISTER_OK ggf. auf 2.0
+        self.server_encoding = None  # Content-Encoding zum Server, aus dem Accept-Encoding von REGISTER_OK
+        self.server_batches = False  # Server nimmt BATCH an (Batch-Header in REGISTER_OK)
+        self.server_keepalive = False  # Server beantwortet PING (Keepalive-Header in REGISTER_OK)
+        self.server_last_seen = None
+        self.peer_list = {}  # {nickname: {'ip', 'udp_port'}}
+        self.rooms = {}  # {room: {nickname: {'ip', 'udp_port'}}} der betretenen Räume
+        self.roster_epoch = None
+        self.roster_version = 0
+        self.handshakes = HandshakeTracker()
+        self.peer_links = {}  # {nickname: PeerLink}, auch nach Chat-Ende bis zum Leerlauf-Timeout
+        self.active_chats = {}  # {nickname: PeerLink} mit offenem Chat
+        self.chat_streams = {}  # {nickname: stream_id} des aktiven Chats
+        self.running = False
+        self._tasks = set()
+        self._handshake_wakeup = None
+        self.timers = TimerWheel(time.monotonic())  # Schlüssel: SERVER_TIMER oder ein PeerLink
+        self._in_flight = {}  # {request_id: InFlightRequest} in Sendereihenfolge
+        self._request_ids = itertools.count(1)
+        self._server_echoes = False  # Server gibt Request-IDs zurück
+        self.request_latencies = collections.deque(maxlen=1000)  # (Typ, Sekunden bis zur Antwort)
+        self._event_queues = []  # eine asyncio.Queue pro laufendem events()
+        self._batch = []  # gesammelte Broadcasts des nächsten BATCH
+        self._batch_future = None  # gemeinsames Future aller Nachrichten in _batch
+        self._batch_timer = None
+
+    def emit(self, name, data=None):
+        data = data or {}
+        if self.on_event is not None:
+            self.on_event(name, data)
+        for queue in self._event_queues:
+            queue.put_nowait((name, data))
+
+    async def events(self):
+        """Alle Ereignisse als (name, data), bis stop() aufgerufen wird"""
+        queue = asyncio.Queue()
+        self._event_queues.append(queue)
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            self._event_queues.remove(queue)
+
+    def spawn(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def start(self, server_host='localhost', server_port=8888):
+        await self.open_endpoints()
+        return await self.connect(server_host, server_port)
+
+    async def open_endpoints(self):
+        """UDP-Endpunkt und TCP-Listener für P2P-Chats öffnen"""
+        loop = asyncio.get_running_loop()
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.bind(('', 0))
+        self.udp_port = udp_socket.getsockname()[1]
+        self.udp_transport, _ = await loop.create_datagram_endpoint(lambda: UdpEndpoint(self), sock=udp_socket)
+
+        tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        tcp_socket.bind(('', 0))
+        self.tcp_port = tcp_socket.getsockname()[1]
+        self.tcp_server = await asyncio.start_server(self.accept_peer, sock=tcp_socket)
+
+        self.running = True
+        self._handshake_wakeup = asyncio.Event()
+        self.spawn(self.run_handshakes())
+        self.spawn(self.run_timers())
+
+    async def connect(self, host, port):
+        """Verbinden und registrieren; kehrt mit dem Body von REGISTER_OK zurück"""
+        self.server_reader, self.server_writer = await asyncio.open_connection(host, port)
+        self.my_ip = self.server_writer.get_extra_info('sockname')[0]
+        self.server_last_seen = time.monotonic()
+        self.timers.schedule(SERVER_TIMER, self.server_last_seen + self.PING_INTERVAL)
+        self.spawn(self.read_server())
+        return await self.register_with_server()
+
+    async def drain(self):
+        """Warten, bis der Sendepuffer zum Server unter die Hochwassermarke gefallen ist"""
+        if self.server_writer is not None:
+            await self.server_writer.drain()
+
+    async def stop(self):
+        self.running = False
+        for link in list(self.peer_links.values()):
+            link.writer.close()
+        if self.server_writer is not None:
+            self.server_writer.close()
+        if self.udp_transport is not None:
+            self.udp_transport.close()
+        if self.tcp_server is not None:
+            self.tcp_server.close()
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.flush_batch()
+        self.fail_requests()
+        for queue in self._event_queues:
+            queue.put_nowait(None)
+
+    # --- Server ---
+
+    def register_with_server(self):
+        register_data = {
+            'nickname': self.nickname,
+            'ip': self.my_ip,
+            'udp_port': self.udp_port
+        }
+        # Beitritte/Abgänge gesammelt als PRESENCE statt einzeln empfangen.
+        # REGISTER geht immer als Text, die Startzeile bietet die bevorzugte Version an.
+        return self.request('REGISTER', 'REGISTER_OK', register_data,
+                            {'Presence': 'batch', 'Batch': 'broadcast', 'Keepalive': 'ping',
+                             'Accept-Encoding': ', '.join(CODECS)},
+                            self.PREFERRED_VERSION,
+                            self.REGISTER_TIMEOUT)
+
+    def request(self, message_type, reply_type, json_data=None, additional_headers=None, offer_version=None,
+                timeout=None):
+        """Anfrage mit neuer Request-ID senden; das Future wird mit dem Body der Antwort erfüllt"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # Wer das Ergebnis nicht abwartet, bekommt Fehler trotzdem als server_error-Ereignis
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        request_id = str(next(self._request_ids))
+        headers = dict(additional_headers) if additional_headers else {}
+        headers['Request-ID'] = request_id
+        if not self.send_to_server(message_type, json_data, headers, offer_version):
+            future.set_exception(ConnectionError("Keine Verbindung zum Server"))
+            return future
+        timer = loop.call_later(timeout or self.REQUEST_TIMEOUT, self.expire_request, request_id)
+        self._in_flight[request_id] = InFlightRequest(request_id, message_type, reply_type, future,
+                                                      time.perf_counter(), timer)
+        return future
+
+    def resolve_request(self, message_type, headers, json_data):
+        """Antwort der offenen Anfrage mit derselben Request-ID zuordnen"""
+        request_id = headers.get('Request-ID')
+        if request_id is not None:
+            self._server_echoes = True
+            request = self._in_flight.pop(request_id, None)
+        elif self._in_flight and not self._server_echoes:
+            # Server ohne Request-ID-Echo: Antworten kommen in Sendereihenfolge, ein ERROR gilt der ältesten
+            request = next(iter(self._in_flight.values()))
+            if message_type not in (request.reply_type, 'ERROR'):
+                return
+            del self._in_flight[request.request_id]
+        else:
+            return
+        if request is None:
+            return
+
+        request.timer.cancel()
+        if request.future.done():
+            return
+        if message_type == 'ERROR':
+            if json_data.get('code') == 'rate_limited':
+                request.future.set_exception(RateLimitedError(json_data.get('message'),
+                                                              float(headers.get('Retry-After', 0))))
+            else:
+                request.future.set_exception(RuntimeError(json_data.get('message')))
+            return
+        self.request_latencies.append((request.message_type, time.perf_counter() - request.started))
+        request.future.set_result(json_data)
+
+    def expire_request(self, request_id):
+        request = self._in_flight.pop(request_id, None)
+        if request is not None and not request.future.done():
+            request.future.set_exception(TimeoutError(f"Keine Antwort auf {request.message_type}"))
+
+    def fail_requests(self):
+        """Offene Anfragen nach Verbindungsverlust abbrechen"""
+        requests, self._in_flight = self._in_flight, {}
+        for request in requests.values():
+            request.timer.cancel()
+            if not request.future.done():
+                request.future.set_exception(ConnectionError("Verbindung zum Server getrennt"))
+
+    def latency_stats(self):
+        """{Typ: {count, p50_ms, p99_ms}} der zuletzt beantworteten Anfragen"""
+        samples = collections.defaultdict(list)
+        for message_type, latency in self.request_latencies:
+            samples[message_type].append(latency)
+        stats = {}
+        for message_type, latencies in samples.items():
+            latencies.sort()
+            stats[message_type] = {
+                'count': len(latencies),
+                'p50_ms': round(latencies[int(0.5 * len(latencies))] * 1000, 2),
+                'p99_ms': round(latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] * 1000, 2)
+            }
+        return stats
+
+    def send_to_server(self, message_type, json_data=None, additional_headers=None, offer_version=None):
+        if self.server_writer is None or self.server_writer.is_closing():
+            return False
+        if offer_version is None and self.server_version == PROTOCOL_V2:
+            frame = encode_frame_parts(message_type, PROTOCOL_V2, additional_headers,
+                                       encode_body(json_data, PROTOCOL_V2), self.server_encoding)
+        else:
+            frame = encode_frame_parts(message_type, offer_version or self.PROTOCOL_VERSION, additional_headers,
+                                       encode_body(json_data), self.server_encoding, (('Host', self.my_ip),))
+        # Kopf und Body getrennt; ab Python 3.12 schreibt der Transport sie per sendmsg
+        self.server_writer.writelines(frame.buffers())
+        return True
+
+    async def read_server(self):
+        try:
+            while True:
+                frame = await read_frame_async(self.server_reader, self.server_decoder)
+                if frame is None:
+                    break
+                self.server_last_seen = time.monotonic()
+                message_type, headers, body = frame
+                self.handle_server_message(message_type, headers, json.loads(body) if body else {})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if self.running:
+                self.emit('error', {'message': f"Fehler bei Server-Kommunikation: {e}"})
+        self.fail_requests()
+        if self.running:
+            self.emit('disconnected')
+
+    def handle_server_message(self, message_type, headers, json_data):
+        self.resolve_request(message_type, headers, json_data)
+
+        if message_type == 'REGISTER_OK':
+            if headers.get('Protocol-Version') == PROTOCOL_V2:
+                self.server_version = PROTOCOL_V2
+            encodings = accepted_encodings(headers.get('Accept-Encoding'))
+            self.server_encoding = encodings[0] if encodings else None
+            self.server_batches = headers.get('Batch') == 'broadcast'
+            self.server_keepalive = headers.get('Keepalive') == 'ping'
+            self.emit('registered', json_data)
+            # Broadcasts von vor der Anmeldung nachholen
+            self.request_history(self.HISTORY_ON_JOIN)
+        elif message_type == 'USER_LIST':
+            self.update_peer_list(json_data.get('users', []), json_data.get('epoch'), json_data.get('version', 0))
+        elif message_type in ('USER_DELTA', 'PRESENCE'):
+            self.apply_roster_delta(json_data)
+        elif message_type == 'USER_JOINED':
+            self.add_peer(json_data)
+            self.emit('presence', {'joined': [json_data], 'left': []})
+        elif message_type == 'USER_LEFT':
+            self.remove_peer(json_data.get('nickname'))
+            self.emit('presence', {'joined': [], 'left': [json_data.get('nickname')]})
+        elif message_type == 'BROADCAST_MSG':
+            self.emit('broadcast', json_data)
+        elif message_type == 'BROADCAST_BATCH':
+            for broadcast_data in json_data.get('messages', []):
+                self.emit('broadcast', broadcast_data)
+        elif message_type == 'BROADCAST_OK':
+            self.emit('broadcast_ok', json_data)
+        elif message_type == 'BATCH_OK':
+            self.emit('batch_ok', json_data)
+        elif message_type == 'ERROR':
+            self.emit('server_error', json_data)
+        elif message_type == 'STATS_OK':
+            self.emit('stats', json_data)
+        elif message_type == 'HISTORY_OK':
+            self.emit('history', json_data)
+        elif message_type == 'SEARCH_OK':
+            self.emit('search', json_data)
+        elif message_type == 'JOIN_OK':
+            self.rooms[json_data['room']] = {user['nickname']: {'ip': user['ip'], 'udp_port': user['udp_port']}
+                                             for user in json_data.get('members', [])}
+            self.emit('room_joined', json_data)
+        elif message_type == 'LEAVE_OK':
+            self.rooms.pop(json_data.get('room'), None)
+            self.emit('room_left', json_data)
+        elif message_type == 'ROOM_PRESENCE':
+            members = self.rooms.get(json_data.get('room'))
+            if members is not None:
+                for user in json_data.get('joined', []):
+                    members[user['nickname']] = {'ip': user['ip'], 'udp_port': user['udp_port']}
+                for nickname in json_data.get('left', []):
+                    members.pop(nickname, None)
+            self.emit('room_presence', json_data)
+        elif message_type == 'ROOM_MSG':
+            self.emit('room_message', json_data)
+        elif message_type == 'PING':
+            self.send_to_server('PONG')
+
+    async def run_timers(self):
+        """Leerlauf-Zeitgeber aller Verbindungen, ein Tick pro Sekunde"""
+        while self.running:
+            await asyncio.sleep(self.timers.tick)
+            now = time.monotonic()
+            for key in self.timers.advance(now):
+                if key is SERVER_TIMER:
+                    self.check_server(now)
+                else:
+                    self.check_peer(key, now)
+
+    def check_server(self, now):
+        """Stille Serververbindung anpingen, nach IDLE_TIMEOUT ohne Lebenszeichen schließen"""
+        if self.server_writer is None or self.server_writer.is_closing() or not self.server_keepalive:
+            return  # ältere Server kennen kein PING
+        idle = now - self.server_last_seen
+        if idle >= self.IDLE_TIMEOUT:
+            self.emit('error', {'message': f"Server seit {idle:.0f} s ohne Lebenszeichen"})
+            # read_server sieht das Verbindungsende und meldet 'disconnected'
+            self.server_writer.close()
+            return
+        if idle >= self.PING_INTERVAL:
+            # Als Anfrage, damit die Antwortzeit in latency_stats eingeht
+            self.request('PING', 'PONG')
+            deadline = self.server_last_seen + self.IDLE_TIMEOUT
+        else:
+            deadline = self.server_last_seen + self.PING_INTERVAL
+        self.timers.schedule(SERVER_TIMER, deadline)
+
+    def sync_user_list(self):
+        """Nur die Änderungen seit der bekannten Roster-Version anfordern"""
+        if self.roster_epoch is None:
+            self.send_to_server('GET_USERS')
+        else:
+            self.send_to_server('GET_USERS', None, {'Since': self.roster_version, 'Epoch': self.roster_epoch})
+
+    def broadcast(self, message):
+        return self.request('BROADCAST', 'BROADCAST_OK', {'message': message})
+
+    def broadcast_batched(self, message):
+        """Broadcast in den nächsten BATCH legen.
+
+        Alle Nachrichten eines BATCH teilen sich ein Future, das mit dem Body
+        von BATCH_OK erfüllt wird. Ohne BATCH-Unterstützung des Servers gehen
+        die gesammelten Nachrichten einzeln als BROADCAST hinaus.
+        """
+        if self._batch_future is None:
+            self._batch_future = asyncio.get_running_loop().create_future()
+            self._batch_future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        future = self._batch_future
+        self._batch.append(message)
+        if len(self._batch) >= self.batch_size or self.batch_linger <= 0:
+            self.flush_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = asyncio.get_running_loop().call_later(self.batch_linger, self.flush_batch)
+        return future
+
+    def flush_batch(self):
+        """Gesammelte Broadcasts sofort senden"""
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        if not self._batch:
+            return
+        messages, self._batch = self._batch, []
+        future, self._batch_future = self._batch_future, None
+        if self.server_batches:
+            sent = self.request('BATCH', 'BATCH_OK', {'messages': messages})
+        else:
+            sent = asyncio.gather(*(self.broadcast(message) for message in messages))
+        sent.add_done_callback(lambda done: self._settle_batch(done, future, len(messages)))
+
+    @staticmethod
+    def _settle_batch(sent, future, count):
+        if future.done():
+            return
+        if sent.cancelled():
+            future.cancel()
+        elif sent.exception() is not None:
+            future.set_exception(sent.exception())
+        elif isinstance(sent.result(), list):
+            # Einzeln gesendet: eine Bestätigung im Format von BATCH_OK zusammenfassen
+            future.set_result({'message': 'Messages broadcasted', 'count': count})
+        else:
+            future.set_result(sent.result())
+
+    def join(self, room):
+        """Raum betreten; das Future liefert die übrigen Mitglieder"""
+        return self.request('JOIN', 'JOIN_OK', None, {'Room': room})
+
+    def leave(self, room):
+        return self.request('LEAVE', 'LEAVE_OK', None, {'Room': room})
+
+    def send_room(self, room, message):
+        """Nachricht an alle Mitglieder eines betretenen Raums"""
+        return self.request('ROOM_MSG', 'ROOM_MSG_OK', {'message': message}, {'Room': room})
+
+    def request_history(self, limit, since=None):
+        headers = {'Limit': limit}
+        if since is not None:
+            headers['Since'] = since
+        return self.request('HISTORY', 'HISTORY_OK', None, headers)
+
+    def search(self, query, limit=None):
+        return self.request('SEARCH', 'SEARCH_OK', {'query': query}, {'Limit': limit} if limit else None)
+
+    def request_stats(self):
+        return self.request('STATS', 'STATS_OK')
+
+    def update_peer_list(self, users, epoch=None, version=0):
+        self.peer_list = {user['nickname']: {'ip': user['ip'], 'udp_port': user['udp_port']} for user in users}
+        self.roster_epoch = epoch
+        self.roster_version = version
+
+    def apply_roster_delta(self, json_data):
+        """USER_DELTA/PRESENCE auf die vorhandene Peer-Liste anwenden"""
+        if json_data.get('epoch') != self.roster_epoch or json_data.get('from_version', 0) > self.roster_version:
+            # Server neu gestartet oder Änderungen verpasst
+            self.sync_user_list()
+            return
+
+        joined = [user for user in json_data.get('joined', []) if user['nickname'] != self.nickname]
+        left = [nickname for nickname in json_data.get('left', []) if nickname != self.nickname]
+
+        # Ein PRESENCE kann Beitritte enthalten, die schon in der USER_LIST standen
+        joined = [user for user in joined if self.peer_list.get(user['nickname']) !=
+                  {'ip': user['ip'], 'udp_port': user['udp_port']}]
+        left = [nickname for nickname in left if nickname in self.peer_list]
+
+        for user in joined:
+            self.add_peer(user)
+        for nickname in left:
+            self.remove_peer(nickname)
+        self.roster_version = max(self.roster_version, json_data.get('version', 0))
+        if joined or left:
+            self.emit('presence', {'joined': joined, 'left': left})
+
+    def add_peer(self, user):
+        self.peer_list[user.get('nickname')] = {'ip': user.get('ip'), 'udp_port': user.get('udp_port')}
+
+    def remove_peer(self, nickname):
+        self.peer_list.pop(nickname, None)
+        link = self.peer_links.get(nickname)
+        if link is not None:
+            self.close_peer_link(link)
+
+    # --- P2P über UDP ---
+
+    def send_datagram(self, message_type, json_data, target_ip, target_port, additional_headers=None):
+        headers = {'From': self.nickname, 'Host': self.my_ip}
+        if additional_headers:
+            headers.update(additional_headers)
+        self.udp_transport.sendto(encode_frame(message_type, self.PROTOCOL_VERSION, headers, encode_body(json_data)),
+                                  (target_ip, target_port))
+        return True
+
+    def handle_datagram(self, data, addr):
+        decoder = FrameDecoder()
+        decoder.feed(data)
+        try:
+            frame = decoder.next_frame()
+            if frame is None:
+                return
+            message_type, headers, body = frame
+            json_data = json.loads(body) if body else {}
+        except ValueError as e:
+            self.emit('error', {'message': f"Fehler beim UDP-Parsen: {e}"})
+            return
+
+        if message_type == 'CHAT_REQUEST':
+            self.handle_chat_request(headers, json_data, addr)
+        elif message_type == 'CHAT_RESPONSE':
+            self.handle_chat_response(headers, json_data)
+
+    async def run_handshakes(self):
+        """Wiederholungen und Zeitüberschreitungen ausgehender CHAT_REQUESTs"""
+        while self.running:
+            resend, expired, wait = self.handshakes.due()
+            for request in resend:
+                request.send()
+            for request in expired:
+                if request.peer not in self.active_chats:
+                    self.emit('chat_timeout', {'nickname': request.peer})
+            self._handshake_wakeup.clear()
+            try:
+                await asyncio.wait_for(self._handshake_wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def start_chat(self, peer_nickname):
+        if peer_nickname not in self.peer_list:
+            self.emit('error', {'message': f"Benutzer {peer_nickname} nicht gefunden"})
+            return False
+
+        if peer_nickname in self.active_chats:
+            self.emit('error', {'message': f"Chat mit {peer_nickname} bereits aktiv"})
+            return False
+
+        if self.handshakes.pending_for(peer_nickname):
+            self.emit('error', {'message': f"Chat-Anfrage an {peer_nickname} läuft bereits"})
+            return False
+
+        link = self.peer_links.get(peer_nickname)
+        if link is not None and link.multiplexed:
+            # Gepoolte Verbindung: neuer Stream ohne Handshake, Nachrichten dürfen sofort folgen
+            stream_id = link.open_stream()
+            link.last_active = time.monotonic()
+            self.chat_streams[peer_nickname] = stream_id
+            self.active_chats[peer_nickname] = link
+            self.send_peer(link, 'CHAT_OPEN', None, {'To': peer_nickname, 'Stream-ID': stream_id})
+            self.emit('chat_started', {'nickname': peer_nickname, 'latency': None, 'reused': True})
+            return True
+
+        peer_info = self.peer_list[peer_nickname]
+        chat_request_data = {
+            'tcp_port': self.tcp_port
+        }
+        request_id = f"{self.nickname}_{time.time_ns()}_{random.randint(1000, 9999)}"
+        additional_headers = {
+            'To': peer_nickname,
+            'Request-ID': request_id,
+            'Protocol-Version': self.PREFERRED_VERSION,
+            'Accept-Encoding': ', '.join(CODECS),
+            'Stream-ID': 1,  # mehrere Chats über eine Verbindung möglich
+            'Keepalive': 'ping'
+        }
+        # Bis CHAT_RESPONSE oder CHAT_HELLO eintrifft, wiederholt run_handshakes das Datagramm
+        self.handshakes.start(request_id, peer_nickname, lambda: self.send_datagram(
+            'CHAT_REQUEST', chat_request_data, peer_info['ip'], peer_info['udp_port'], additional_headers))
+        self._handshake_wakeup.set()
+        self.emit('chat_requested', {'nickname': peer_nickname, 'request_id': request_id})
+        return True
+
+    def handle_chat_request(self, headers, json_data, addr):
+        initiator = headers.get('From')
+        request_id = headers.get('Request-ID')
+
+        # Wiederholte Anfrage: nur die Antwort erneut senden, sie könnte verloren gegangen sein.
+        # Ohne Request-ID (ältere Peers) lässt sich keine Wiederholung erkennen.
+        cached = self.handshakes.seen(request_id) if request_id is not None else None
+        if cached is not None:
+            self.send_datagram('CHAT_RESPONSE', cached[0], addr[0], addr[1], cached[1])
+            return
+
+        self.emit('chat_request', {'nickname': initiator})
+        response_data = {
+            'accepted': True,
+            'tcp_port': self.tcp_port
+        }
+        additional_headers = {
+            'To': initiator,
+            'Request-ID': request_id if request_id is not None else 'unknown'
+        }
+        if request_id is not None:
+            self.handshakes.remember(request_id, (response_data, additional_headers))
+        self.send_datagram('CHAT_RESPONSE', response_data, addr[0], addr[1], additional_headers)
+        self.spawn(self.connect_peer(initiator, addr[0], json_data.get('tcp_port'), headers))
+
+    def handle_chat_response(self, headers, json_data):
+        accepted = json_data.get('accepted', False)
+        # Wiederholte Antworten auf schon bestätigte Anfragen ignorieren
+        if self.handshakes.acknowledge(headers.get('Request-ID'), accepted) is None:
+            return
+        self.emit('chat_response', {'nickname': headers.get('From'), 'accepted': accepted})
+
+    # --- P2P über TCP ---
+
+    async def connect_peer(self, initiator, ip, tcp_port, request_headers):
+        """TCP-Verbindung zum Initiator einer Chat-Anfrage aufbauen und CHAT_HELLO senden"""
+        try:
+            reader, writer = await asyncio.open_connection(ip, tcp_port)
+        except (OSError, TypeError) as e:
+            self.emit('error', {'message': f"Fehler beim Verbinden mit {initiator}: {e}"})
+            return
+
+        # Stream-ID in der Anfrage: der Initiator kann mehrere Chats über eine Verbindung führen
+        link = PeerLink(reader, writer, initiator, connected=True, multiplexed='Stream-ID' in request_headers)
+        hello_headers = {'Accept-Encoding': ', '.join(CODECS), 'Request-ID': request_headers.get('Request-ID')}
+        if link.multiplexed:
+            hello_headers['Stream-ID'] = link.open_stream()
+        if 'Keepalive' in request_headers:
+            link.keepalive = True
+            hello_headers['Keepalive'] = 'ping'
+        # Bietet der Initiator 2.0 an, geht CHAT_HELLO mit 2.0 in der Startzeile
+        # und alle weiteren Nachrichten binär
+        if request_headers.get('Protocol-Version') == PROTOCOL_V2:
+            self.send_peer(link, 'CHAT_HELLO', {'nickname': self.nickname}, hello_headers, offer_version=PROTOCOL_V2)
+            link.protocol_version = PROTOCOL_V2
+        else:
+            self.send_peer(link, 'CHAT_HELLO', {'nickname': self.nickname}, hello_headers)
+        encodings = accepted_encodings(request_headers.get('Accept-Encoding'))
+        link.content_encoding = encodings[0] if encodings else None
+
+        self.add_peer_link(link)
+        self.emit('chat_started', {'nickname': initiator, 'latency': None, 'reused': False})
+        await self.read_peer(link)
+
+    def accept_peer(self, reader, writer):
+        self.spawn(self.identify_peer(reader, writer))
+
+    async def identify_peer(self, reader, writer):
+        """Eingehende Verbindung: erst CHAT_HELLO zur Identifikation, dann Chat-Nachrichten"""
+        decoder = FrameDecoder()
+        try:
+            frame = await read_frame_async(reader, decoder)
+            if frame is None or frame[0] != 'CHAT_HELLO':
+                writer.close()
+                return
+            _, headers, body = frame
+            json_data = json.loads(body) if body else {}
+        except Exception as e:
+            self.emit('error', {'message': f"Fehler bei Chat-Identifikation: {e}"})
+            writer.close()
+            return
+
+        peer_nickname = json_data.get('nickname') or headers.get('From', 'Unknown')
+        link = PeerLink(reader, writer, peer_nickname, connected=False, multiplexed='Stream-ID' in headers,
+                        decoder=decoder)
+        link.keepalive = headers.get('Keepalive') == 'ping'
+        if decoder.version == PROTOCOL_V2:
+            link.protocol_version = PROTOCOL_V2
+        encodings = accepted_encodings(headers.get('Accept-Encoding'))
+        link.content_encoding = encodings[0] if encodings else None
+        if link.multiplexed:
+            link.streams.add(int(headers['Stream-ID']))
+        latency = self.handshakes.complete(headers.get('Request-ID'))
+
+        self.add_peer_link(link)
+        self.emit('chat_started', {'nickname': peer_nickname, 'latency': latency, 'reused': False})
+        await self.read_peer(link)
+
+    def add_peer_link(self, link):
+        """Verbindung in den Pool legen und den ersten Stream als aktiven Chat eintragen"""
+        previous = self.peer_links.get(link.nickname)
+        self.peer_links[link.nickname] = link
+        if previous is not None and previous is not link:
+            # Beide Seiten haben gleichzeitig verbunden: die ältere Verbindung läuft aus
+            self.close_peer_link(previous)
+        self.active_chats[link.nickname] = link
+        if link.streams:
+            self.chat_streams[link.nickname] = max(link.streams)
+        self.timers.schedule(link, link.last_seen + min(self.PING_INTERVAL, self.PEER_IDLE_TIMEOUT))
+
+    def close_peer_link(self, link):
+        """Gepoolte Verbindung abbauen; CHAT_CLOSE ohne Stream-ID schließt sie auch beim Peer"""
+        if link.multiplexed:
+            self.send_peer(link, 'CHAT_CLOSE', None, {'To': link.nickname})
+        link.writer.close()
+
+    def check_peer(self, link, now):
+        """Gepoolte Verbindung ohne Chat auslaufen lassen, stille Verbindung anpingen oder als tot schließen"""
+        if link.writer.is_closing():
+            return
+        # Offen ist ein Chat, solange er in active_chats steht; ältere Peers ohne
+        # Stream-ID haben nie Streams, ihr einziger Chat zählt trotzdem
+        chatting = self.active_chats.get(link.nickname) is link
+        if not chatting and now - link.last_active >= self.PEER_IDLE_TIMEOUT:
+            self.close_peer_link(link)
+            return
+        # Mit offenem Chat bleibt die Verbindung; ältere Peers ohne PING hält nur das
+        # Verbindungsende auf, der Zeitgeber schaut dann nur noch gelegentlich nach
+        deadline = now + self.PEER_IDLE_TIMEOUT if chatting else link.last_active + self.PEER_IDLE_TIMEOUT
+        if link.keepalive:
+            idle = now - link.last_seen
+            if idle >= self.IDLE_TIMEOUT:
+                # read_peer sieht das Verbindungsende und meldet den Chat als beendet
+                self.emit('error', {'message': f"{link.nickname} seit {idle:.0f} s ohne Lebenszeichen"})
+                link.writer.close()
+                return
+            if idle >= self.PING_INTERVAL:
+                self.send_peer(link, 'PING')
+                deadline = min(deadline, link.last_seen + self.IDLE_TIMEOUT)
+            else:
+                deadline = min(deadline, link.last_seen + self.PING_INTERVAL)
+        self.timers.schedule(link, deadline)
+
+    def send_peer(self, link, message_type, json_data=None, additional_headers=None, offer_version=None):
+        if link.writer.is_closing():
+            return False
+        if offer_version is None and link.protocol_version == PROTOCOL_V2:
+            frame = encode_frame_parts(message_type, PROTOCOL_V2, additional_headers,
+                                       encode_body(json_data, PROTOCOL_V2), link.content_encoding,
+                                       (('From', self.nickname),))
+        else:
+            frame = encode_frame_parts(message_type, offer_version or self.PROTOCOL_VERSION, additional_headers,
+                                       encode_body(json_data), link.content_encoding,
+                                       (('From', self.nickname), ('Host', self.my_ip)))
+        link.writer.writelines(frame.buffers())
+        return True
+
+    async def read_peer(self, link):
+        """Alle Streams einer Verbindung lesen, bis sie geschlossen wird; Leerlauf prüft check_peer"""
+        peer_nickname = link.nickname
+        try:
+            while self.running:
+                frame = await read_frame_async(link.reader, link.decoder)
+                if frame is None:
+                    break
+                message_type, headers, body = frame
+                link.last_seen = time.monotonic()
+                if message_type == 'PING':
+                    self.send_peer(link, 'PONG', None, {'To': peer_nickname})
+                    continue
+                if message_type == 'PONG':
+                    continue  # hält die Verbindung nur am Leben, nicht im Pool
+                link.last_active = link.last_seen
+                stream_id = int(headers['Stream-ID']) if 'Stream-ID' in headers else None
+
+                if message_type == 'CHAT_OPEN' and stream_id is not None:
+                    link.streams.add(stream_id)
+                    self.chat_streams[peer_nickname] = stream_id
+                    self.active_chats[peer_nickname] = link
+                    self.emit('chat_started', {'nickname': peer_nickname, 'latency': None, 'reused': True})
+                elif message_type == 'CHAT_MSG':
+                    if stream_id is not None and stream_id not in link.streams:
+                        continue  # Nachzügler eines bereits geschlossenen Streams
+                    json_data = json.loads(body) if body else {}
+                    self.emit('chat_message', {'nickname': peer_nickname, 'message': json_data.get('message'),
+                                               'timestamp': headers.get('Timestamp', '')})
+                elif message_type == 'CHAT_CLOSE':
+                    if stream_id is None:
+                        # Ohne Stream-ID: die ganze Verbindung wird geschlossen
+                        break
+                    link.streams.discard(stream_id)
+                    if self.chat_streams.get(peer_nickname) == stream_id:
+                        del self.chat_streams[peer_nickname]
+                        del self.active_chats[peer_nickname]
+                        self.emit('chat_closed', {'nickname': peer_nickname, 'by_peer': True})
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.emit('error', {'message': f"Chat-Fehler mit {peer_nickname}: {e}"})
+        finally:
+            self.timers.cancel(link)
+            if self.peer_links.get(peer_nickname) is link:
+                del self.peer_links[peer_nickname]
+                self.chat_streams.pop(peer_nickname, None)
+            if self.active_chats.get(peer_nickname) is link:
+                del self.active_chats[peer_nickname]
+                if self.running:
+                    self.emit('chat_closed', {'nickname': peer_nickname, 'by_peer': True})
+            link.writer.close()
+
+    def send_chat(self, peer_nickname, message):
+        link = self.active_chats.get(peer_nickname)
+        if link is None:
+            self.emit('error', {'message': f"Kein aktiver Chat mit {peer_nickname}"})
+            return False
+
+        # Timestamp hinzufügen
+        additional_headers = {
+            'To': peer_nickname,
+            'Timestamp': time.strftime('%H:%M:%S')
+        }
+        if peer_nickname in self.chat_streams:
+            additional_headers['Stream-ID'] = self.chat_streams[peer_nickname]
+        link.last_active = time.monotonic()
+        return self.send_peer(link, 'CHAT_MSG', {'message': message}, additional_headers)
+
+    def close_chat(self, peer_nickname):
+        link = self.active_chats.pop(peer_nickname, None)
+        if link is None:
+            self.emit('error', {'message': f"Kein aktiver Chat mit {peer_nickname}"})
+            return False
+
+        if link.multiplexed:
+            # Nur den Stream schließen, die Verbindung bleibt für den nächsten Chat im Pool
+            stream_id = self.chat_streams.pop(peer_nickname, None)
+            link.streams.discard(stream_id)
+            link.last_active = time.monotonic()
+            self.send_peer(link, 'CHAT_CLOSE', None, {'To': peer_nickname, 'Stream-ID': stream_id})
+        else:
+            self.send_peer(link, 'CHAT_CLOSE', None, {'To': peer_nickname})
+            link.writer.close()
+        self.emit('chat_closed', {'nickname': peer_nickname, 'by_peer': False})
+        return True
@@ -0,0 +1,149 @@
+import collections
+import threading
+import time
+
+SENT = 'sent'
+ACCEPTED = 'accepted'
+
+
+class PendingRequest:
+    __slots__ = ('request_id', 'peer', 'send', 'state', 'started', 'next_retry', 'timeout', 'attempts')
+
+    def __init__(self, request_id, peer, send, started, timeout):
+        self.request_id = request_id
+        self.peer = peer
+        self.send = send
+        self.state = SENT
+        self.started = started
+        self.next_retry = started + timeout
+        self.timeout = timeout
+        self.attempts = 1
+
+
+class HandshakeTracker:
+    """Zustandsautomat für den CHAT_REQUEST-Handshake über UDP, Schlüssel ist die Request-ID.
+
+    Ausgehend: CHAT_REQUEST wird bis zum CHAT_RESPONSE mit exponentiell
+    wachsendem Abstand wiederholt (SENT -> ACCEPTED); fertig ist der
+    Handshake mit dem CHAT_HELLO über TCP, das auch ohne CHAT_RESPONSE
+    genügt. Nach overall_timeout gilt die Anfrage als gescheitert.
+
+    Eingehend: beantwortete Request-IDs bleiben dedupe_ttl Sekunden mit
+    ihrer Antwort im Cache, damit eine Wiederholung nur die Antwort erneut
+    auslöst und keine zweite TCP-Verbindung.
+
+    Der Tracker hat keinen eigenen Timer; der Aufrufer fragt mit due() die
+    fälligen Wiederholungen ab (in ChatEngine ein Task der Event-Loop).
+    """
+
+    def __init__(self, initial_timeout=0.2, max_timeout=1.6, overall_timeout=8.0,
+                 dedupe_ttl=30.0, dedupe_size=1024, samples=1000):
+        self.initial_timeout = initial_timeout
+        self.max_timeout = max_timeout
+        self.overall_timeout = overall_timeout
+        self.dedupe_ttl = dedupe_ttl
+        self.dedupe_size = dedupe_size
+        self._lock = threading.Lock()
+        self._pending = {}  # {request_id: PendingRequest}
+        self._seen = collections.OrderedDict()  # {request_id: (Zeitpunkt, Antwort)}
+        self.latencies = collections.deque(maxlen=samples)  # Sekunden bis CHAT_HELLO
+        self.completed = 0
+        self.failed = 0
+        self.retransmits = 0
+
+    def start(self, request_id, peer, send):
+        """Anfrage senden und bis zur Antwort wiederholen; send() verschickt das Datagramm"""
+        with self._lock:
+            now = time.monotonic()
+            self._pending[request_id] = PendingRequest(request_id, peer, send, now, self.initial_timeout)
+        send()
+
+    def pending_for(self, peer):
+        with self._lock:
+            return any(request.peer == peer for request in self._pending.values())
+
+    def acknowledge(self, request_id, accepted=True):
+        """CHAT_RESPONSE erhalten: keine Wiederholungen mehr; abgelehnt beendet die Anfrage"""
+        with self._lock:
+            request = self._pending.get(request_id)
+            if request is None:
+                return None
+            if not accepted:
+                del self._pending[request_id]
+                self.failed += 1
+            else:
+                request.state = ACCEPTED
+            return request.peer
+
+    def complete(self, request_id):
+        """CHAT_HELLO zur Anfrage angekommen; gibt die Dauer des Handshakes zurück"""
+        with self._lock:
+            request = self._pending.pop(request_id, None)
+            if request is None:
+                return None
+            latency = time.monotonic() - request.started
+            self.latencies.append(latency)
+            self.completed += 1
+            return latency
+
+    def seen(self, request_id):
+        """Gespeicherte Antwort, falls die Request-ID kürzlich schon beantwortet wurde"""
+        with self._lock:
+            self._expire_seen(time.monotonic())
+            entry = self._seen.get(request_id)
+            return entry[1] if entry is not None else None
+
+    def remember(self, request_id, response):
+        with self._lock:
+            self._seen[request_id] = (time.monotonic(), response)
+            self._seen.move_to_end(request_id)
+            while len(self._seen) > self.dedupe_size:
+                self._seen.popitem(last=False)
+
+    def _expire_seen(self, now):
+        while self._seen:
+            request_id, (stamp, _) = next(iter(self._seen.items()))
+            if now - stamp <= self.dedupe_ttl:
+                break
+            del self._seen[request_id]
+
+    def stats(self):
+        """Abgeschlossene/gescheiterte Handshakes und Dauer-Perzentile in Millisekunden"""
+        with self._lock:
+            latencies = sorted(self.latencies)
+            data = {'completed': self.completed, 'failed': self.failed, 'retransmits': self.retransmits,
+                    'pending': len(self._pending)}
+        for name, fraction in (('p50_ms', 0.5), ('p99_ms', 0.99)):
+            data[name] = round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000, 1) \
+                if latencies else None
+        return data
+
+    def due(self):
+        """(zu wiederholende, abgelaufene Anfragen, Sekunden bis zur nächsten Frist oder None).
+
+        Der Aufrufer verschickt die Wiederholungen, meldet die abgelaufenen
+        und ruft due() spätestens nach der genannten Zeit oder nach start()
+        erneut auf.
+        """
+        resend = []
+        expired = []
+        wait = None
+        with self._lock:
+            now = time.monotonic()
+            for request in list(self._pending.values()):
+                if now - request.started >= self.overall_timeout:
+                    del self._pending[request.request_id]
+                    self.failed += 1
+                    expired.append(request)
+                    continue
+                deadline = request.started + self.overall_timeout
+                if request.state == SENT:
+                    if now >= request.next_retry:
+                        request.timeout = min(request.timeout * 2, self.max_timeout)
+                        request.next_retry = now + request.timeout
+                        request.attempts += 1
+                        self.retransmits += 1
+                        resend.append(request)
+                    deadline = min(deadline, request.next_retry)
+                wait = deadline - now if wait is None else min(wait, deadline - now)
+        return resend, expired, wait
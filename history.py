@@ -0,0 +1,264 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+from common import PROTOCOL_V2, encode_body
+
+# Indexeintrag pro Nachricht: Zeitstempel und Ende des Datensatzes in der .log-Datei
+INDEX_ENTRY = struct.Struct('!dQ')
+RECORD_SEPARATOR = b',\n'
+
+
+class Segment:
+    """Ein Abschnitt des Logs: <base>.log mit den Datensätzen, <base>.idx mit dem Index.
+
+    Jeder Datensatz ist der kompakte JSON-Body eines BROADCAST_MSG gefolgt von
+    ",\\n". Ein zusammenhängender Bereich ist damit nach Abschneiden der letzten
+    zwei Bytes direkt der Inhalt eines JSON-Arrays.
+    """
+
+    def __init__(self, directory, base):
+        self.base = base
+        self.log_path = os.path.join(directory, f"{base:020d}.log")
+        self.index_path = os.path.join(directory, f"{base:020d}.idx")
+        self.log_file = None
+        self.index_file = None
+        self.count = 0
+        self.size = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self._maps = None  # (log_map, index_map), nur für abgeschlossene Segmente
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return
+        index_size = os.path.getsize(self.index_path)
+        self.count = index_size // INDEX_ENTRY.size
+        if index_size % INDEX_ENTRY.size:
+            # Halb geschriebener Indexeintrag nach einem Absturz
+            os.truncate(self.index_path, self.count * INDEX_ENTRY.size)
+        if self.count:
+            with open(self.index_path, 'rb') as index_file:
+                self.first_timestamp = INDEX_ENTRY.unpack(index_file.read(INDEX_ENTRY.size))[0]
+                index_file.seek((self.count - 1) * INDEX_ENTRY.size)
+                self.last_timestamp, self.size = INDEX_ENTRY.unpack(index_file.read(INDEX_ENTRY.size))
+        if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > self.size:
+            # Daten ohne Indexeintrag verwerfen
+            os.truncate(self.log_path, self.size)
+
+    def open_for_append(self):
+        self.log_file = open(self.log_path, 'ab')
+        self.index_file = open(self.index_path, 'ab')
+
+    def append(self, body, timestamp):
+        self.log_file.write(body)
+        self.log_file.write(RECORD_SEPARATOR)
+        self.size += len(body) + len(RECORD_SEPARATOR)
+        self.index_file.write(INDEX_ENTRY.pack(timestamp, self.size))
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        self.last_timestamp = timestamp
+        self.count += 1
+
+    def flush(self):
+        if self.log_file is not None:
+            self.log_file.flush()
+            self.index_file.flush()
+
+    def seal(self):
+        """Segment abschließen; ab jetzt wird nur noch gelesen"""
+        if self.log_file is not None:
+            self.log_file.close()
+            self.index_file.close()
+            self.log_file = self.index_file = None
+
+    def maps(self):
+        """(log_map, index_map) für Lesezugriffe.
+
+        Abgeschlossene Segmente werden einmal gemappt und behalten, das
+        aktive Segment wächst noch und wird pro Anfrage in aktueller Größe
+        gemappt.
+        """
+        if self._maps is not None:
+            return self._maps
+        if not self.count:
+            return None
+        self.flush()
+        with open(self.log_path, 'rb') as log_file, open(self.index_path, 'rb') as index_file:
+            maps = (mmap.mmap(log_file.fileno(), self.size, access=mmap.ACCESS_READ),
+                    mmap.mmap(index_file.fileno(), self.count * INDEX_ENTRY.size, access=mmap.ACCESS_READ))
+        if self.log_file is None:
+            self._maps = maps
+        return maps
+
+    def position(self, index_map, index):
+        """Startposition des index-ten Datensatzes"""
+        if index == 0:
+            return 0
+        return INDEX_ENTRY.unpack_from(index_map, (index - 1) * INDEX_ENTRY.size)[1]
+
+    def find_time(self, index_map, timestamp):
+        """Index des ersten Datensatzes mit Zeitstempel >= timestamp"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if INDEX_ENTRY.unpack_from(index_map, middle * INDEX_ENTRY.size)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def close(self):
+        self.seal()
+        if self._maps is not None:
+            for mapping in self._maps:
+                mapping.close()
+            self._maps = None
+
+    def delete(self):
+        self.close()
+        for path in (self.log_path, self.index_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class BroadcastLog:
+    """Segmentiertes Append-only-Log aller BROADCAST_MSG mit fortlaufenden Offsets.
+
+    append() vergibt den Offset, legt ihn in die Nachricht und schreibt den
+    kompakten JSON-Body einmal ins aktive Segment. read() schneidet die
+    angefragten Datensätze direkt aus den gemappten Segmenten und liefert
+    sie als Inhalt eines JSON-Arrays, ohne einzelne Nachrichten erneut zu
+    serialisieren.
+
+    Ab segment_bytes wird ein neues Segment begonnen. Abgeschlossene
+    Segmente werden gelöscht, sobald das Log retention_bytes übersteigt
+    oder ihre letzte Nachricht älter als retention_seconds ist.
+    """
+
+    def __init__(self, directory, segment_bytes=8 * 1024 * 1024, retention_bytes=256 * 1024 * 1024,
+                 retention_seconds=7 * 24 * 3600):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.log'))
+        self.segments = [Segment(directory, base) for base in bases]
+        if not self.segments:
+            self.segments.append(Segment(directory, 0))
+        for segment in self.segments[:-1]:
+            segment.seal()
+        self.segments[-1].open_for_append()
+        self._enforce_retention(time.time())
+
+    @property
+    def next_offset(self):
+        active = self.segments[-1]
+        return active.base + active.count
+
+    @property
+    def first_offset(self):
+        return self.segments[0].base
+
+    def append(self, broadcast_data):
+        """Offset vergeben, Nachricht speichern; gibt den kompakten JSON-Body zurück"""
+        with self._lock:
+            broadcast_data['offset'] = self.next_offset
+            body = encode_body(broadcast_data, PROTOCOL_V2)
+            active = self.segments[-1]
+            active.append(body, broadcast_data.get('timestamp', time.time()))
+            if active.size >= self.segment_bytes:
+                self._roll()
+        return body
+
+    def flush(self):
+        """Aktives Segment auf die Platte bringen und abgelaufene Segmente löschen.
+
+        Der Server ruft flush() etwa einmal pro Sekunde auf; so greift
+        retention_seconds auch dann, wenn lange kein neues Segment beginnt.
+        """
+        with self._lock:
+            self.segments[-1].flush()
+            self._enforce_retention(time.time())
+
+    def read(self, since=None, since_time=None, limit=100):
+        """(erster Offset, nächster Offset, JSON-Array-Inhalt) ab since bzw. since_time.
+
+        Ohne Angabe werden die letzten limit Nachrichten geliefert.
+        """
+        with self._lock:
+            if since is None and since_time is None:
+                since = self.next_offset - limit
+            start = max(self.first_offset, min(since if since is not None else 0, self.next_offset))
+
+            parts = []
+            temporary = []  # Mappings des aktiven Segments, nach dem Lesen wieder schließen
+            first = None
+            offset = start
+            remaining = limit
+            for segment in self.segments:
+                if remaining <= 0:
+                    break
+                if segment.base + segment.count <= offset or not segment.count:
+                    continue
+                if since_time is not None and segment.last_timestamp < since_time:
+                    continue
+                log_map, index_map = segment.maps()
+                if segment.log_file is not None:
+                    temporary += (log_map, index_map)
+                index = max(0, offset - segment.base)
+                if since_time is not None:
+                    index = max(index, segment.find_time(index_map, since_time))
+                    since_time = None  # ab hier ist alles neuer
+                end = min(segment.count, index + remaining)
+                if index >= end:
+                    continue
+                parts.append(log_map[segment.position(index_map, index):segment.position(index_map, end)])
+                if first is None:
+                    first = segment.base + index
+                remaining -= end - index
+                offset = segment.base + end
+
+            for mapping in temporary:
+                mapping.close()
+            if first is None:
+                return self.next_offset, self.next_offset, b''
+            payload = b''.join(parts)[:-len(RECORD_SEPARATOR)]
+            return first, offset, payload
+
+    def get(self, offset):
+        """Gespeicherten JSON-Body einer Nachricht oder None, falls gelöscht"""
+        first, _, payload = self.read(since=offset, limit=1)
+        return payload if first == offset and payload else None
+
+    def _roll(self):
+        active = self.segments[-1]
+        active.seal()
+        segment = Segment(self.directory, active.base + active.count)
+        segment.open_for_append()
+        self.segments.append(segment)
+        self._enforce_retention(time.time())
+
+    def _enforce_retention(self, now):
+        total = sum(segment.size for segment in self.segments)
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            expired = oldest.last_timestamp is not None and now - oldest.last_timestamp > self.retention_seconds
+            if total <= self.retention_bytes and not expired:
+                break
+            total -= oldest.size
+            oldest.delete()
+            self.segments.pop(0)
+
+    def close(self):
+        with self._lock:
+            for segment in self.segments:
+                segment.close()
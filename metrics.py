@@ -0,0 +1,260 @@
+import collections
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from common import MESSAGE_CODES
+
+# Obergrenzen der Histogramm-Buckets in Sekunden
+HANDLE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+# Sammeltyp für Nachrichtentypen, die das Protokoll nicht kennt
+UNKNOWN_TYPE = 'UNKNOWN'
+
+
+class Histogram:
+    """Feste Buckets wie bei Prometheus; count/sum für den Mittelwert"""
+
+    def __init__(self, buckets=HANDLE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # letzter Bucket: +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """[(Obergrenze, Anzahl <= Obergrenze)], letzte Grenze '+Inf'"""
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class ServerMetrics:
+    """Zähler und Histogramme eines GroupChatServer.
+
+    Die Aufzeichnung hält nur einen kurzen Lock pro Aufruf; Verbindungs-
+    und Warteschlangenwerte werden erst beim Abfragen (snapshot) aus dem
+    Server gelesen, damit der Versandpfad nichts zusätzlich zählen muss.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.messages_in = collections.Counter()
+        self.messages_out = collections.Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.dropped_frames = 0  # von bereits geschlossenen Verbindungen
+        self.idle_disconnects = 0  # wegen Leerlauf-Timeout getrennte Verbindungen
+        self.rejected = collections.Counter()  # wegen Rate-Limit abgelehnte Nachrichten pro Typ
+        self.handle_seconds = {}  # {message_type: Histogram}
+
+    def record_in(self, message_type, size, seconds):
+        # Der Typ kommt vom Client: erfundene Typen dürfen keine eigenen Zähler anlegen
+        if message_type not in MESSAGE_CODES:
+            message_type = UNKNOWN_TYPE
+        with self._lock:
+            self.messages_in[message_type] += 1
+            self.bytes_in += size
+            histogram = self.handle_seconds.get(message_type)
+            if histogram is None:
+                histogram = self.handle_seconds[message_type] = Histogram()
+            histogram.observe(seconds)
+
+    def record_out(self, message_type, size):
+        with self._lock:
+            self.messages_out[message_type] += 1
+            self.bytes_out += size
+
+    def record_closed(self, connection):
+        with self._lock:
+            self.dropped_frames += connection.dropped_frames
+
+    def record_idle_disconnect(self):
+        with self._lock:
+            self.idle_disconnects += 1
+
+    def record_rejected(self, message_type):
+        with self._lock:
+            self.rejected[message_type] += 1
+
+    def snapshot(self, server, top=5):
+        with self._lock:
+            data = {
+                'uptime_seconds': round(time.time() - self.started, 1),
+                'messages_in': dict(self.messages_in),
+                'messages_out': dict(self.messages_out),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'idle_disconnects': self.idle_disconnects,
+                'rejected': dict(self.rejected),
+                'handle_seconds': {
+                    message_type: {
+                        'count': histogram.count,
+                        'sum': round(histogram.sum, 6),
+                        'buckets': histogram.cumulative()
+                    }
+                    for message_type, histogram in self.handle_seconds.items()
+                }
+            }
+            dropped = self.dropped_frames
+
+        depths = server.queue_depths()
+        data['connections'] = len(server.connections)
+        data['clients'] = len(server.clients)
+        data['roster_version'] = server.clients.version
+        roster = dict(server.clients.roster_stats)
+        roster['rebuild_seconds'] = round(roster['rebuild_seconds'], 6)
+        roster['last_rebuild_seconds'] = round(roster['last_rebuild_seconds'], 6)
+        data['roster'] = roster
+        data['rooms'] = server.rooms.stats()
+        data['queues'] = {
+            'frames': sum(depth['frames'] for depth in depths),
+            'bytes': sum(depth['bytes'] for depth in depths),
+            'max_bytes': depths[0]['bytes'] if depths else 0,
+            'lagging': sum(depth['lagging'] for depth in depths),
+            'dropped_frames': dropped + sum(depth['dropped'] for depth in depths),
+            'top': depths[:top]
+        }
+        return data
+
+
+def label(value):
+    """Label-Wert für das Prometheus-Textformat maskieren"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_text(data):
+    """Snapshot im Prometheus-Textformat"""
+    lines = [
+        f"chatroom_uptime_seconds {data['uptime_seconds']}",
+        f"chatroom_connections {data['connections']}",
+        f"chatroom_clients {data['clients']}",
+        f"chatroom_rooms {data['rooms']['rooms']}",
+        f"chatroom_room_memberships {data['rooms']['memberships']}",
+        f"chatroom_bytes_in_total {data['bytes_in']}",
+        f"chatroom_bytes_out_total {data['bytes_out']}",
+        f"chatroom_idle_disconnects_total {data['idle_disconnects']}",
+        f"chatroom_roster_cache_hits_total {data['roster']['hits']}",
+        f"chatroom_roster_rebuilds_total {data['roster']['rebuilds']}",
+        f"chatroom_roster_rebuild_seconds_total {data['roster']['rebuild_seconds']}",
+        f"chatroom_roster_last_rebuild_seconds {data['roster']['last_rebuild_seconds']}",
+    ]
+    for message_type, count in sorted(data['messages_in'].items()):
+        lines.append(f'chatroom_messages_in_total{{type="{label(message_type)}"}} {count}')
+    for message_type, count in sorted(data['messages_out'].items()):
+        lines.append(f'chatroom_messages_out_total{{type="{label(message_type)}"}} {count}')
+    for message_type, count in sorted(data['rejected'].items()):
+        lines.append(f'chatroom_rejected_total{{type="{label(message_type)}"}} {count}')
+    for message_type, histogram in sorted(data['handle_seconds'].items()):
+        message_type = label(message_type)
+        for bound, count in histogram['buckets']:
+            lines.append(f'chatroom_handle_seconds_bucket{{type="{message_type}",le="{bound}"}} {count}')
+        lines.append(f'chatroom_handle_seconds_sum{{type="{message_type}"}} {histogram["sum"]}')
+        lines.append(f'chatroom_handle_seconds_count{{type="{message_type}"}} {histogram["count"]}')
+    queues = data['queues']
+    lines += [
+        f"chatroom_queue_frames {queues['frames']}",
+        f"chatroom_queue_bytes {queues['bytes']}",
+        f"chatroom_queue_max_bytes {queues['max_bytes']}",
+        f"chatroom_lagging_clients {queues['lagging']}",
+        f"chatroom_dropped_frames_total {queues['dropped_frames']}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+class MetricsEndpoint:
+    """HTTP-Scrape-Endpunkt nur auf localhost: /metrics (Text) und /stats (JSON)"""
+
+    def __init__(self, server, port, host='127.0.0.1'):
+        chat_server = server
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                data = chat_server.metrics.snapshot(chat_server)
+                if self.path == '/metrics':
+                    payload = render_text(data).encode('utf-8')
+                    content_type = 'text/plain; version=0.0.4'
+                elif self.path == '/stats':
+                    payload = json.dumps(data).encode('utf-8')
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class RateLimitFilter(logging.Filter):
+    """Höchstens burst Meldungen pro Vorlage und interval Sekunden durchlassen.
+
+    Gruppiert wird nach der unformatierten Meldung (record.msg), sodass z.B.
+    alle "Client %s getrennt" zusammen zählen. Die Zahl der unterdrückten
+    Meldungen wird an die nächste durchgelassene angehängt.
+    """
+
+    def __init__(self, burst=10, interval=1.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._windows = {}  # {msg: [Fensterbeginn, durchgelassen, unterdrückt]}
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(record.msg)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self._windows[record.msg] = [now, 1, 0]
+            elif window[1] < self.burst:
+                window[1] += 1
+                suppressed = 0
+            else:
+                window[2] += 1
+                return False
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} ähnliche Meldungen unterdrückt)"
+        return True
+
+
+def configure_logging(level='INFO', burst=10, interval=1.0):
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    handler.addFilter(RateLimitFilter(burst, interval))
+    root = logging.getLogger('chatroom')
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    root.propagate = False
@@ -0,0 +1,53 @@
+# BATCH hat keinen eigenen Eimer, sondern belastet BROADCAST mit einem Token pro Nachricht
+RATE_LIMITS = {
+    'BROADCAST': (50.0, 200),  # Nachrichten/s, Burst
+    'ROOM_MSG': (50.0, 200),
+    'GET_USERS': (5.0, 20),
+}
+
+
+class TokenBucket:
+    """Token Bucket für einen Nachrichtentyp eines Clients.
+
+    Der Eimer fasst burst Token und füllt sich mit rate Token pro Sekunde
+    auf; jede Nachricht kostet einen. Nachgefüllt wird erst beim nächsten
+    take() anhand der vergangenen Zeit, es läuft also kein Timer mit.
+    Kostet etwas mehr als burst (ein großer BATCH), geht es bei vollem Eimer
+    durch und der Eimer wird negativ, bis die Rate es wieder abgedeckt hat.
+    Jeder Eimer gehört zu genau einer Verbindung und wird nur von deren
+    Leser (Handler-Thread bzw. Event-Loop) benutzt, daher ohne Lock.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now, cost=1):
+        """cost Token entnehmen; 0.0, wenn genug da waren, sonst Sekunden bis dahin (nichts entnommen)"""
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        needed = min(cost, self.burst)
+        if tokens >= needed:
+            self.tokens = tokens - cost
+            return 0.0
+        self.tokens = tokens
+        return (needed - tokens) / self.rate
+
+
+def parse_rate_limits(text):
+    """'BROADCAST=50/200,GET_USERS=5/20' -> {Typ: (rate, burst)}; 'none' schaltet alle Limits ab"""
+    if text.strip().lower() == 'none':
+        return {}
+    limits = {}
+    for part in text.split(','):
+        message_type, _, value = part.partition('=')
+        rate, _, burst = value.partition('/')
+        rate = float(rate)
+        burst = int(burst) if burst else max(1, int(rate))
+        if rate <= 0 or burst < 1:
+            raise ValueError(f"Ungültiges Limit: {part}")
+        limits[message_type.strip().upper()] = (rate, burst)
+    return limits
@@ -0,0 +1,178 @@
+import collections
+import itertools
+import threading
+import time
+
+
+class ClientSession:
+    """Serverseitiger Eintrag eines angemeldeten Clients: nur, was Roster und Versand brauchen.
+
+    Anders als common.ClientInfo (Client-Seite mit Sockets, Peer-Liste und
+    Chats) ohne __dict__ und ohne leere Dicts; bei vielen Tausend Clients
+    belegt der Server so nur ein Objekt fester Größe pro Anmeldung.
+    """
+    __slots__ = ('nickname', 'ip', 'udp_port')
+
+    def __init__(self, nickname, ip, udp_port):
+        self.nickname = nickname
+        self.ip = ip
+        self.udp_port = udp_port
+
+    def __repr__(self):
+        return f"ClientSession({self.nickname!r}, {self.ip!r}, {self.udp_port!r})"
+
+
+class ClientRegistry:
+    """Registrierte Clients, indiziert nach Socket und Nickname.
+
+    Änderungen laufen unter einem Lock, damit ein Nickname atomar
+    reserviert wird. Leser (z.B. Broadcast-Schleifen) nehmen keinen Lock,
+    sondern iterieren über einen unveränderlichen Snapshot, der erst nach
+    einer Änderung beim nächsten Lesen neu gebaut wird.
+
+    Zu jedem Client wird sein Eintrag für die Benutzerliste einmal als JSON
+    hinterlegt. roster_json() setzt daraus pro Roster-Version einmal ein
+    JSON-Array zusammen und schneidet für jede Anfrage nur den Eintrag des
+    Anfragenden heraus.
+
+    Jede Änderung erhöht die Roster-Version. Die letzten history Änderungen
+    werden aufbewahrt, damit Clients mit changes_since() nur das Delta
+    abholen können. Die Epoche wechselt mit jedem Serverstart.
+
+    Im Shard-Betrieb stehen Clients anderer Shards mit remote=True unter
+    einem Platzhalter-Schlüssel im Roster. Sie belegen ihren Nickname und
+    erscheinen in Benutzerliste und Deltas, aber nicht in snapshot(), get()
+    oder len(), die nur lokale Verbindungen betreffen.
+    """
+
+    def __init__(self, history=4096):
+        self._lock = threading.Lock()
+        self._by_socket = {}    # {client_socket: ClientSession}
+        self._by_nickname = {}  # {nickname: client_socket}
+        self._remote = {}       # {Platzhalter: ClientSession} für Clients anderer Shards
+        self._version = 0
+        self._snapshot = (0, ())
+        self._changes = collections.deque(maxlen=history)  # (version, nickname, ClientSession oder None)
+        self._entries = {}  # {client_socket: Listeneintrag als JSON-Bytes}
+        self._roster = (0, memoryview(b''), {})  # (version, Einträge mit ", " verbunden, {client_socket: (start, end)})
+        self.epoch = str(int(time.time() * 1000))
+        self.roster_stats = {'hits': 0, 'rebuilds': 0, 'rebuild_seconds': 0.0, 'last_rebuild_seconds': 0.0}
+
+    @property
+    def version(self):
+        return self._version
+
+    def register(self, client_socket, client_info, entry_json=b'', remote=False):
+        """Nickname reservieren; False, wenn er bereits vergeben ist"""
+        with self._lock:
+            if client_info.nickname in self._by_nickname:
+                return False
+            self._by_nickname[client_info.nickname] = client_socket
+            if remote:
+                self._remote[client_socket] = client_info
+            else:
+                self._by_socket[client_socket] = client_info
+            self._entries[client_socket] = entry_json
+            self._version += 1
+            self._changes.append((self._version, client_info.nickname, client_info))
+        return True
+
+    def unregister(self, client_socket):
+        """Client entfernen; gibt seine ClientSession zurück oder None, falls schon entfernt"""
+        with self._lock:
+            client_info = self._by_socket.pop(client_socket, None)
+            if client_info is None:
+                client_info = self._remote.pop(client_socket, None)
+            if client_info is None:
+                return None
+            del self._by_nickname[client_info.nickname]
+            del self._entries[client_socket]
+            self._version += 1
+            self._changes.append((self._version, client_info.nickname, None))
+        return client_info
+
+    def changes_since(self, version):
+        """(aktuelle Version, {nickname: ClientSession oder None (verlassen)}) seit version.
+
+        None, wenn die Änderungen nicht mehr (oder noch nie) im Verlauf liegen.
+        """
+        with self._lock:
+            if version == self._version:
+                return self._version, {}
+            if version > self._version or not self._changes or self._changes[0][0] > version + 1:
+                return None
+            start = version + 1 - self._changes[0][0]
+            changes = {nickname: client_info
+                       for _, nickname, client_info in itertools.islice(self._changes, start, None)}
+            return self._version, changes
+
+    def get(self, client_socket, default=None):
+        return self._by_socket.get(client_socket, default)
+
+    def remote_info(self, remote_key):
+        """ClientSession eines Clients auf einem anderen Shard oder None"""
+        return self._remote.get(remote_key)
+
+    def find(self, nickname):
+        """Socket zu einem Nickname oder None"""
+        return self._by_nickname.get(nickname)
+
+    def snapshot(self):
+        """Unveränderliches Tupel aller lokalen (client_socket, ClientSession)-Paare"""
+        version, items = self._snapshot
+        current = self._version
+        if version != current:
+            # tuple(dict.items()) läuft in CPython ohne Freigabe des GIL durch;
+            # ein paralleler Schreiber erhöht danach die Version, sodass ein
+            # zu neuer Snapshot höchstens einmal zu oft neu gebaut wird.
+            items = tuple(self._by_socket.items())
+            self._snapshot = (current, items)
+        return items
+
+    def roster_json(self, exclude=None):
+        """(Version, JSON-Array aller Listeneinträge ohne exclude) ohne erneutes json.dumps"""
+        version, joined, spans = self._roster
+        if version != self._version:
+            version, joined, spans = self._rebuild_roster()
+        else:
+            self.roster_stats['hits'] += 1
+
+        span = spans.get(exclude)
+        if span is None:
+            return version, b''.join((b'[', joined, b']'))
+
+        start, end = span
+        if end < len(joined):
+            end += 2    # folgendes ", " mit entfernen
+        elif start > 0:
+            start -= 2  # letzter Eintrag: vorangehendes ", " entfernen
+        return version, b''.join((b'[', joined[:start], joined[end:], b']'))
+
+    def _rebuild_roster(self):
+        started = time.perf_counter()
+        with self._lock:
+            version = self._version
+            entries = tuple(self._entries.items())
+
+        spans = {}
+        position = 0
+        for client_socket, entry_json in entries:
+            spans[client_socket] = (position, position + len(entry_json))
+            position += len(entry_json) + 2
+        roster = (version, memoryview(b', '.join(entry_json for _, entry_json in entries)), spans)
+        self._roster = roster
+
+        elapsed = time.perf_counter() - started
+        self.roster_stats['rebuilds'] += 1
+        self.roster_stats['rebuild_seconds'] += elapsed
+        self.roster_stats['last_rebuild_seconds'] = elapsed
+        return roster
+
+    def __getitem__(self, client_socket):
+        return self._by_socket[client_socket]
+
+    def __contains__(self, client_socket):
+        return client_socket in self._by_socket
+
+    def __len__(self):
+        return len(self._by_socket)
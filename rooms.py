@@ -0,0 +1,88 @@
+import threading
+
+LOBBY = 'lobby'
+MAX_ROOM_NAME = 64
+
+
+def valid_room(name):
+    """Raumname zulässig? Die Lobby (alle Clients) kann weder betreten noch verlassen werden"""
+    return bool(name) and len(name) <= MAX_ROOM_NAME and name != LOBBY and name.isprintable()
+
+
+class RoomIndex:
+    """Mitglieder benannter Räume, indiziert in beide Richtungen.
+
+    Raum -> {Socket: ClientSession} liefert beim Versand einer ROOM_MSG nur die
+    Abonnenten, die Kosten wachsen mit der Raumgröße statt mit der Zahl der
+    Clients. Socket -> Räume wird beim Trennen gebraucht. Wie beim
+    ClientRegistry ändern Schreiber unter einem Lock, Leser iterieren ohne
+    Lock über einen Snapshot pro Raum, der nach einer Änderung neu gebaut
+    wird. Leere Räume werden sofort entfernt.
+
+    Im Shard-Betrieb stehen Mitglieder anderer Shards mit ihrem
+    Platzhalter-Schlüssel aus dem ClientRegistry im Raum.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._members = {}  # {room: {client_socket: ClientSession}}
+        self._rooms = {}  # {client_socket: set(room)}
+        self._snapshots = {}  # {room: ((client_socket, ClientSession), ...)}
+
+    def join(self, room, client_socket, client_info):
+        """Raum betreten; False, wenn der Client schon Mitglied ist"""
+        with self._lock:
+            members = self._members.setdefault(room, {})
+            if client_socket in members:
+                return False
+            members[client_socket] = client_info
+            self._rooms.setdefault(client_socket, set()).add(room)
+            self._snapshots.pop(room, None)
+        return True
+
+    def leave(self, room, client_socket):
+        """Raum verlassen; gibt die ClientSession zurück oder None, falls kein Mitglied"""
+        with self._lock:
+            return self._remove(room, client_socket)
+
+    def leave_all(self, client_socket):
+        """Alle Räume verlassen; gibt [(room, ClientSession)] zurück"""
+        with self._lock:
+            rooms = self._rooms.get(client_socket, ())
+            return [(room, self._remove(room, client_socket)) for room in sorted(rooms)]
+
+    def _remove(self, room, client_socket):
+        members = self._members.get(room)
+        if members is None or client_socket not in members:
+            return None
+        client_info = members.pop(client_socket)
+        if not members:
+            del self._members[room]
+        rooms = self._rooms[client_socket]
+        rooms.discard(room)
+        if not rooms:
+            del self._rooms[client_socket]
+        self._snapshots.pop(room, None)
+        return client_info
+
+    def members(self, room):
+        """Unveränderliches Tupel der (client_socket, ClientSession)-Paare eines Raums"""
+        snapshot = self._snapshots.get(room)
+        if snapshot is None:
+            with self._lock:
+                members = self._members.get(room)
+                if members is None:
+                    return ()
+                snapshot = self._snapshots[room] = tuple(members.items())
+        return snapshot
+
+    def is_member(self, room, client_socket):
+        return client_socket in self._members.get(room, ())
+
+    def rooms_of(self, client_socket):
+        return sorted(self._rooms.get(client_socket, ()))
+
+    def stats(self):
+        with self._lock:
+            return {'rooms': len(self._members),
+                    'memberships': sum(len(members) for members in self._members.values())}
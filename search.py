@@ -0,0 +1,174 @@
+import array
+import bisect
+import collections
+import heapq
+import json
+import logging
+import math
+import queue
+import re
+import threading
+
+log = logging.getLogger('chatroom.search')
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class SearchIndex:
+    """Invertierter Index über die Broadcasts im Verlauf.
+
+    Dokument-ID ist der Offset im BroadcastLog; gespeichert werden nur
+    Postings (Offset, Häufigkeit) und die Länge jedes Dokuments, der Text
+    selbst bleibt im Verlauf. Der Absender steht als Term "from:<nickname>"
+    im Index. Treffer werden mit BM25 bewertet, bei Gleichstand gewinnt die
+    neuere Nachricht.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, base=0):
+        self._lock = threading.Lock()
+        self._postings = {}  # {term: (array Offsets, array Häufigkeiten)}
+        self._lengths = array.array('H')  # Dokumentlänge, Index = Offset - base
+        self.base = base
+        self.documents = 0
+        self._total_length = 0
+
+    def add_batch(self, documents):
+        """[(offset, sender, message)] in einem Zug aufnehmen"""
+        with self._lock:
+            for offset, sender, message in documents:
+                terms = tokenize(message)
+                counts = collections.Counter(terms)
+                counts[f"from:{sender.lower()}"] += 1
+                for term, count in counts.items():
+                    postings = self._postings.get(term)
+                    if postings is None:
+                        postings = self._postings[term] = (array.array('Q'), array.array('H'))
+                    postings[0].append(offset)
+                    postings[1].append(min(count, 0xFFFF))
+
+                position = offset - self.base
+                if position >= len(self._lengths):
+                    self._lengths.extend([0] * (position + 1 - len(self._lengths)))
+                self._lengths[position] = min(len(terms), 0xFFFF)
+                self.documents += 1
+                self._total_length += len(terms)
+
+    def prune(self, first_offset):
+        """Postings von Nachrichten vor first_offset entfernen (vom Verlauf gelöscht)"""
+        with self._lock:
+            removed = first_offset - self.base
+            if removed <= 0:
+                return
+            dropped = self._lengths[:removed]
+            self.documents -= len(dropped)
+            self._total_length -= sum(dropped)
+            del self._lengths[:removed]
+            self.base = first_offset
+            for term in list(self._postings):
+                offsets, frequencies = self._postings[term]
+                cut = bisect.bisect_left(offsets, first_offset)
+                if cut == len(offsets):
+                    del self._postings[term]
+                elif cut:
+                    del offsets[:cut]
+                    del frequencies[:cut]
+
+    def search(self, query, limit=20, first_offset=0):
+        """[(offset, score)] der besten Treffer; Offsets vor first_offset sind gelöscht"""
+        terms = []
+        for word in query.split():
+            if word.lower().startswith('from:'):
+                terms.append(word.lower())
+            else:
+                terms += tokenize(word)
+        if not terms:
+            return []
+
+        with self._lock:
+            if not self.documents:
+                return []
+            average_length = self._total_length / self.documents or 1
+            scores = collections.defaultdict(float)
+            for term in set(terms):
+                postings = self._postings.get(term)
+                if postings is None:
+                    continue
+                offsets, frequencies = postings
+                idf = math.log(1 + (self.documents - len(offsets) + 0.5) / (len(offsets) + 0.5))
+                for offset, frequency in zip(offsets, frequencies):
+                    if offset < first_offset:
+                        continue
+                    length = self._lengths[offset - self.base]
+                    norm = frequency + self.K1 * (1 - self.B + self.B * length / average_length)
+                    scores[offset] += idf * frequency * (self.K1 + 1) / norm
+
+        return heapq.nlargest(limit, scores.items(), key=lambda hit: (hit[1], hit[0]))
+
+
+class BackgroundIndexer:
+    """Nimmt Broadcasts über eine Queue entgegen und indiziert sie gesammelt in einem eigenen Thread.
+
+    submit() ist der einzige Aufruf im Broadcast-Pfad und blockiert nie;
+    neue Nachrichten sind dadurch erst nach kurzer Verzögerung auffindbar.
+    """
+
+    def __init__(self, index, history, batch_size=512):
+        self.index = index
+        self.history = history
+        self.batch_size = batch_size
+        self._queue = queue.SimpleQueue()
+        self.reindex_end = history.next_offset  # ab hier kommt alles über submit()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, offset, sender, message):
+        self._queue.put((offset, sender, message))
+
+    def stop(self):
+        self._queue.put(None)
+
+    def run(self):
+        self.reindex()
+        while True:
+            item = self._queue.get()
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self.index.add_batch(batch)
+                if self.history.first_offset > self.index.base:
+                    self.index.prune(self.history.first_offset)
+            if item is None:
+                return
+
+    def reindex(self):
+        """Beim Start den vorhandenen Verlauf einlesen"""
+        offset = self.history.first_offset
+        end = self.reindex_end
+        indexed = 0
+        while offset < end:
+            first, following, payload = self.history.read(since=offset, limit=self.batch_size)
+            if first == following:
+                break
+            messages = json.loads(b'[' + payload + b']')
+            self.index.add_batch([(message['offset'], message.get('sender', ''), message.get('message', ''))
+                                  for message in messages if message['offset'] < end])
+            indexed += len(messages)
+            offset = following
+        if indexed:
+            log.info("%s Nachrichten aus dem Verlauf indiziert", indexed)
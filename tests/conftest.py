@@ -0,0 +1,95 @@
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+# Die Module liegen flach im Wurzelverzeichnis, ohne Paket
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import PROTOCOL_V1, FrameDecoder, encode_body, encode_frame  # noqa: E402
+from Server import GroupChatServer  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+class ProtocolClient:
+    """Blockierender Text-Client für Tests gegen einen laufenden Server"""
+
+    def __init__(self, port, nickname):
+        self.nickname = nickname
+        self.socket = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.decoder = FrameDecoder()
+
+    def send(self, message_type, json_data=None, headers=None):
+        self.socket.sendall(encode_frame(message_type, PROTOCOL_V1, dict(headers or {}, Host='127.0.0.1'),
+                                         encode_body(json_data)))
+
+    def receive(self):
+        """Nächster Frame als (message_type, headers, json_data)"""
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is not None:
+                message_type, headers, body = frame
+                return message_type, headers, json.loads(body) if body else {}
+            if not self.decoder.recv_from(self.socket):
+                raise ConnectionError("Server hat die Verbindung geschlossen")
+
+    def receive_until(self, message_type):
+        """Frames bis einschließlich des ersten vom Typ message_type"""
+        frames = []
+        while not frames or frames[-1][0] != message_type:
+            frames.append(self.receive())
+        return frames
+
+    def register(self, headers=None):
+        self.send('REGISTER', {'nickname': self.nickname, 'ip': '127.0.0.1', 'udp_port': 1}, headers)
+        self.receive_until('REGISTER_OK')
+        self.receive_until('USER_LIST')
+
+    def close(self):
+        self.socket.close()
+
+
+@pytest.fixture
+def chat_server():
+    """Startet GroupChatServer(**options) in einem Thread; liefert die Funktion start(**options)"""
+    servers = []
+
+    def start(**options):
+        options.setdefault('mode', 'selector')
+        server = GroupChatServer(host='127.0.0.1', port=free_port(), **options)
+        thread = threading.Thread(target=server.start, daemon=True)
+        thread.start()
+        deadline = time.monotonic() + 5
+        while not server.running and time.monotonic() < deadline:
+            time.sleep(0.01)
+        servers.append((server, thread))
+        return server
+
+    yield start
+    for server, thread in servers:
+        server.stop()
+        thread.join(2)
+
+
+@pytest.fixture
+def connect():
+    """Liefert connect(server, nickname) -> ProtocolClient; Verbindungen werden am Ende geschlossen"""
+    clients = []
+
+    def open_client(server, nickname):
+        client = ProtocolClient(server.port, nickname)
+        clients.append(client)
+        return client
+
+    yield open_client
+    for client in clients:
+        client.close()
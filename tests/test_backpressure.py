@@ -0,0 +1,27 @@
+import socket
+
+from common import FrameDecoder
+from Server import Connection, GroupChatServer
+
+
+def queued_frames(connection):
+    decoder = FrameDecoder()
+    for _, frame in connection.outq:
+        decoder.feed(bytes(frame))
+    return [(message_type, headers.get('Request-ID')) for message_type, headers, _ in decoder.frames()]
+
+
+def test_coalesce_keeps_get_users_replies():
+    server = GroupChatServer(slow_consumer_policy='coalesce', send_buffer_limit=100)
+    ours, theirs = socket.socketpair()
+    connection = server.connections[ours] = Connection(ours, None)
+
+    server.send_message(ours, 'USER_JOINED', {'nickname': 'bert'})
+    server.send_user_list(ours, {'Request-ID': '7'})
+    server.send_message(ours, 'USER_LEFT', {'nickname': 'bert'})
+
+    frames = queued_frames(connection)
+    assert ('USER_LIST', '7') in frames
+    assert [frame for frame in frames if frame[1] is None] == [('USER_LIST', None)]
+    ours.close()
+    theirs.close()
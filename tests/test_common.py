@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+from common import PROTOCOL_V1, PROTOCOL_V2, FrameDecoder, encode_body, encode_frame
+
+
+def frames(protocol_version):
+    return [
+        encode_frame('BROADCAST', protocol_version, {'Request-ID': '1'},
+                     encode_body({'message': 'Hallo Welt'}, protocol_version)),
+        encode_frame('GET_USERS', protocol_version, {'Since': '4', 'Epoch': '17'}),
+        encode_frame('BROADCAST', protocol_version, None, encode_body({'message': 'ä' * 100}, protocol_version)),
+    ]
+
+
+@pytest.mark.parametrize('protocol_version', [PROTOCOL_V1, PROTOCOL_V2])
+def test_byte_by_byte(protocol_version):
+    decoder = FrameDecoder()
+    received = []
+    for byte in b''.join(frames(protocol_version)):
+        decoder.feed(bytes([byte]))
+        received += decoder.frames()
+
+    assert [message_type for message_type, _, _ in received] == ['BROADCAST', 'GET_USERS', 'BROADCAST']
+    assert received[0][1]['Request-ID'] == '1'
+    assert json.loads(received[0][2]) == {'message': 'Hallo Welt'}
+    assert received[1][1]['Since'] == '4' and received[1][2] == ''
+    assert json.loads(received[2][2]) == {'message': 'ä' * 100}
+    assert decoder.version == protocol_version
+
+
+@pytest.mark.parametrize('protocol_version', [PROTOCOL_V1, PROTOCOL_V2])
+def test_split_inside_header_and_body(protocol_version):
+    first, second, third = frames(protocol_version)
+    data = first + second + third
+    decoder = FrameDecoder()
+    cut = len(first) + 5  # mitten im Kopf des zweiten Frames
+    decoder.feed(data[:cut])
+    assert [frame[0] for frame in decoder.frames()] == ['BROADCAST']
+    decoder.feed(data[cut:-10])  # dritter Body unvollständig
+    assert [frame[0] for frame in decoder.frames()] == ['GET_USERS']
+    assert decoder.next_frame() is None
+    decoder.feed(data[-10:])
+    assert decoder.next_frame()[0] == 'BROADCAST'
+    assert decoder.next_frame() is None
+
+
+def test_mixed_versions_on_one_stream():
+    decoder = FrameDecoder()
+    decoder.feed(frames(PROTOCOL_V1)[1] + frames(PROTOCOL_V2)[1])
+    assert decoder.next_frame()[0] == 'GET_USERS' and decoder.version == PROTOCOL_V1
+    assert decoder.next_frame()[0] == 'GET_USERS' and decoder.version == PROTOCOL_V2
+
+
+def test_oversized_header_rejected():
+    decoder = FrameDecoder(max_header_size=64)
+    decoder.feed(b'BROADCAST 1.0\r\n' + b'X' * 100)
+    with pytest.raises(ValueError):
+        decoder.next_frame()
+
+
+@pytest.mark.parametrize('content_length', ['-5', str(32 * 1024 * 1024)])
+def test_invalid_content_length_rejected(content_length):
+    decoder = FrameDecoder()
+    decoder.feed(f"BROADCAST 1.0\r\nContent-Length: {content_length}\r\n\r\n{{}}".encode('utf-8'))
+    with pytest.raises(ValueError):
+        decoder.next_frame()
+    assert decoder.offset == 0
+
+
+def test_oversized_binary_body_rejected():
+    decoder = FrameDecoder(max_body_size=1024)
+    decoder.feed(encode_frame('BROADCAST', PROTOCOL_V2, None, b'x' * 2048))
+    with pytest.raises(ValueError):
+        decoder.next_frame()
@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+from common import PROTOCOL_V1, encode_body, encode_frame
+from engine import ChatEngine
+
+
+async def open_peer(headers):
+    """Als Peer mit dem Listener einer ChatEngine verbinden und CHAT_HELLO senden"""
+    engine = ChatEngine('anna')
+    started = asyncio.Event()
+    engine.on_event = lambda name, data: started.set() if name == 'chat_started' else None
+    await engine.open_endpoints()
+    reader, writer = await asyncio.open_connection('127.0.0.1', engine.tcp_port)
+    writer.write(encode_frame('CHAT_HELLO', PROTOCOL_V1, dict(headers, From='bert'), encode_body({'nickname': 'bert'})))
+    await asyncio.wait_for(started.wait(), 5)
+    return engine, reader, writer
+
+
+def test_legacy_chat_survives_idle_check():
+    async def scenario():
+        # Älterer Peer: kein Stream-ID, kein Keepalive, ein Chat pro Verbindung
+        engine, _, writer = await open_peer({})
+        link = engine.peer_links['bert']
+        assert not link.multiplexed and not link.streams
+
+        engine.check_peer(link, time.monotonic() + 10 * engine.PEER_IDLE_TIMEOUT)
+        assert not link.writer.is_closing()
+        assert engine.active_chats.get('bert') is link
+        writer.close()
+        await engine.stop()
+
+    asyncio.run(scenario())
+
+
+def test_pooled_link_without_chat_expires():
+    async def scenario():
+        engine, reader, writer = await open_peer({'Stream-ID': 1})
+        link = engine.peer_links['bert']
+        engine.check_peer(link, time.monotonic() + 10 * engine.PEER_IDLE_TIMEOUT)
+        assert not link.writer.is_closing()  # Chat auf Stream 1 ist offen
+
+        writer.write(encode_frame('CHAT_CLOSE', PROTOCOL_V1, {'From': 'bert', 'Stream-ID': 1}))
+        await writer.drain()
+        while 'bert' in engine.active_chats:
+            await asyncio.sleep(0.01)
+        engine.check_peer(link, time.monotonic() + engine.PEER_IDLE_TIMEOUT)
+        assert link.writer.is_closing()
+        writer.close()
+        await engine.stop()
+
+    asyncio.run(scenario())
+
+
+def test_chat_requests_without_request_id_are_not_deduplicated():
+    engine = ChatEngine('anna')
+    engine.tcp_port = 4000
+    sent = []
+    requests = []
+    engine.send_datagram = lambda message_type, data, ip, port, headers: sent.append((port, headers['To']))
+    engine.spawn = lambda coroutine: coroutine.close()
+    engine.on_event = lambda name, data: requests.append(data['nickname']) if name == 'chat_request' else None
+
+    engine.handle_chat_request({'From': 'bert'}, {'tcp_port': 5001}, ('127.0.0.1', 6001))
+    engine.handle_chat_request({'From': 'carl'}, {'tcp_port': 5002}, ('127.0.0.1', 6002))
+    assert requests == ['bert', 'carl']
+    assert sent == [(6001, 'bert'), (6002, 'carl')]
+
+    # Mit Request-ID wird eine Wiederholung weiterhin nur erneut beantwortet
+    engine.handle_chat_request({'From': 'dora', 'Request-ID': 'd1'}, {'tcp_port': 5003}, ('127.0.0.1', 6003))
+    engine.handle_chat_request({'From': 'dora', 'Request-ID': 'd1'}, {'tcp_port': 5003}, ('127.0.0.1', 6003))
+    assert requests == ['bert', 'carl', 'dora']
+    assert sent[2:] == [(6003, 'dora'), (6003, 'dora')]
@@ -0,0 +1,81 @@
+import json
+import os
+import time
+
+from history import INDEX_ENTRY, BroadcastLog
+
+
+def messages(payload):
+    return json.loads(b'[' + payload + b']')
+
+
+# Frisch genug, dass die Altersgrenze des Logs nichts löscht
+START = time.time() - 60
+
+
+def fill(log, count, start=0):
+    for number in range(start, start + count):
+        log.append({'sender': 'anna', 'message': f"Nachricht {number}", 'timestamp': START + number})
+
+
+def test_read_by_offset_and_time(tmp_path):
+    log = BroadcastLog(str(tmp_path), segment_bytes=300)
+    fill(log, 20)
+    assert len(log.segments) > 1
+
+    first, following, payload = log.read(since=5, limit=3)
+    assert (first, following) == (5, 8)
+    assert [entry['offset'] for entry in messages(payload)] == [5, 6, 7]
+
+    first, _, payload = log.read(since_time=START + 12, limit=2)
+    assert first == 12
+    assert [entry['message'] for entry in messages(payload)] == ['Nachricht 12', 'Nachricht 13']
+    log.close()
+
+
+def test_restart_continues_offsets(tmp_path):
+    log = BroadcastLog(str(tmp_path), segment_bytes=300)
+    fill(log, 15)
+    log.close()
+
+    log = BroadcastLog(str(tmp_path), segment_bytes=300)
+    assert log.next_offset == 15
+    fill(log, 5, start=15)
+    first, following, payload = log.read(since=0, limit=100)
+    assert (first, following) == (0, 20)
+    assert [entry['offset'] for entry in messages(payload)] == list(range(20))
+    log.close()
+
+
+def test_restart_after_torn_write(tmp_path):
+    log = BroadcastLog(str(tmp_path), segment_bytes=1 << 20)
+    fill(log, 3)
+    log.close()
+
+    # Absturz mitten im Schreiben: Datensatz ohne Indexeintrag und halber Indexeintrag
+    active = log.segments[-1]
+    with open(active.log_path, 'ab') as log_file:
+        log_file.write(b'{"sender": "anna", "mess')
+    with open(active.index_path, 'ab') as index_file:
+        index_file.write(INDEX_ENTRY.pack(START + 10, 10 ** 6)[:7])
+
+    log = BroadcastLog(str(tmp_path), segment_bytes=1 << 20)
+    assert log.next_offset == 3
+    assert os.path.getsize(active.index_path) == 3 * INDEX_ENTRY.size
+    fill(log, 1, start=3)
+    _, _, payload = log.read(since=0, limit=100)
+    assert [entry['message'] for entry in messages(payload)] == [f"Nachricht {number}" for number in range(4)]
+    log.close()
+
+
+def test_server_flushes_history_once_per_interval(tmp_path, monkeypatch):
+    from Server import GroupChatServer
+
+    server = GroupChatServer(history_dir=str(tmp_path))
+    flushes = []
+    monkeypatch.setattr(server.history, 'flush', lambda: flushes.append(time.monotonic()))
+    server._history_flushed -= server.HISTORY_FLUSH_INTERVAL
+    for _ in range(100):
+        server.run_timers(time.time())
+    assert len(flushes) == 1
+    server.history.close()
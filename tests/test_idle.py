@@ -0,0 +1,38 @@
+import socket
+
+from registry import ClientSession
+from Server import Connection, GroupChatServer
+
+
+def idle_server(keepalive):
+    server = GroupChatServer(ping_interval=30.0, idle_timeout=90.0)
+    ours, theirs = socket.socketpair()
+    connection = server.connections[ours] = Connection(ours, None)
+    connection.keepalive = keepalive
+    server.clients.register(ours, ClientSession('bert', '127.0.0.1', 1))
+    server.watch_connection(connection)
+    return server, connection, theirs
+
+
+def test_registered_client_without_keepalive_is_reaped():
+    server, connection, theirs = idle_server(keepalive=False)
+    start = connection.last_seen
+
+    server.check_idle(start + 31)
+    assert not connection.outq  # kein PING ohne Keepalive-Header
+    assert len(server.timers) == 1
+    server.check_idle(start + 92)
+    assert server.metrics.idle_disconnects == 1
+    assert theirs.recv(1) == b''
+    theirs.close()
+
+
+def test_keepalive_client_gets_ping_before_reap():
+    server, connection, theirs = idle_server(keepalive=True)
+    start = connection.last_seen
+
+    server.check_idle(start + 31)
+    assert [entry[0] for entry in connection.outq] == ['PING']
+    server.check_idle(start + 92)
+    assert server.metrics.idle_disconnects == 1
+    theirs.close()
@@ -0,0 +1,23 @@
+from metrics import ServerMetrics, render_text
+
+
+def test_unknown_types_share_one_bucket(chat_server, connect):
+    server = chat_server()
+    client = connect(server, 'anna')
+    client.register()
+    for number in range(50):
+        client.send(f'X{number}"}}')
+    client.send('GET_USERS')
+    client.receive_until('USER_LIST')
+
+    data = server.metrics.snapshot(server)
+    assert set(data['handle_seconds']) == {'REGISTER', 'GET_USERS', 'UNKNOWN'}
+    assert data['messages_in']['UNKNOWN'] == 50
+
+
+def test_render_text_escapes_labels(chat_server):
+    server = chat_server()
+    metrics = ServerMetrics()
+    metrics.record_out('A"}\\\n', 10)
+    text = render_text(metrics.snapshot(server))
+    assert 'chatroom_messages_out_total{type="A\\"}\\\\\\n"} 1' in text.splitlines()
@@ -0,0 +1,91 @@
+import pytest
+
+from ratelimit import TokenBucket, parse_rate_limits
+
+
+def test_burst_then_reject():
+    bucket = TokenBucket(10.0, 3, now=0.0)
+    assert [bucket.take(0.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take(0.0) == pytest.approx(0.1)
+
+
+def test_refill_with_elapsed_time():
+    bucket = TokenBucket(10.0, 3, now=0.0)
+    for _ in range(3):
+        bucket.take(0.0)
+    assert bucket.take(0.05) == pytest.approx(0.05)
+    assert bucket.take(0.1) == 0.0
+    assert bucket.take(0.1) > 0.0
+
+
+def test_refill_capped_at_burst():
+    bucket = TokenBucket(10.0, 3, now=0.0)
+    bucket.take(0.0)
+    assert [bucket.take(100.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take(100.0) > 0.0
+
+
+def test_cost_above_burst_runs_into_debt():
+    bucket = TokenBucket(10.0, 3, now=0.0)
+    assert bucket.take(0.0, cost=5) == 0.0
+    assert bucket.tokens == -2
+    # Erst wenn die Schuld abgetragen und ein Token nachgefüllt ist, geht wieder etwas durch
+    assert bucket.take(0.25) == pytest.approx(0.05)
+    assert bucket.take(0.4) == 0.0
+
+
+def test_rejected_take_keeps_tokens():
+    bucket = TokenBucket(1.0, 2, now=0.0)
+    assert bucket.take(0.0, cost=2) == 0.0
+    assert bucket.take(0.5, cost=2) == pytest.approx(1.5)
+    assert bucket.tokens == pytest.approx(0.5)
+
+
+def test_parse_rate_limits():
+    assert parse_rate_limits('broadcast=50/200, GET_USERS=5') == {'BROADCAST': (50.0, 200), 'GET_USERS': (5.0, 5)}
+    assert parse_rate_limits('none') == {}
+    with pytest.raises(ValueError):
+        parse_rate_limits('BROADCAST=0/10')
+
+
+def test_server_rejects_with_retry_after(chat_server, connect):
+    server = chat_server(rate_limits={'BROADCAST': (1.0, 2)})
+    client = connect(server, 'anna')
+    client.register()
+
+    for number in range(3):
+        client.send('BROADCAST', {'message': f"m{number}"}, {'Request-ID': str(number)})
+    replies = [client.receive_until(reply)[-1] for reply in ('BROADCAST_OK', 'BROADCAST_OK', 'ERROR')]
+
+    assert [headers['Request-ID'] for _, headers, _ in replies] == ['0', '1', '2']
+    _, headers, error = replies[2]
+    assert error['code'] == 'rate_limited'
+    assert 0 < float(headers['Retry-After']) <= 1.0
+    assert server.metrics.snapshot(server)['rejected'] == {'BROADCAST': 1}
+
+
+def test_server_charges_batch_per_message(chat_server, connect):
+    server = chat_server(rate_limits={'BROADCAST': (1.0, 3)})
+    client = connect(server, 'anna')
+    client.register()
+
+    # Drei Nachrichten leeren den Eimer, danach hat nicht einmal ein einzelner BROADCAST Platz
+    client.send('BATCH', {'messages': ['a', 'b', 'c']})
+    assert client.receive_until('BATCH_OK')[-1][2]['count'] == 3
+    client.send('BROADCAST', {'message': 'd'})
+    assert client.receive_until('ERROR')[-1][2]['code'] == 'rate_limited'
+    client.send('BATCH', {'messages': ['e']})
+    assert client.receive_until('ERROR')[-1][2]['code'] == 'rate_limited'
+
+
+def test_server_batch_above_burst_needs_full_bucket(chat_server, connect):
+    server = chat_server(rate_limits={'BROADCAST': (1.0, 3)})
+    client = connect(server, 'anna')
+    client.register()
+
+    client.send('BATCH', {'messages': ['a'] * 5})
+    assert client.receive_until('BATCH_OK')[-1][2]['count'] == 5
+    client.send('BATCH', {'messages': ['b'] * 5})
+    _, headers, error = client.receive_until('ERROR')[-1]
+    assert error['code'] == 'rate_limited'
+    assert float(headers['Retry-After']) > 4.0  # zwei Token Schuld plus drei für den vollen Eimer
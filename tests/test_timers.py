@@ -0,0 +1,44 @@
+from timers import TimerWheel
+
+
+def test_expiry_order_follows_deadlines():
+    wheel = TimerWheel(0.0, tick=1.0, slots=8)
+    wheel.schedule('c', 3.0)
+    wheel.schedule('a', 1.0)
+    wheel.schedule('b', 2.0)
+    assert wheel.advance(0.5) == []
+    assert [wheel.advance(now) for now in (1.0, 2.0, 3.0)] == [['a'], ['b'], ['c']]
+    assert len(wheel) == 0
+
+
+def test_deadline_beyond_one_revolution():
+    wheel = TimerWheel(0.0, tick=1.0, slots=4)
+    wheel.schedule('far', 6.0)
+    wheel.schedule('near', 2.0)
+    assert wheel.advance(2.0) == ['near']
+    assert wheel.advance(5.0) == []
+    assert wheel.advance(6.0) == ['far']
+
+
+def test_long_pause_expires_everything_due():
+    wheel = TimerWheel(0.0, tick=1.0, slots=4)
+    for second in range(1, 10):
+        wheel.schedule(second, float(second))
+    assert sorted(wheel.advance(100.0)) == list(range(1, 10))
+
+
+def test_cancel_and_reschedule():
+    wheel = TimerWheel(0.0, tick=1.0, slots=8)
+    wheel.schedule('a', 1.0)
+    wheel.schedule('b', 1.0)
+    wheel.cancel('a')
+    wheel.schedule('b', 3.0)
+    assert wheel.advance(2.0) == []
+    assert wheel.advance(3.0) == ['b']
+
+
+def test_past_deadline_fires_on_next_tick():
+    wheel = TimerWheel(5.0, tick=1.0, slots=8)
+    wheel.schedule('late', 1.0)
+    assert wheel.advance(5.5) == []
+    assert wheel.advance(6.0) == ['late']
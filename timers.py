@@ -0,0 +1,69 @@
+import math
+import threading
+
+
+class TimerWheel:
+    """Hashed Timer Wheel: Zeitgeber für sehr viele Schlüssel zu O(1) pro Tick.
+
+    Die Zeitachse ist in Ticks von tick Sekunden geteilt, ein Ring aus slots
+    Fächern nimmt je Tick die dort fälligen Schlüssel auf. Eintragen und
+    Entfernen sind ein Dict-Zugriff; advance() besucht nur die Fächer der
+    seither vergangenen Ticks statt aller Zeitgeber. Liegt eine Frist mehr
+    als eine Umdrehung (tick * slots) in der Zukunft, bleibt der Schlüssel
+    bis zur passenden Runde in seinem Fach.
+
+    Pro Schlüssel gibt es höchstens einen Zeitgeber, schedule() ersetzt ihn.
+    Die Auflösung ist ein Tick: fällig wird ein Schlüssel mit dem ersten
+    advance() nach seiner Frist, höchstens einen Tick zu spät. Wie der
+    HandshakeTracker hat das Rad keinen eigenen Thread, der Aufrufer ruft
+    advance() regelmäßig auf.
+    """
+
+    def __init__(self, now, tick=1.0, slots=256):
+        self.tick = tick
+        self._lock = threading.Lock()
+        self._slots = [{} for _ in range(slots)]  # {Schlüssel: Tick der Fälligkeit}
+        self._where = {}  # {Schlüssel: Fach}
+        self._current = int(now // tick)  # zuletzt abgearbeiteter Tick
+
+    def __len__(self):
+        return len(self._where)
+
+    def schedule(self, key, deadline):
+        """key zum Zeitpunkt deadline fällig werden lassen (ersetzt einen vorhandenen Zeitgeber)"""
+        with self._lock:
+            # Nie in den laufenden oder einen schon abgearbeiteten Tick eintragen
+            due = max(math.ceil(deadline / self.tick), self._current + 1)
+            index = due % len(self._slots)
+            slot = self._where.get(key)
+            if slot is not None and slot != index:
+                del self._slots[slot][key]
+            self._slots[index][key] = due
+            self._where[key] = index
+
+    def cancel(self, key):
+        with self._lock:
+            slot = self._where.pop(key, None)
+            if slot is not None:
+                del self._slots[slot][key]
+
+    def advance(self, now):
+        """Alle bis now fälligen Schlüssel austragen und zurückgeben"""
+        target = int(now // self.tick)
+        expired = []
+        with self._lock:
+            if target <= self._current:
+                return expired
+            # Nach langer Pause genügt eine Umdrehung, jedes Fach kommt einmal dran
+            first = max(self._current + 1, target - len(self._slots) + 1)
+            for tick in range(first, target + 1):
+                slot = self._slots[tick % len(self._slots)]
+                if not slot:
+                    continue
+                due = [key for key, when in slot.items() if when <= target]
+                for key in due:
+                    del slot[key]
+                    del self._where[key]
+                expired.extend(due)
+            self._current = target
+        return expired